@@ -6,6 +6,98 @@ import numpy as np
 import torch.distributed as dist
 import os
 from torch.utils.data import ConcatDataset
+from audiossl.lightning.samplers import (BatchedDataset, LengthBucketBatchSampler,
+                                        TokenBudgetBatchSampler, identity_collate,
+                                        load_length_manifest, num_mel_frames)
+
+class TensorBatchLoader:
+    """Minibatches of in-memory tensors, sliced from a (permuted) index with one
+    index_select per tensor; no dataset, sampler, collation or workers.
+
+    Under ddp each rank takes every world_size-th sample of the permutation,
+    padded to equal length like DistributedSampler. The permutation is drawn
+    from seed + epoch, so all ranks agree on it. float16 tensors (embeddings
+    read from an EmbeddingCache) are converted to float32 batch by batch.
+    """
+    def __init__(self, tensors, batch_size, shuffle=False, drop_last=False, seed=0):
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def _indices(self):
+        n = self.tensors[0].shape[0]
+        device = self.tensors[0].device
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=generator).to(device)
+        else:
+            indices = torch.arange(n, device=device)
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            world_size, rank = dist.get_world_size(), dist.get_rank()
+            total = -(-n // world_size) * world_size
+            indices = torch.cat([indices, indices[:total - n]])[rank:total:world_size]
+        return indices
+
+    def __len__(self):
+        n = self.tensors[0].shape[0]
+        if dist.is_available() and dist.is_initialized():
+            n = -(-n // dist.get_world_size())
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def __iter__(self):
+        indices = self._indices()
+        self.epoch += 1
+        for i in range(len(self)):
+            index = indices[i * self.batch_size:(i + 1) * self.batch_size]
+            yield tuple(t.index_select(0, index).float() if t.dtype == torch.float16
+                        else t.index_select(0, index) for t in self.tensors)
+
+
+class InMemoryDataModule(LightningDataModule):
+    """train/val/test splits held as tensors, batched by TensorBatchLoader.
+    By default the tensors stay in host memory and lightning moves every
+    batch to the device. With device="auto" (opt-in, all splits must fit in
+    the memory of every device) they are moved once to the training device of
+    the attached trainer, so batches never leave it."""
+    def __init__(self, train, val, test, batch_size, device="cpu"):
+        super().__init__()
+        self.splits = {"train": train, "val": val, "test": test}
+        self.batch_size = batch_size
+        self.device = device
+        self.loaders = {}
+
+    def setup(self, stage=None):
+        if self.device == "auto":
+            device = self.trainer.strategy.root_device if self.trainer is not None else torch.device("cpu")
+        else:
+            device = torch.device(self.device)
+        # splits may share tensors (all-folds data), move each only once
+        moved = {}
+        for name, tensors in self.splits.items():
+            for t in tensors:
+                if id(t) not in moved:
+                    moved[id(t)] = t.to(device)
+            self.splits[name] = tuple(moved[id(t)] for t in tensors)
+        self.loaders = {}
+
+    def _loader(self, name, shuffle):
+        if name not in self.loaders:
+            self.loaders[name] = TensorBatchLoader(self.splits[name], self.batch_size, shuffle=shuffle)
+        return self.loaders[name]
+
+    def train_dataloader(self):
+        return self._loader("train", True)
+
+    def val_dataloader(self):
+        return self._loader("val", False)
+
+    def test_dataloader(self):
+        return self._loader("test", False)
+
 
 def get_inmemory_datamodule(x_train,
                             y_train,
@@ -13,13 +105,71 @@ def get_inmemory_datamodule(x_train,
                             y_val,
                             x_test,
                             y_test,
-                            batch_size):
-            
-    dataset_train = data.TensorDataset(x_train,y_train)
-    dataset_val = data.TensorDataset(x_val,y_val)
-    dataset_test = data.TensorDataset(x_test,y_test)
+                            batch_size,
+                            device="cpu"):
+    return InMemoryDataModule((x_train,y_train),
+                              (x_val,y_val),
+                              (x_test,y_test),
+                              batch_size=batch_size,
+                              device=device)
+
+
+def get_inmemory_fold_datamodule(x, y, fold_ids, batch_size, device="cpu"):
+    """Embeddings of all clips of a multi-fold dataset with their fold ids, for
+    heads that select their own train/eval folds (MultiLinearClassifierPLModule)."""
+    tensors = (x, y, fold_ids)
+    return InMemoryDataModule(tensors,tensors,tensors,batch_size=batch_size,device=device)
+
+
+def get_all_folds_dataloader(data_path,
+                             dataset_name,
+                             transform,
+                             collate_fn,
+                             batch_size,
+                             num_workers=10):
+    """Dataloader over every clip of a multi-fold dataset, each clip listed once,
+    together with the fold id (1..num_folds) of every clip.
 
-    return LightningDataModule.from_datasets(dataset_train,dataset_val,dataset_test,batch_size=batch_size)
+    Folds are assumed to be leave-one-fold-out (as Urbansound8k): the held out
+    clips of fold k are the "test" split of fold k, its train split is the
+    union of all other folds. See `split_folds`.
+    """
+    dataset_info = datasets.get_dataset(dataset_name)
+    folds = [dataset_info.creator(data_path,
+                                  "test",
+                                  fold,
+                                  transform,
+                                  target_transform=None)
+             for fold in range(1, dataset_info.num_folds + 1)]
+    fold_ids = torch.cat([torch.full((len(d),), fold, dtype=torch.long)
+                          for fold, d in enumerate(folds, 1)])
+    dataloader = data.DataLoader(ConcatDataset(folds),
+                                 batch_size=batch_size,
+                                 num_workers=num_workers,
+                                 shuffle=False,
+                                 sampler=None,
+                                 drop_last=False,
+                                 collate_fn=collate_fn,
+                                 pin_memory=True)
+    return dataloader, fold_ids
+
+
+def validation_fold(folds, fold):
+    """Fold held out of the training folds of `fold` for validation: the next
+    one, cyclically. Selecting epochs or configs on the test fold itself would
+    inflate its score."""
+    folds = sorted(folds)
+    return folds[(folds.index(fold) + 1) % len(folds)]
+
+
+def split_folds(x, y, fold_ids, fold):
+    """Assemble x_train, y_train, x_val, y_val, x_test, y_test of `fold` from
+    embeddings of all clips: test on the held out fold, validate on its
+    `validation_fold` and train on the remaining ones."""
+    test = fold_ids == fold
+    val = fold_ids == validation_fold(fold_ids.unique().tolist(), fold)
+    train = ~(test | val)
+    return x[train], y[train], x[val], y[val], x[test], y[test]
 import numpy as np
 import pyarrow as pa
 from torch.utils.data import WeightedRandomSampler
@@ -96,6 +246,8 @@ class DistributedSamplerWrapper(DistributedSampler):
             self.sampler.generator = torch.Generator()
         self.sampler.generator.manual_seed(self.seed + self.epoch)
         indices = list(self.sampler)
+        # pad like DistributedSampler, so that every rank takes the same number of steps
+        indices += indices[:self.total_size - len(indices)]
         if self.epoch == 0:
             print(f"\n DistributedSamplerWrapper :  {indices[:10]} \n\n")
         indices = indices[self.rank:self.total_size:self.num_replicas]
@@ -136,6 +288,12 @@ class DownstreamDataModule(LightningDataModule):
                  limit_batch_size=None,
                  shuffle = True,
                  sampler = None,
+                 length_bucketing = False,
+                 length_manifest_dir = None,
+                 bucket_batches = 100,
+                 max_tokens = None,
+                 max_batch_size = None,
+                 max_clip_len = 12.,
                  **kwargs
                  ):
         super().__init__()
@@ -152,15 +310,36 @@ class DownstreamDataModule(LightningDataModule):
         self.multi_label=dataset_info.multi_label
         self.shuffle = shuffle
         self.sampler = sampler
+        # batch clips of similar length, lengths are read from a manifest
+        # (<length_manifest_dir>/<dataset>_<split>[_fold<k>].npz, built on first use)
+        self.length_bucketing = length_bucketing
+        self.length_manifest_dir = length_manifest_dir if length_manifest_dir is not None \
+            else os.path.join(data_path, "length_manifests")
+        self.bucket_batches = bucket_batches
+        # dynamic batches of at most max_tokens padded mel frames, clip lengths
+        # are capped at the max_clip_len seconds the transforms crop to
+        if max_tokens is not None and (dataset_name == "dcase" or sampler is not None):
+            # train_dataloader gives these their own loaders, steps_per_epoch
+            # would count token budget batches that are never drawn
+            raise ValueError("max_tokens can not be combined with the dcase or the weighted audioset sampler")
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_clip_frames = num_mel_frames(int(max_clip_len * 16000))
+        self.manifest_suffix = "_fold{}".format(fold) if num_folds > 1 else ""
         if num_folds > 1:
-            self.dataset_train = dataset_info.creator(data_path,
-                                                      "train",
-                                                      fold,
-                                                      transforms[0],
-                                                      target_transform=target_transforms[0])
+            # same splits as split_folds: test on the held out fold, validate
+            # on its validation_fold and train on the remaining ones
+            folds = list(range(1, num_folds + 1))
+            val_fold = validation_fold(folds, fold)
+            self.dataset_train = ConcatDataset([dataset_info.creator(data_path,
+                                                                     "test",
+                                                                     k,
+                                                                     transforms[0],
+                                                                     target_transform=target_transforms[0])
+                                                for k in folds if k not in (fold, val_fold)])
             self.dataset_val = dataset_info.creator(data_path,
-                                                      "valid",
-                                                      fold,
+                                                      "test",
+                                                      val_fold,
                                                       transforms[1],
                                                       target_transform=target_transforms[1])
             self.dataset_test = dataset_info.creator(data_path,
@@ -196,6 +375,56 @@ class DownstreamDataModule(LightningDataModule):
     def prepare_data(self):
         pass
 
+    def clip_frames(self, dataset, split):
+        lengths = load_length_manifest(dataset,
+                                       os.path.join(self.length_manifest_dir,
+                                                    "{}_{}{}.npz".format(self.dataset_name, split, self.manifest_suffix)))
+        return np.minimum(lengths, self.max_clip_frames)
+
+    def bucketed_dataloader(self, dataset, split, shuffle):
+        sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+        # kept on the dataset as well, for the sampler lightning re-creates in predict
+        dataset.clip_frames = self.clip_frames(dataset, split)
+        return data.DataLoader(dataset,
+                               batch_sampler=LengthBucketBatchSampler(sampler,
+                                                                      self.batch_size,
+                                                                      False,
+                                                                      dataset.clip_frames,
+                                                                      self.bucket_batches,
+                                                                      shuffle=shuffle),
+                               num_workers=self.num_workers,
+                               collate_fn=self.collate_fn,
+                               pin_memory=True)
+
+    def token_budget_batch_sampler(self, dataset, split, shuffle):
+        return TokenBudgetBatchSampler(self.clip_frames(dataset, split),
+                                       self.max_tokens,
+                                       self.max_batch_size,
+                                       shuffle=shuffle)
+
+    def token_budget_dataloader(self, dataset, split, shuffle):
+        batch_sampler = self.token_budget_batch_sampler(dataset, split, shuffle)
+        if dist.is_available() and dist.is_initialized():
+            # same batch order on every rank, batches are dealt out round robin
+            sampler = DistributedSamplerWrapper(batch_sampler, range(len(batch_sampler)), shuffle=shuffle)
+        else:
+            sampler = batch_sampler
+        # every item is a whole collated batch; the sampler is already
+        # distributed, so lightning does not replace it
+        return data.DataLoader(BatchedDataset(dataset, self.collate_fn),
+                               batch_size=None,
+                               sampler=sampler,
+                               num_workers=self.num_workers,
+                               collate_fn=identity_collate,
+                               pin_memory=True)
+
+    def steps_per_epoch(self, nproc):
+        """training steps per epoch on each of `nproc` processes"""
+        if self.max_tokens is not None:
+            n_batches = len(self.token_budget_batch_sampler(self.dataset_train, "train", False))
+            return -(-n_batches // nproc)
+        return len(self.dataset_train)//self.batch_size//nproc+1
+
     def train_dataloader(self):
         # Add dataloader for ConcatDataset
         if self.dataset_name == "dcase" :
@@ -228,6 +457,10 @@ class DownstreamDataModule(LightningDataModule):
                 )
 
 
+        elif self.max_tokens is not None:
+            return self.token_budget_dataloader(self.dataset_train, "train", self.shuffle)
+        elif self.length_bucketing:
+            return self.bucketed_dataloader(self.dataset_train, "train", self.shuffle)
         else:
             return data.DataLoader(
                 self.dataset_train,
@@ -241,6 +474,10 @@ class DownstreamDataModule(LightningDataModule):
                 )
                             
     def val_dataloader(self):
+        if self.max_tokens is not None:
+            return self.token_budget_dataloader(self.dataset_val, "valid", False)
+        if self.length_bucketing:
+            return self.bucketed_dataloader(self.dataset_val, "valid", False)
         return data.DataLoader(self.dataset_val,
                         batch_size=self.batch_size,
                         num_workers=self.num_workers,
@@ -250,6 +487,10 @@ class DownstreamDataModule(LightningDataModule):
                         collate_fn=self.collate_fn,
                         pin_memory=True)
     def test_dataloader(self):
+        if self.max_tokens is not None:
+            return self.token_budget_dataloader(self.dataset_test, "test", False)
+        if self.length_bucketing:
+            return self.bucketed_dataloader(self.dataset_test, "test", False)
         return data.DataLoader(self.dataset_test,
                         batch_size=self.batch_size,
                         num_workers=self.num_workers,
@@ -268,4 +509,13 @@ class DownstreamDataModule(LightningDataModule):
         parser.add_argument('--batch_size_per_gpu', default=256, type=int,
             help='Per-GPU batch-size : number of distinct samples loaded on one GPU.')
         parser.add_argument('--num_workers', default=10, type=int, help='Number of data loading workers per GPU.')
+        parser.add_argument('--length_bucketing', action="store_true",
+            help='batch clips of similar length to reduce padding, lengths come from a precomputed manifest')
+        parser.add_argument('--length_manifest_dir', default=None, type=str,
+            help='directory of the length manifests, default <data_path>/length_manifests')
+        parser.add_argument('--bucket_batches', default=100, type=int, help='number of batches per length bucket')
+        parser.add_argument('--max_tokens', default=None, type=int,
+            help='dynamic batches of at most this many padded mel frames (clips x longest clip) instead of batch_size_per_gpu clips')
+        parser.add_argument('--max_batch_size', default=None, type=int, help='at most this many clips per dynamic batch')
+        parser.add_argument('--max_clip_len', default=12., type=float, help='clip length (s) the transforms crop to')
         return parent_parser
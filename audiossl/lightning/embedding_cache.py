@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from audiossl.lightning.utils import EmbeddingExtractor
+
+CACHE_VERSION = 1
+
+
+def file_hash(path, chunk_size=1 << 24):
+    """sha1 of the content of a file, e.g. a pretrained checkpoint"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def select_layers(x, layout, layers):
+    """Pick a subset of layers out of stored embeddings.
+
+    Stored rows are the concatenated outputs of all `n_layers` blocks, each
+    block contributing `n_parts` vectors (e.g. cls and avg). `order` tells how
+    the encoder concatenated them:
+        "part_major":  [part0_layer0, part0_layer1, ..., part1_layer0, ...]
+        "layer_major": [layer0_part0, layer0_part1, ..., layer1_part0, ...]
+    The result has the same order the encoder would have produced when asked
+    for `layers` only, so embeddings of the last k layers match an extraction
+    with n_last_blocks=k.
+    """
+    n_layers, n_parts, order = layout["n_layers"], layout["n_parts"], layout["order"]
+    N = x.shape[0]
+    if order == "part_major":
+        x = x.reshape(N, n_parts, n_layers, -1)[:, :, layers]
+    elif order == "layer_major":
+        x = x.reshape(N, n_layers, n_parts, -1)[:, layers]
+    else:
+        raise NotImplementedError("embedding order {} is not supported".format(order))
+    return x.reshape(N, -1)
+
+
+def last_layers(layout, n_last_blocks):
+    n_layers = layout["n_layers"]
+    return list(range(n_layers - n_last_blocks, n_layers))
+
+
+class EmbeddingCache:
+    """Content addressed on-disk store of extracted embeddings.
+
+    Each (split, fold) entry lives in a directory named after the sha1 of its
+    key (checkpoint hash, dataset, split, fold, transform config, chunk length,
+    ...). An entry holds
+
+        embeddings.npy  float16 [N, n_layers*n_parts*dim], read memory-mapped
+        labels.npy      labels in their original dtype
+        meta.json       key and layout, written last; marks the entry complete
+
+    Embeddings of all layers are stored, so any layer subset can be probed
+    without re-extraction (see `select_layers`).
+
+    Example::
+
+            cache = EmbeddingCache(root, ckpt_hash=file_hash(ckpt), dataset_name="spcv2", chunk_len=601)
+            if not cache.exists("train"):
+                cache.write("train", x, y, layout)
+            x, y = cache.read("train", n_last_blocks=1)
+    """
+    def __init__(self, root, **key):
+        self.root = root
+        self.key = dict(key, version=CACHE_VERSION)
+
+    def entry_key(self, split, fold=None):
+        return dict(self.key, split=split, fold=fold)
+
+    def path(self, split, fold=None):
+        key = json.dumps(self.entry_key(split, fold), sort_keys=True, default=str)
+        return os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest())
+
+    def exists(self, split, fold=None):
+        return os.path.exists(os.path.join(self.path(split, fold), "meta.json"))
+
+    def layout(self, split, fold=None):
+        with open(os.path.join(self.path(split, fold), "meta.json")) as f:
+            return json.load(f)["layout"]
+
+    def write(self, split, x, y, layout, fold=None):
+        tmp_path = self.path(split, fold) + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        emb = np.lib.format.open_memmap(os.path.join(tmp_path, "embeddings.npy"),
+                                        mode="w+", dtype=np.float16, shape=tuple(x.shape))
+        emb[:] = x.detach().cpu().to(torch.float16).numpy()
+        emb.flush()
+        del emb
+        np.save(os.path.join(tmp_path, "labels.npy"), y.detach().cpu().numpy())
+        self.commit(split, layout, fold)
+
+    def commit(self, split, layout, fold=None):
+        """Publish the embeddings.npy / labels.npy written to `path(...) + ".tmp"`"""
+        path = self.path(split, fold)
+        tmp_path = path + ".tmp"
+        shape = np.load(os.path.join(tmp_path, "embeddings.npy"), mmap_mode="r").shape
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"key": self.entry_key(split, fold),
+                       "layout": layout,
+                       "shape": list(shape)}, f, default=str)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def read(self, split, n_last_blocks=None, layers=None, fold=None):
+        """Return (x, y) as float16 / label tensors for the requested layers.
+        Either `n_last_blocks` or an explicit list of `layers` can be given,
+        by default all layers are returned. All layers are a (copy-on-write)
+        memory map of the entry, a subset is copied in float16; batches are
+        converted to float32 by TensorBatchLoader."""
+        path = self.path(split, fold)
+        layout = self.layout(split, fold)
+        if layers is None:
+            layers = last_layers(layout, n_last_blocks or layout["n_layers"])
+        x = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="c")
+        if list(layers) != list(range(layout["n_layers"])):
+            x = select_layers(x, layout, layers)
+        x = torch.from_numpy(x)
+        y = torch.from_numpy(np.load(os.path.join(path, "labels.npy")))
+        return x, y
+
+
+def extract_split_cached(cache, pretrained_module, split, dataloader, nproc, n_last_blocks, fold=None,
+                         accelerator="gpu", num_threads=None):
+    """Embeddings of one split, extracted with all blocks of the encoder and
+    streamed to `cache` if missing (from all ddp ranks, in dataset order), then
+    read back for the last `n_last_blocks` layers, in float16."""
+    if not cache.exists(split, fold):
+        layout = pretrained_module.embedding_layout
+        n_blocks = pretrained_module.n_blocks
+        pretrained_module.n_blocks = layout["n_layers"]
+        extracter = EmbeddingExtractor(pretrained_module, nproc=nproc,
+                                       accelerator=accelerator, num_threads=num_threads)
+        extracter.extract_to(dataloader,
+                             cache.path(split, fold) + ".tmp",
+                             dtype=np.float16,
+                             finalize=lambda path: cache.commit(split, layout, fold))
+        print("cached {} embeddings to {}".format(split, cache.path(split, fold)))
+        pretrained_module.n_blocks = n_blocks
+    return cache.read(split, n_last_blocks=n_last_blocks, fold=fold)
+
+
+def extract_embedding_cached(cache, pretrained_module, data, nproc, n_last_blocks, fold=None,
+                             accelerator="gpu", num_threads=None):
+    """Drop-in for `extract_embedding` of the train_freeze scripts.
+
+    Splits missing from `cache` are extracted once with all blocks of the
+    encoder (layout given by `pretrained_module.embedding_layout`) and written
+    to disk; the last `n_last_blocks` layers are then read back.
+    Returns x_train, y_train, x_val, y_val, x_test, y_test.
+    """
+    splits = {"train": data.train_dataloader,
+              "valid": data.val_dataloader,
+              "test": data.test_dataloader}
+    output = []
+    for split, dataloader in splits.items():
+        # dataloaders are only built for splits missing from the cache
+        if cache.exists(split, fold):
+            output.extend(cache.read(split, n_last_blocks=n_last_blocks, fold=fold))
+        else:
+            output.extend(extract_split_cached(cache, pretrained_module, split, dataloader(),
+                                               nproc, n_last_blocks, fold,
+                                               accelerator, num_threads))
+    return tuple(output)
@@ -0,0 +1,257 @@
+import os
+import zipfile
+from datetime import timedelta
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torchaudio
+from torch.utils.data import BatchSampler, ConcatDataset, Dataset, Sampler
+
+# mel frames of the downstream transforms
+SAMPLE_RATE = 16000
+HOP_LENGTH = 160
+# bumped when the lengths stored in the manifests change meaning, or the
+# clips of a split change (2: fold splits hold out a validation fold)
+MANIFEST_VERSION = 2
+MANIFEST_TIMEOUT = timedelta(hours=6)
+
+
+def _clip_files(dataset):
+    """audio files of a dataset in index order, None if it does not list them"""
+    if hasattr(dataset, "file_names") and hasattr(dataset, "path"):
+        # Urbansound8k, Nsynth
+        return [os.path.join(dataset.path, f) for f in dataset.file_names]
+    if hasattr(dataset, "usage_list") and hasattr(dataset, "dataset"):
+        # SpeakerClassifiDataset
+        return list(dataset.dataset)
+    if hasattr(dataset, "meta_data") and hasattr(dataset, "data_dir"):
+        # IEMOCAPDataset
+        return [os.path.join(dataset.data_dir, m["path"]) for m in dataset.meta_data]
+    return None
+
+
+def num_mel_frames(num_samples, sample_rate=SAMPLE_RATE):
+    return int(num_samples * SAMPLE_RATE / sample_rate) // HOP_LENGTH + 1
+
+
+def clip_lengths(dataset):
+    """Length of every clip of `dataset` in mel frames, read from the file
+    headers when the dataset lists its audio files. Datasets that do not
+    (LMDB, DCASE, ...) are decoded and transformed item by item instead, a
+    full pass over the data the first time their manifest is built."""
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([clip_lengths(d) for d in dataset.datasets])
+    files = _clip_files(dataset)
+    if files is not None:
+        lengths = []
+        for f in files:
+            info = torchaudio.info(f)
+            lengths.append(num_mel_frames(info.num_frames, info.sample_rate))
+        return np.array(lengths, dtype=np.int64)
+    lengths = []
+    for i in range(len(dataset)):
+        x = dataset[i][0]
+        # downstream transforms return (spec, length), otherwise a waveform
+        lengths.append(int(x[1]) if isinstance(x, (tuple, list)) else num_mel_frames(x.shape[-1]))
+    return np.array(lengths, dtype=np.int64)
+
+
+def _is_rank_zero():
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def _manifest_matches(manifest, dataset):
+    return (manifest.get("version") == MANIFEST_VERSION and
+            manifest.get("units") == "mel_frames" and
+            manifest.get("sample_rate") == SAMPLE_RATE and
+            manifest.get("hop_length") == HOP_LENGTH and
+            len(manifest["lengths"]) == len(dataset))
+
+
+def _read_manifest(dataset, path):
+    """lengths of the manifest at `path`, None if it is missing, unreadable
+    (e.g. partially written) or does not match `dataset`"""
+    if not os.path.exists(path):
+        return None
+    manifest = {}
+    try:
+        f = np.load(path)
+        # a bare array is a manifest of an earlier version, without units
+        if isinstance(f, np.lib.npyio.NpzFile):
+            with f:
+                manifest = {k: f[k].item() if f[k].ndim == 0 else f[k] for k in f.files}
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        pass
+    if "lengths" in manifest and _manifest_matches(manifest, dataset):
+        return manifest["lengths"]
+    print("length manifest {} does not match the dataset, rebuilding".format(path))
+    return None
+
+
+def load_length_manifest(dataset, path):
+    """Clip lengths of `dataset` in mel frames, computed once and stored at
+    `path` (.npz) with their units and the manifest version. A manifest that
+    can not be read, or of other units, version or dataset size is rebuilt.
+
+    Under ddp every rank must call it: rank 0 builds the manifest and
+    publishes it with an atomic rename, the other ranks wait and read it."""
+    distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+    if distributed:
+        # building can take a full pass over the data, longer than the default timeout
+        group = dist.new_group(backend="gloo", timeout=MANIFEST_TIMEOUT)
+    if _is_rank_zero():
+        lengths = _read_manifest(dataset, path)
+        if lengths is None:
+            print("building length manifest {}".format(path))
+            lengths = clip_lengths(dataset)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # through a file object, np.savez would otherwise append .npz to the path
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, lengths=lengths, units="mel_frames", sample_rate=SAMPLE_RATE,
+                         hop_length=HOP_LENGTH, version=MANIFEST_VERSION)
+            os.replace(path + ".tmp", path)
+    if distributed:
+        dist.barrier(group=group)
+        dist.destroy_process_group(group)
+        if not _is_rank_zero():
+            lengths = _read_manifest(dataset, path)
+            assert lengths is not None, "length manifest {} was not written by rank 0".format(path)
+    return lengths
+
+
+def padding_ratio(batches, lengths):
+    """fraction of a padded batch tensor that is padding"""
+    total = 0
+    real = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        total += batch_lengths.max() * len(batch)
+        real += batch_lengths.sum()
+    return 1 - real / max(total, 1)
+
+
+class LengthBucketBatchSampler(BatchSampler):
+    """Batches of clips with similar lengths, to cut the padding added by collate_fn.
+
+    The indices drawn from `sampler` (RandomSampler, or the DistributedSampler
+    lightning injects under ddp, so every rank buckets its own shard) are cut
+    into buckets of `bucket_batches` batches, each bucket is sorted by length
+    and split into batches. Bucket contents are random through `sampler`, and
+    with `shuffle` the order of the batches across buckets is shuffled as well.
+    The padding ratio with and without bucketing is printed by rank 0 for the
+    first epoch. Without `lengths` the `clip_frames` of the sampler's dataset
+    are used, so lightning can re-create the sampler from (sampler,
+    batch_size, drop_last) when it wraps it for predict.
+
+    Example::
+
+            lengths = load_length_manifest(dataset, "manifests/voxceleb1_train.npz")
+            batch_sampler = LengthBucketBatchSampler(RandomSampler(dataset), 64, False, lengths)
+            dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+    """
+    def __init__(self, sampler, batch_size, drop_last, lengths=None, bucket_batches=100, shuffle=True, seed=0):
+        super().__init__(sampler, batch_size, drop_last)
+        if lengths is None:
+            # lightning re-creates the sampler as cls(sampler, batch_size=..., drop_last=...)
+            # when it did not capture the arguments (predict outside of a hook)
+            dataset = getattr(sampler, "dataset", getattr(sampler, "data_source", None))
+            lengths = getattr(dataset, "clip_frames", None)
+            if lengths is None:
+                raise ValueError("no clip lengths given, and the dataset of the sampler has no clip_frames")
+        self.lengths = np.asarray(lengths)
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        indices = np.fromiter(iter(self.sampler), dtype=np.int64)
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = indices[start:start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        # bucket sizes are multiples of batch_size, only the last batch can be short
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in order]
+        if self.epoch == 0 and _is_rank_zero():
+            plain = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+            print("LengthBucketBatchSampler: padding ratio {:.3f} -> {:.3f}".format(
+                padding_ratio(plain, self.lengths), padding_ratio(batches, self.lengths)))
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Dynamic batches holding at most `max_tokens` padded mel frames each
+    (longest clip of the batch x number of clips), optionally at most
+    `max_batch_size` clips. A clip longer than the budget gets its own batch.
+
+    The batches are packed once from the clips sorted by length, every epoch
+    only their order is shuffled with `generator`. Wrapped in
+    DistributedSamplerWrapper (which seeds `generator` with seed + epoch) all
+    ranks draw the same order and take the same number of steps; use it as
+    the sampler of a DataLoader over `BatchedDataset` with batch_size=None.
+    """
+    def __init__(self, lengths, max_tokens, max_batch_size=None, shuffle=True):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.generator = None
+        batches = []
+        batch = []
+        batch_max = 0
+        for i in np.argsort(self.lengths, kind="stable"):
+            new_max = max(batch_max, self.lengths[i])
+            if len(batch) > 0 and (new_max * (len(batch) + 1) > max_tokens or
+                                   (max_batch_size is not None and len(batch) >= max_batch_size)):
+                batches.append(batch)
+                batch = []
+                new_max = self.lengths[i]
+            batch.append(int(i))
+            batch_max = new_max
+        if len(batch) > 0:
+            batches.append(batch)
+        self.batches = batches
+        if _is_rank_zero():
+            sizes = np.array([len(b) for b in batches])
+            print("TokenBudgetBatchSampler: {} clips in {} batches of {}-{} clips (mean {:.1f}), padding ratio {:.3f}".format(
+                len(self.lengths), len(batches), sizes.min(), sizes.max(), sizes.mean(),
+                padding_ratio([np.array(b) for b in batches], self.lengths)))
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.batches), generator=self.generator).tolist()
+        else:
+            order = range(len(self.batches))
+        for i in order:
+            yield self.batches[i]
+
+
+class BatchedDataset(Dataset):
+    """Dataset whose items are whole batches: a list of indices of `dataset`
+    is loaded and collated in the worker."""
+    def __init__(self, dataset, collate_fn):
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+
+    def __getitem__(self, batch):
+        return self.collate_fn([self.dataset[i] for i in batch])
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def identity_collate(batch):
+    return batch
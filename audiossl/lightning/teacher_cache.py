@@ -0,0 +1,180 @@
+import contextlib
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+import torch
+from pytorch_lightning import LightningModule
+from torch.utils import data
+from torch.utils.data import ConcatDataset
+from audiossl.lightning.utils import EmbeddingExtractor
+
+
+def cache_key(key):
+    """lmdb keys are bytes, file names str"""
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+
+def dataset_keys(dataset):
+    """Key of every clip of `dataset` in index order: the lmdb key of
+    LMDBDataset, the file name of StronglyAnnotatedSet based datasets"""
+    if isinstance(dataset, ConcatDataset):
+        return [k for d in dataset.datasets for k in dataset_keys(d)]
+    if hasattr(dataset, "keys") and hasattr(dataset, "txn"):
+        # LMDBDataset
+        return [cache_key(k) for k in dataset.keys[:len(dataset)]]
+    if hasattr(dataset, "examples") and hasattr(dataset, "examples_list"):
+        # StronglyAnnotatedSet
+        return [cache_key(dataset.examples[k]["mixture"]) for k in dataset.examples_list]
+    if hasattr(dataset, "dataset"):
+        # TransformDataset
+        return dataset_keys(dataset.dataset)
+    raise TypeError("can not list the keys of {}".format(type(dataset).__name__))
+
+
+@contextlib.contextmanager
+def seeded(seed):
+    """Run a block with python, numpy and torch seeded by `seed`, the global
+    random states are restored afterwards"""
+    states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+
+
+def view_seed(key, view):
+    return int(hashlib.sha1("{}/{}".format(key, view).encode()).hexdigest()[:8], 16)
+
+
+def load_view(dataset, index, key, view, augment=None):
+    """Item `index` of `dataset` as seen in view `view`: the random crop of the
+    dataset transform and, for view > 0, `augment` applied to the
+    spectrogram are seeded from (key, view), so the same view is reproduced
+    whenever it is loaded."""
+    with seeded(view_seed(key, view)):
+        item = list(dataset[index])
+        if view > 0 and augment is not None:
+            x = item[0]
+            item[0] = (augment(x[0]),) + tuple(x[1:]) if isinstance(x, (tuple, list)) else augment(x)
+    return tuple(item)
+
+
+class TeacherViewDataset(data.Dataset):
+    def __init__(self, dataset, keys, view, augment=None):
+        self.dataset = dataset
+        self.keys = keys
+        self.view = view
+        self.augment = augment
+
+    def __getitem__(self, index):
+        return load_view(self.dataset, index, self.keys[index], self.view, self.augment)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class TeacherPredictor(LightningModule):
+    """predict_step returning the teacher output for EmbeddingExtractor.
+    `teacher` takes ((x, length), y) and returns its predictions, or a tuple
+    starting with them."""
+    def __init__(self, teacher):
+        super().__init__()
+        self.teacher = teacher
+
+    def predict_step(self, batch, batch_idx, dataloader_idx=0):
+        pred = self.teacher((batch[0], batch[1]))
+        if isinstance(pred, (tuple, list)):
+            pred = pred[0]
+        # labels are not stored, only a one byte placeholder per row
+        return pred, torch.ones(pred.shape[0], dtype=torch.uint8)
+
+
+class TeacherCache:
+    """Predictions of a frozen distillation teacher, computed once per clip
+    and read back by key (lmdb key or file name) instead of running the
+    teacher every training step.
+
+        keys.json                clip keys in row order
+        view{k}/embeddings.npy   float16 teacher outputs for view k of every clip,
+                                 view 0 un-augmented, views > 0 seeded
+                                 augmentations (see `load_view`)
+        meta.json                number of clips and views, written last
+
+    The directory belongs to one teacher and one training set, delete it when
+    either changes.
+
+    Example::
+
+            cache = TeacherCache(root)
+            if not cache.exists():
+                cache.build(teacher, dataset, num_views=3, augment=RandomResizeCrop())
+            target = cache.get(keys, view=0)
+    """
+    def __init__(self, root):
+        self.root = root
+        self.index = None
+        self.views = None
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.root, "meta.json"))
+
+    def build(self, teacher, dataset, num_views=1, augment=None, collate_fn=None,
+              batch_size=64, num_workers=8, nproc=1):
+        """Run `teacher` over `num_views` views of every clip of `dataset` on
+        `nproc` gpus"""
+        keys = dataset_keys(dataset)
+        assert len(set(keys)) == len(keys), "clip keys are not unique"
+        extractor = EmbeddingExtractor(TeacherPredictor(teacher), nproc=nproc)
+
+        def finalize(path):
+            with open(os.path.join(self.root, "keys.json"), "w") as f:
+                json.dump(keys, f)
+            with open(os.path.join(self.root, "meta.json"), "w") as f:
+                json.dump({"num_clips": len(keys), "num_views": num_views}, f)
+
+        for view in range(num_views):
+            dataloader = data.DataLoader(TeacherViewDataset(dataset, keys, view, augment),
+                                         batch_size=batch_size,
+                                         num_workers=num_workers,
+                                         shuffle=False,
+                                         drop_last=False,
+                                         collate_fn=collate_fn)
+            extractor.extract_to(dataloader,
+                                 os.path.join(self.root, "view{}".format(view)),
+                                 dtype=np.float16,
+                                 finalize=finalize if view == num_views - 1 else None)
+            print("cached teacher predictions of view {} to {}".format(view, self.root))
+
+    @property
+    def num_views(self):
+        self._open()
+        return len(self.views)
+
+    def _open(self):
+        if self.views is not None:
+            return
+        with open(os.path.join(self.root, "meta.json")) as f:
+            meta = json.load(f)
+        with open(os.path.join(self.root, "keys.json")) as f:
+            self.index = {k: i for i, k in enumerate(json.load(f))}
+        self.views = [np.load(os.path.join(self.root, "view{}".format(v), "embeddings.npy"), mmap_mode="r")
+                      for v in range(meta["num_views"])]
+
+    def get(self, keys, view=0):
+        """float32 teacher outputs of view `view` for a list of clip keys"""
+        self._open()
+        rows = []
+        for k in keys:
+            k = cache_key(k)
+            if k not in self.index:
+                raise KeyError("{} is missing from the teacher cache {}".format(k, self.root))
+            rows.append(self.index[k])
+        return torch.from_numpy(np.asarray(self.views[view][rows], dtype=np.float32))
@@ -1,26 +1,247 @@
 from tkinter import W
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+import numpy as np
+import torch
+import torch.distributed as dist
 import pytorch_lightning
 
 
 from pytorch_lightning import Trainer
 from pytorch_lightning import LightningDataModule,LightningModule
+from pytorch_lightning.callbacks import BasePredictionWriter, Callback
+
+# ranks wait for rank 0 to merge the shards, which takes far longer than the
+# default collective timeout on AudioSet sized outputs
+MERGE_TIMEOUT = timedelta(hours=6)
+
+
+class ShardedEmbeddingWriter(BasePredictionWriter):
+    """Streams the (x, y) predictions of every rank to raw shard files under
+    `path`, together with the dataset indices of the rows, so host memory stays
+    constant whatever the dataset size:
+
+        shard{rank}.x.bin    rows of x in `dtype`
+        shard{rank}.y.bin    rows of y in their own dtype
+        shard{rank}.idx.bin  int64 dataset index of every row
+        shard{rank}.json     row shapes and dtypes, written when predict ends
+
+    `merge_shards` turns them into one store ordered by dataset index.
+    """
+    def __init__(self, path, dtype=np.float16):
+        super().__init__(write_interval="batch")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.files = None
+        self.meta = None
+
+    def setup(self, trainer, pl_module, stage):
+        if trainer.is_global_zero:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+        trainer.strategy.barrier()
+        self.rank = trainer.global_rank
+        prefix = os.path.join(self.path, "shard{}".format(self.rank))
+        self.files = {k: open("{}.{}.bin".format(prefix, k), "wb") for k in ["x", "y", "idx"]}
+        self.meta = None
+
+    def write_on_batch_end(self, trainer, pl_module, prediction, batch_indices, batch, batch_idx, dataloader_idx):
+        x, y = prediction
+        x = x.detach().float().cpu().numpy().astype(self.dtype)
+        y = y.detach().cpu().numpy()
+        if len(batch_indices) != x.shape[0]:
+            # lightning passes [] when it can not wrap the batch sampler
+            raise RuntimeError("the dataset indices of predict batch {} are not known, "
+                               "the rows can not be put back in dataset order".format(batch_idx))
+        if self.meta is None:
+            self.meta = {"x_shape": list(x.shape[1:]), "x_dtype": x.dtype.str,
+                         "y_shape": list(y.shape[1:]), "y_dtype": y.dtype.str,
+                         "rows": 0}
+        self.meta["rows"] += x.shape[0]
+        self.files["x"].write(np.ascontiguousarray(x).tobytes())
+        self.files["y"].write(np.ascontiguousarray(y).tobytes())
+        self.files["idx"].write(np.asarray(batch_indices, dtype=np.int64).tobytes())
+
+    def on_predict_end(self, trainer, pl_module):
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.path, "shard{}.json".format(self.rank)), "w") as f:
+            json.dump(self.meta, f)
+
+
+def merge_shards(path, num_rows, chunk_rows=4096):
+    """Merge the shards of ShardedEmbeddingWriter into path/embeddings.npy and
+    path/labels.npy ordered by dataset index, chunk by chunk. Rows duplicated by
+    DistributedSampler padding are written twice to the same place. The shard
+    files are removed afterwards."""
+    shards = sorted(f[:-len(".json")] for f in os.listdir(path) if f.startswith("shard") and f.endswith(".json"))
+    metas = []
+    for shard in shards:
+        with open(os.path.join(path, shard + ".json")) as f:
+            metas.append(json.load(f))
+    metas = [(s, m) for s, m in zip(shards, metas) if m is not None]
+    assert len(metas) > 0, "no predictions were written to {}".format(path)
+    meta = metas[0][1]
+    x_out = np.lib.format.open_memmap(os.path.join(path, "embeddings.npy"), mode="w+",
+                                      dtype=np.dtype(meta["x_dtype"]), shape=(num_rows, *meta["x_shape"]))
+    y_out = np.lib.format.open_memmap(os.path.join(path, "labels.npy"), mode="w+",
+                                      dtype=np.dtype(meta["y_dtype"]), shape=(num_rows, *meta["y_shape"]))
+    written = np.zeros(num_rows, dtype=bool)
+    for shard, m in metas:
+        prefix = os.path.join(path, shard)
+        rows = m["rows"]
+        x = np.memmap(prefix + ".x.bin", dtype=np.dtype(m["x_dtype"]), mode="r", shape=(rows, *m["x_shape"]))
+        y = np.memmap(prefix + ".y.bin", dtype=np.dtype(m["y_dtype"]), mode="r", shape=(rows, *m["y_shape"]))
+        idx = np.fromfile(prefix + ".idx.bin", dtype=np.int64)
+        assert idx.shape[0] == rows
+        for start in range(0, rows, chunk_rows):
+            index = idx[start:start + chunk_rows]
+            x_out[index] = x[start:start + chunk_rows]
+            y_out[index] = y[start:start + chunk_rows]
+            written[index] = True
+        del x, y
+    assert written.all(), "{} of {} rows are missing from the shards".format((~written).sum(), num_rows)
+    x_out.flush()
+    y_out.flush()
+    del x_out, y_out
+    for shard in shards:
+        for suffix in [".x.bin", ".y.bin", ".idx.bin", ".json"]:
+            os.remove(os.path.join(path, shard + suffix))
+
+
+class IntraOpThreads(Callback):
+    """Limit the intra-op threads of every process, so that N cpu workers on
+    one machine do not oversubscribe its cores"""
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+
+    def setup(self, trainer, pl_module, stage):
+        torch.set_num_threads(self.num_threads)
+
+
+def concat_predictions(result):
+    """x, y of `EmbeddingExtractor.extract`, concatenated over batches. The
+    single memory-mapped batch of the cpu backend is returned without a copy."""
+    return [r[0] if len(r) == 1 else torch.cat(r, dim=0) for r in zip(*result)]
+
 
 class EmbeddingExtractor:
+    """Runs `module.predict_step` over a dataloader with `nproc` processes.
+
+    accelerator="gpu": one ddp process per gpu.
+    accelerator="cpu": `nproc` ddp (gloo) worker processes sharding the
+    dataset, each with `num_threads` intra-op threads (default: cores/nproc).
+    Their predictions go through the on-disk format of `extract_to` so they
+    come back complete and in dataset order.
+    """
     def __init__(self,
                  module:LightningModule,
-                 nproc:int=1
+                 nproc:int=1,
+                 accelerator:str="gpu",
+                 num_threads:int=None
                 ):
-        self.trainer = Trainer(
+        self.nproc = nproc
+        self.accelerator = accelerator
+        if accelerator == "cpu" and not num_threads:
+            num_threads = max(1, (os.cpu_count() or 1) // nproc)
+        self.num_threads = num_threads
+        self.trainer = self._trainer()
+        self.module = module
+
+    def _trainer(self, callbacks=None):
+        callbacks = list(callbacks or [])
+        if self.num_threads:
+            callbacks.append(IntraOpThreads(self.num_threads))
+        if self.accelerator == "cpu":
+            return Trainer(
+                            strategy="ddp" if self.nproc > 1 else "auto",
+                            logger=False,
+                            accelerator="cpu",
+                            devices=self.nproc,
+                            callbacks=callbacks,
+                            )
+        return Trainer(
                             strategy="ddp_find_unused_parameters_false",
                             sync_batchnorm=True,
                             logger=False,
                             accelerator="gpu",
-                            devices=nproc,
+                            devices=self.nproc,
+                            callbacks=callbacks,
                             #profiler="simple",
                             #max_epochs=1,
                             )
-        self.module = module
     def extract(self,dataloader):
+        if self.accelerator == "cpu":
+            return [self._extract_cpu(dataloader)]
         return self.trainer.predict(self.module,dataloader)
 
+    def _extract_cpu(self, dataloader):
+        """x, y of the cpu workers, memory-mapped from a scratch directory that
+        is removed before returning"""
+        # the scratch root is shared with the ddp workers through the
+        # environment they inherit, the process creating it removes it at exit
+        root = os.environ.get("AUDIOSSL_EXTRACT_DIR")
+        if root is None:
+            root = tempfile.mkdtemp(prefix="audiossl_extract_")
+            os.environ["AUDIOSSL_EXTRACT_DIR"] = root
+            atexit.register(shutil.rmtree, root, True)
+        path = os.path.join(root, "predictions")
+        trainer = None
+        try:
+            trainer = self.extract_to(dataloader, path, dtype=np.float32)
+            # copy-on-write maps: writable tensors, read lazily, whose pages
+            # stay valid once the files are unlinked
+            x = torch.from_numpy(np.load(os.path.join(path, "embeddings.npy"), mmap_mode="c"))
+            y = torch.from_numpy(np.load(os.path.join(path, "labels.npy"), mmap_mode="c"))
+            trainer.strategy.barrier()
+        finally:
+            if trainer is None or trainer.is_global_zero:
+                shutil.rmtree(path, ignore_errors=True)
+        return x, y
+
+    def extract_to(self, dataloader, path, dtype=np.float16, finalize=None):
+        """Stream the predictions of all ranks to `path` and merge them into
+        embeddings.npy / labels.npy in dataset order (see ShardedEmbeddingWriter),
+        nothing is accumulated in memory. `finalize(path)` is then called on
+        rank 0 before the ranks are synchronized. Returns the trainer.
+
+        The dataset indices of the rows are tracked through the batch sampler,
+        dataloaders without one (e.g. token budget batches) are rejected."""
+        if dataloader.batch_sampler is None:
+            raise ValueError("extraction needs a dataloader with a batch sampler, so the dataset "
+                             "indices of every row are known; got batch_size=None")
+        writer = ShardedEmbeddingWriter(path, dtype)
+        trainer = self._trainer(callbacks=[writer])
+        start = time.time()
+        trainer.predict(self.module, dataloader, return_predictions=False)
+        trainer.strategy.barrier()
+        group = merge_group(trainer)
+        if trainer.is_global_zero:
+            n_clips = len(dataloader.dataset)
+            elapsed = time.time() - start
+            print("extracted {} clips in {:.1f}s ({:.1f} clips/s, {} {} processes{})".format(
+                n_clips, elapsed, n_clips / elapsed, self.nproc, self.accelerator,
+                ", {} threads each".format(self.num_threads) if self.num_threads else ""))
+            merge_shards(path, n_clips)
+            if finalize is not None:
+                finalize(path)
+        if group is None:
+            trainer.strategy.barrier()
+        else:
+            dist.barrier(group=group)
+            dist.destroy_process_group(group)
+        return trainer
+
 
+def merge_group(trainer):
+    """gloo group of all ranks whose collectives time out after MERGE_TIMEOUT,
+    None when not distributed. Created by all ranks before rank 0 merges."""
+    if not (dist.is_available() and dist.is_initialized() and trainer.world_size > 1):
+        return None
+    return dist.new_group(backend="gloo", timeout=MERGE_TIMEOUT)
@@ -1,12 +1,14 @@
 from email.mime import audio
 from pytorch_lightning import LightningModule
-from audiossl.modules.head import LinearHead
+from audiossl.modules.head import LinearHead,MultiLinearHead
 from audiossl.models.atst import audio_transformer
 import torch
 from torch import nn
 from torch.nn import functional as F
 from audiossl.methods.atst.downstream.utils import Metric
 from audiossl.utils.common import cosine_scheduler_epoch,get_params_groups
+from audiossl.lightning.embedding_cache import last_layers,select_layers
+from audiossl.lightning.datamodules import validation_fold
 from itertools import chain
 
 
@@ -20,16 +22,24 @@ class PretrainedEncoderPLModule(LightningModule):
                  pretrained_encoder: audio_transformer.AST,
                  chunk_len: float,
                  n_blocks: int,
-                 avgpool:bool = True):
+                 avgpool:bool = True,
+                 tome_r = 0):
         super().__init__()
         self.encoder = pretrained_encoder
         self.chunk_len = int((chunk_len * 16000)/160 + 1)
         self.n_blocks = n_blocks
         self.avgpool = avgpool
+        # number of tokens merged after each block (ToMe), 0 disables merging
+        self.tome_r = tome_r
         if avgpool:
             self.embed_dim = self.encoder.embed_dim*2*n_blocks
         else:
             self.embed_dim = self.encoder.embed_dim*n_blocks
+        # how get_intermediate_layers_chunks concatenates the outputs of all blocks:
+        # [cls of each block, avg of each block]
+        self.embedding_layout = {"n_layers": len(self.encoder.blocks),
+                                 "n_parts": 2 if avgpool else 1,
+                                 "order": "part_major"}
 
     def forward(self, batch):
         (x, length), y = batch
@@ -37,7 +47,8 @@ class PretrainedEncoderPLModule(LightningModule):
                                                         length,
                                                         self.n_blocks,
                                                         self.chunk_len,
-                                                        avgpool=self.avgpool)
+                                                        avgpool=self.avgpool,
+                                                        tome_r=self.tome_r)
         return x, y
 
 
@@ -126,6 +137,200 @@ class LinearClassifierPLModule(LightningModule):
         parser.add_argument('--max_epochs', default=100, type=int)
         return parent_parser
 
+def build_probe_heads(learning_rates, n_last_blocks, layout, embed_dim, folds=[0], lr_scale=1.):
+    """Heads for MultiLinearClassifierPLModule: one per (learning rate, number of
+    last blocks, fold). `layout` describes the extracted embeddings (see
+    `select_layers`), fold 0 means no cross validation; other folds are
+    validated on their `validation_fold`.
+    Returns the list of head specs and their feature masks."""
+    index = torch.arange(embed_dim).unsqueeze(0)
+    heads = []
+    feature_masks = []
+    for lr in learning_rates:
+        for n in n_last_blocks:
+            assert n <= layout["n_layers"], "only the last {} blocks are extracted".format(layout["n_layers"])
+            mask = torch.zeros(embed_dim)
+            mask[select_layers(index, layout, last_layers(layout, n))] = 1
+            for fold in folds:
+                heads.append({"lr": lr * lr_scale,
+                              "fold": fold,
+                              "val_fold": 0 if fold == 0 else validation_fold(folds, fold),
+                              "config": "lr={},n_last_blocks={}".format(lr, n)})
+                feature_masks.append(mask)
+    return heads, torch.stack(feature_masks)
+
+
+class MultiLinearClassifierPLModule(LightningModule):
+    """Trains K independent linear probes on the same embeddings in one pass.
+
+    heads[k] gives the learning rate of head k, its fold (tested on this one,
+    validated on its val_fold and trained on all other folds; 0 for no folds)
+    and the name of its config. The learning rate is applied by weighting each head's loss,
+    which for momentum SGD without weight decay equals a per-head learning
+    rate under the shared cosine schedule. Each head has its own BatchNorm
+    statistics (averaged over ranks under ddp) and feature mask, and keeps
+    the weights of its best validation epoch. The config with the best mean
+    validation metric over its folds is selected and reported.
+    """
+    def __init__(self,
+                 heads,
+                 max_epochs,
+                 embed_dim,
+                 num_labels,
+                 multi_label=False,
+                 feature_masks=None,
+                 **kwargs):
+        super().__init__()
+        self.max_epochs = max_epochs
+        self.heads = heads
+        self.multi_label = multi_label
+        self.head = MultiLinearHead(embed_dim, num_labels, len(heads), feature_masks)
+        self.register_buffer("head_lr", torch.tensor([h["lr"] for h in heads]))
+        self.register_buffer("head_fold", torch.tensor([h["fold"] for h in heads]))
+        self.register_buffer("head_val_fold", torch.tensor([h.get("val_fold", 0) for h in heads]))
+        self.register_buffer("best_val", torch.full((len(heads),), -float("inf")))
+        self.state_names = ["weight", "bias", "running_mean", "running_var"]
+        for name in self.state_names:
+            self.register_buffer("best_" + name, getattr(self.head, name).detach().clone())
+
+        self.metrics = [Metric(mode="mAP" if multi_label else "ACC") for _ in heads]
+        self.metric = self.metrics[0]
+        self.test_scores = None
+        self.save_hyperparameters(ignore=["feature_masks"])
+
+    def _unpack(self, batch):
+        if len(batch) == 3:
+            x, y, fold_ids = batch
+        else:
+            (x, y), fold_ids = batch, None
+        if self.multi_label == False and y.dim() > 1:
+            y = y.argmax(-1)
+        if fold_ids is None:
+            fold_ids = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+        return x, y, fold_ids
+
+    def _weights(self, fold_ids, stage):
+        """[B, K] mask of the samples each head is trained, validated or tested on"""
+        fold_ids = fold_ids.unsqueeze(1)
+        if stage == "train":
+            w = (fold_ids != self.head_fold.unsqueeze(0)) & (fold_ids != self.head_val_fold.unsqueeze(0))
+        elif stage == "val":
+            w = fold_ids == self.head_val_fold.unsqueeze(0)
+        else:
+            w = fold_ids == self.head_fold.unsqueeze(0)
+        return w | (self.head_fold == 0).unsqueeze(0)
+
+    def _losses(self, logits, y):
+        K, B, C = logits.shape
+        if self.multi_label:
+            return F.binary_cross_entropy_with_logits(logits, y.float().expand(K, B, C), reduction="none").mean(-1)
+        return F.cross_entropy(logits.reshape(K * B, C), y.repeat(K), reduction="none").view(K, B)
+
+    def training_step(self, batch, batch_idx):
+        x, y, fold_ids = self._unpack(batch)
+        w = self._weights(fold_ids, "train").to(x.dtype)
+        logits = self.head(x, w)
+        losses = (self._losses(logits, y) * w.t()).sum(1) / w.sum(0).clamp(min=1)
+        self.log("lr", self.trainer.optimizers[0].param_groups[0]["lr"], prog_bar=True, logger=True)
+        return (losses * self.head_lr).sum()
+
+    def _eval_step(self, batch, stage):
+        x, y, fold_ids = self._unpack(batch)
+        w = self._weights(fold_ids, stage)
+        logits = self.head(x)
+        if self.multi_label:
+            logits = logits.sigmoid()
+        for k, metric in enumerate(self.metrics):
+            metric.update(logits[k][w[:, k]], y[w[:, k]])
+
+    def _compute_metrics(self, stage):
+        # one score per head, logged rather than printed
+        scores = []
+        for metric in self.metrics:
+            scores.append(float(metric.compute(verbose=False)))
+            metric.clear()
+        scores = torch.tensor(scores, device=self.best_val.device)
+        if not self.trainer.sanity_checking:
+            self.log_dict({"{}_{}/head{}".format(stage, self.metric.mode, k): score
+                           for k, score in enumerate(scores)}, logger=True)
+        return scores
+
+    def on_validation_epoch_start(self) -> None:
+        # every rank updated the running stats on its own shard, average them so
+        # all ranks validate (and keep) the same heads
+        with torch.no_grad():
+            for name in ["running_mean", "running_var"]:
+                buf = getattr(self.head, name)
+                buf.copy_(self.trainer.strategy.reduce(buf, reduce_op="mean"))
+
+    def validation_step(self, batch, batch_idx):
+        self._eval_step(batch, "val")
+
+    def on_validation_epoch_end(self) -> None:
+        scores = self._compute_metrics("val")
+        if not self.trainer.sanity_checking:
+            improved = scores > self.best_val
+            self.best_val = torch.where(improved, scores, self.best_val)
+            with torch.no_grad():
+                for name in self.state_names:
+                    getattr(self, "best_" + name)[improved] = getattr(self.head, name)[improved]
+        self.log("val_"+self.metric.mode, scores.max(), prog_bar=True, logger=True)
+
+    def on_test_start(self) -> None:
+        # evaluate every head with the weights of its best validation epoch
+        with torch.no_grad():
+            for name in self.state_names:
+                getattr(self.head, name).copy_(getattr(self, "best_" + name))
+
+    def test_step(self, batch, batch_idx):
+        self._eval_step(batch, "test")
+
+    def on_test_epoch_end(self) -> None:
+        self.test_scores = self._compute_metrics("test").cpu()
+        print(self.summary())
+        self.log("test_"+self.metric.mode, self.test_scores[self.best_heads()].mean(), prog_bar=True, logger=True)
+
+    def best_heads(self):
+        """indices of the heads (one per fold) of the config with the best mean validation metric"""
+        configs = {}
+        for k, h in enumerate(self.heads):
+            configs.setdefault(h["config"], []).append(k)
+        best_val = self.best_val.cpu()
+        best = max(configs.values(), key=lambda ks: best_val[ks].mean().item())
+        return sorted(best, key=lambda k: self.heads[k]["fold"])
+
+    def summary(self):
+        best = self.best_heads()
+        lines = ["{:<40}{:>6}{:>10}{:>10}".format("config", "fold", "val", "test")]
+        for k, h in enumerate(self.heads):
+            lines.append("{:<40}{:>6}{:>10.4f}{:>10.4f}{}".format(
+                h["config"], h["fold"], self.best_val[k].item(),
+                self.test_scores[k].item() if self.test_scores is not None else float("nan"),
+                " *" if k in best else ""))
+        return "\n".join(lines)
+
+    def configure_optimizers(self):
+        # per-head learning rates are applied in training_step, lr here is the schedule factor
+        optimizer = torch.optim.SGD(self.head.parameters(),
+                                    1.,
+                                    momentum=0.9,
+                                    weight_decay=0,
+                                    )
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
+            optimizer, self.max_epochs, eta_min=0)
+        return [optimizer], [{"scheduler": scheduler, "interval": "epoch"} ]
+
+    @staticmethod
+    def add_model_specific_args(parent_parser):
+
+        parser = parent_parser.add_argument_group("MultiLinearClassifierModel")
+        parser.add_argument("--probe_learning_rates", default=None, type=float, nargs="+",
+                            help="train one linear head per learning rate in a single pass and report the best one")
+        parser.add_argument("--probe_n_last_blocks", default=None, type=int, nargs="+",
+                            help="train one linear head per number of last blocks (<= n_last_blocks) in a single pass")
+        return parent_parser
+
+
 def layer_wise_lr_groups(model):
 
     layer_decay = 0.75
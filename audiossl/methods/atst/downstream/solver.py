@@ -0,0 +1,127 @@
+"""Full-batch solvers for linear probes on in-memory embeddings.
+
+Alternatives to the minibatch SGD of LinearClassifierPLModule:
+    ridge:  ridge regression on one-hot / multi-hot targets, solved with a
+            Cholesky factorization for every value of the regularization path
+    lbfgs:  L2 regularized logistic regression (softmax for single label tasks,
+            vectorized one-vs-rest sigmoid for multi label tasks) solved with
+            full-batch L-BFGS, warm started along the regularization path
+
+Embeddings are standardized with the train statistics, like the BatchNorm of
+LinearHead. The regularization strength is selected on the validation split
+and the test split is scored with the same ACC / mAP as Metric.
+"""
+import time
+
+import torch
+from torch.nn import functional as F
+from audiossl.methods.atst.downstream.utils import metric_score
+
+SOLVERS = ["sgd", "ridge", "lbfgs"]
+
+
+def standardize(x_train, *xs, eps=1e-5):
+    mean = x_train.mean(0)
+    std = (x_train.var(0, unbiased=False) + eps).sqrt()
+    return [(x - mean) / std for x in (x_train,) + xs]
+
+
+def ridge_path(x, y, l2s):
+    """Yield (l2, W, b) of ridge regression for every l2, the loss being
+    mean squared error + l2 * |W|^2. The bias is not regularized; x is
+    centered so it is the mean target. Uses the dual (N x N) system when there
+    are fewer samples than features. The system is built and factored in
+    float64; when it is still not positive definite (collinear features and a
+    tiny l2) it is solved with the pseudo-inverse instead of aborting the path."""
+    N, D = x.shape
+    dtype = x.dtype
+    x, y = x.double(), y.double()
+    b = y.mean(0)
+    y = y - b
+    if N >= D:
+        gram = x.t() @ x
+        rhs = x.t() @ y
+    else:
+        gram = x @ x.t()
+        rhs = y
+    eye = torch.eye(gram.shape[0], dtype=gram.dtype, device=gram.device)
+    for l2 in l2s:
+        A = gram + l2 * N * eye
+        L, info = torch.linalg.cholesky_ex(A)
+        if info == 0:
+            W = torch.cholesky_solve(rhs, L)
+        else:
+            print("ridge l2={:g}: system is not positive definite, using the pseudo-inverse".format(l2))
+            W = torch.linalg.pinv(A, hermitian=True) @ rhs
+        if N < D:
+            W = x.t() @ W
+        yield l2, W.to(dtype), b.to(dtype)
+
+
+def logistic_path(x, y, num_labels, multi_label, l2s, max_iter=100):
+    """Yield (l2, W, b) of L2 regularized logistic regression for every l2,
+    from the strongest to the weakest regularization, each solve warm started
+    from the previous one."""
+    D = x.shape[1]
+    W = torch.zeros(D, num_labels, dtype=x.dtype, device=x.device, requires_grad=True)
+    b = torch.zeros(num_labels, dtype=x.dtype, device=x.device, requires_grad=True)
+    for l2 in sorted(l2s, reverse=True):
+        optimizer = torch.optim.LBFGS([W, b],
+                                      lr=1,
+                                      max_iter=max_iter,
+                                      history_size=10,
+                                      line_search_fn="strong_wolfe")
+
+        def closure():
+            optimizer.zero_grad()
+            logits = x @ W + b
+            if multi_label:
+                loss = F.binary_cross_entropy_with_logits(logits, y)
+            else:
+                loss = F.cross_entropy(logits, y)
+            loss = loss + l2 * (W * W).sum()
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        yield l2, W.detach().clone(), b.detach().clone()
+
+
+def fit_linear_probe(solver,
+                     x_train, y_train, x_val, y_val, x_test, y_test,
+                     num_labels,
+                     multi_label,
+                     l2s,
+                     device="cpu",
+                     max_iter=100):
+    """Fit a linear probe with `solver` ("ridge" or "lbfgs") along the
+    regularization path `l2s`, returns the test score of the l2 with the best
+    validation score."""
+    start = time.time()
+    mode = "mAP" if multi_label else "ACC"
+    x_train, x_val, x_test = standardize(*[x.to(device, torch.float32) for x in (x_train, x_val, x_test)])
+    if multi_label:
+        y_train, y_val, y_test = [y.to(device).float() for y in (y_train, y_val, y_test)]
+    else:
+        y_train, y_val, y_test = [(y.argmax(-1) if y.dim() > 1 else y).to(device).long()
+                                  for y in (y_train, y_val, y_test)]
+
+    if solver == "ridge":
+        targets = y_train if multi_label else F.one_hot(y_train, num_labels).to(x_train.dtype)
+        path = ridge_path(x_train, targets, l2s)
+    elif solver == "lbfgs":
+        path = logistic_path(x_train, y_train, num_labels, multi_label, l2s, max_iter)
+    else:
+        raise NotImplementedError("solver {} is not supported".format(solver))
+
+    best = None
+    for l2, W, b in path:
+        score = metric_score(mode, x_val @ W + b, y_val, verbose=False)
+        print("{} l2={:g} val_{}={:.4f}".format(solver, l2, mode, score))
+        if best is None or score > best[1]:
+            best = (l2, score, W, b)
+    l2, val_score, W, b = best
+    test_score = metric_score(mode, x_test @ W + b, y_test)
+    print("{} best l2={:g} val_{}={:.4f} test_{}={:.4f} ({:.1f}s)".format(
+        solver, l2, mode, val_score, mode, test_score, time.time() - start))
+    return torch.tensor(test_score)
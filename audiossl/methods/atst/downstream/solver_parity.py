@@ -0,0 +1,48 @@
+"""Check of the ridge solver on rank-deficient embeddings.
+
+Embeddings whose feature columns are all duplicated are solved along a path
+down to l2=0, with more samples than features (primal system) and with fewer
+(dual system, N larger than the rank). At l2=0 the Cholesky factorization
+fails and the pseudo-inverse is used. The fitted values must match a float64
+pseudo-inverse reference at every l2.
+
+    python solver_parity.py
+"""
+from argparse import ArgumentParser
+
+import torch
+from audiossl.methods.atst.downstream.solver import ridge_path
+
+
+def reference_fit(x, y, l2):
+    x, y = x.double(), y.double()
+    xc, yc = x - x.mean(0), y - y.mean(0)
+    N, D = x.shape
+    W = torch.linalg.pinv(xc.t() @ xc + l2 * N * torch.eye(D, dtype=x.dtype)) @ xc.t() @ yc
+    return xc @ W + y.mean(0)
+
+
+def main():
+    parser = ArgumentParser("solver_parity")
+    parser.add_argument("--dim", type=int, default=32)
+    parser.add_argument("--num_labels", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(args.seed)
+    l2s = [1e-3, 1e-6, 0.]
+    # primal (N >= 2 * dim) and dual (dim < N < 2 * dim) systems
+    for n in [8 * args.dim, args.dim + args.dim // 4]:
+        x = torch.randn(n, args.dim, generator=generator)
+        x = torch.cat([x, x], dim=1)
+        y = torch.randn(n, args.num_labels, generator=generator)
+        xc = x - x.mean(0)
+        for l2, W, b in ridge_path(xc, y, l2s):
+            assert torch.isfinite(W).all(), "ridge l2={:g} is not finite".format(l2)
+            torch.testing.assert_close((xc @ W + b).double(), reference_fit(x, y, l2), atol=1e-3, rtol=1e-3,
+                                       msg="ridge l2={:g} differs from the reference, N={}".format(l2, n))
+        print("N={} D={}: {} l2 values identical".format(n, x.shape[1], len(l2s)))
+
+
+if __name__ == "__main__":
+    main()
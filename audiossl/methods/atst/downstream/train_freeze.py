@@ -1,19 +1,29 @@
 
 import os
+import time
 from argparse import ArgumentParser
 
 import torch
 from audiossl import datasets
 from audiossl.lightning.datamodules import (DownstreamDataModule,
-                                            get_inmemory_datamodule)
-from audiossl.lightning.utils import EmbeddingExtractor
+                                            get_all_folds_dataloader,
+                                            get_inmemory_datamodule,
+                                            get_inmemory_fold_datamodule,
+                                            split_folds)
+from audiossl.lightning.utils import EmbeddingExtractor, concat_predictions
+from audiossl.lightning.embedding_cache import (EmbeddingCache,
+                                                extract_embedding_cached,
+                                                extract_split_cached,
+                                                file_hash)
 from audiossl.methods.atst.model import ATSTLightningModule
 from audiossl.methods.atst.downstream import utils
 from audiossl.methods.atst.downstream.data import collate_fn
 from audiossl.methods.atst.downstream.model import (
-    LinearClassifierPLModule, PretrainedEncoderPLModule)
+    LinearClassifierPLModule, MultiLinearClassifierPLModule,
+    PretrainedEncoderPLModule, build_probe_heads)
 from audiossl.methods.atst.downstream.transform import \
     FreezingTransform
+from audiossl.methods.atst.downstream.solver import SOLVERS, fit_linear_probe
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 from pytorch_lightning.loggers import TensorBoardLogger, WandbLogger
@@ -50,41 +60,149 @@ def get_pretraied_encoder(args):
     return pretrained_encoder
 
 
-def extract_embedding(pretrained_module, data, nproc):
-    extracter=EmbeddingExtractor(pretrained_module,nproc=nproc)
-    result = extracter.extract(data.train_dataloader())
-    result = [r for r in zip(*result)]
-    x_train, y_train = result
-    x_train = torch.cat(x_train, dim=0)
-    y_train = torch.cat(y_train, dim=0)
-
-    result = extracter.extract(data.val_dataloader())
-    result = [r for r in zip(*result)]
-    x_val, y_val = result
-    x_val = torch.cat(x_val, dim=0)
-    y_val = torch.cat(y_val, dim=0)
-
-    result = extracter.extract(data.test_dataloader())
-    result = [r for r in zip(*result)]
-    x_test, y_test = result
-    x_test = torch.cat(x_test, dim=0)
-    y_test = torch.cat(y_test, dim=0)
+def extract_embedding(pretrained_module, data, nproc, accelerator="gpu", num_threads=None):
+    extracter=EmbeddingExtractor(pretrained_module,nproc=nproc,accelerator=accelerator,num_threads=num_threads)
+    start = time.time()
+    x_train, y_train = concat_predictions(extracter.extract(data.train_dataloader()))
+    x_val, y_val = concat_predictions(extracter.extract(data.val_dataloader()))
+    x_test, y_test = concat_predictions(extracter.extract(data.test_dataloader()))
+    elapsed = time.time() - start
+    n_clips = x_train.shape[0] + x_val.shape[0] + x_test.shape[0]
+    print("extracted {} clips in {:.1f}s ({:.1f} clips/s, tome_r={})".format(
+        n_clips, elapsed, n_clips/elapsed, pretrained_module.tome_r))
     return x_train, y_train, x_val, y_val, x_test, y_test
 
 
-def run(args, pretrained_module, fold=None):
+def extract_fold_embedding(args, pretrained_module, transform, cache=None):
+    """Encode every clip of a multi-fold dataset once, returns embeddings,
+    labels and fold ids of all clips; per-fold splits are then assembled with
+    `split_folds`."""
+    dataloader, fold_ids = get_all_folds_dataloader(args.data_path,
+                                                    args.dataset_name,
+                                                    transform,
+                                                    collate_fn,
+                                                    min(64, args.batch_size_per_gpu),
+                                                    args.num_workers)
+    start = time.time()
+    if cache is not None:
+        x, y = extract_split_cached(cache, pretrained_module, "all_folds", dataloader,
+                                    args.nproc, args.n_last_blocks,
+                                    accelerator=args.accelerator, num_threads=args.num_threads)
+    else:
+        extracter = EmbeddingExtractor(pretrained_module, nproc=args.nproc,
+                                       accelerator=args.accelerator, num_threads=args.num_threads)
+        x, y = concat_predictions(extracter.extract(dataloader))
+    elapsed = time.time() - start
+    print("extracted {} clips of {} folds in {:.1f}s ({:.1f} clips/s, tome_r={})".format(
+        x.shape[0], int(fold_ids.max()), elapsed, x.shape[0]/elapsed, pretrained_module.tome_r))
+    assert x.shape[0] == fold_ids.shape[0]
+    return x, y, fold_ids
+
+
+def multi_head(args):
+    return args.solver == "sgd" and (args.probe_learning_rates is not None or args.probe_n_last_blocks is not None)
+
+
+def run_multi_head(args, pretrained_module, embeddings, save_path, fold_ids=None):
+    """train linear heads for all (learning rate, n_last_blocks, fold)
+    combinations in one pass, returns the test scores (one per fold) of the
+    config with the best validation metric"""
+    dict_args = vars(args)
+    x_train, y_train, x_val, y_val, x_test, y_test = embeddings
+    dataset_info = datasets.get_dataset(args.dataset_name)
+    folds = [0] if fold_ids is None else fold_ids.unique().tolist()
+    layout = dict(pretrained_module.embedding_layout, n_layers=args.n_last_blocks)
+    heads, feature_masks = build_probe_heads(args.probe_learning_rates or [args.learning_rate],
+                                             args.probe_n_last_blocks or [args.n_last_blocks],
+                                             layout,
+                                             x_train.shape[1],
+                                             folds,
+                                             lr_scale=args.nproc*args.batch_size_per_gpu/256)
+    if fold_ids is None:
+        inmemory_datamodule = get_inmemory_datamodule(x_train,
+                                                      y_train,
+                                                      x_val,
+                                                      y_val,
+                                                      x_test,
+                                                      y_test,
+                                                      args.batch_size_per_gpu,
+                                                      device=args.inmemory_device)
+    else:
+        inmemory_datamodule = get_inmemory_fold_datamodule(x_train,
+                                                           y_train,
+                                                           fold_ids,
+                                                           args.batch_size_per_gpu,
+                                                           device=args.inmemory_device)
+
+    model = MultiLinearClassifierPLModule(
+        heads=heads,
+        embed_dim=x_train.shape[1],
+        num_labels=dataset_info.num_labels,
+        multi_label=dataset_info.multi_label,
+        feature_masks=feature_masks,
+        **dict_args)
+    logger_tb = TensorBoardLogger(save_path, name="tb_logs")
+    trainer: Trainer = Trainer(
+        strategy="ddp",
+        sync_batchnorm=args.accelerator == "gpu",
+        accelerator=args.accelerator,
+        devices=args.nproc,
+        max_epochs=args.max_epochs,
+        logger=logger_tb,
+        callbacks=[
+            LearningRateMonitor(logging_interval="step"),
+        ],
+    )
+    print("training {} linear heads".format(len(heads)))
+    trainer.fit(model, datamodule=inmemory_datamodule)
+    trainer.test(model, datamodule=inmemory_datamodule)
+    best = model.best_heads()
+    print("best config {}".format(heads[best[0]]["config"]))
+    return model.test_scores[best]
+
+
+def run(args, pretrained_module, fold=None, cache=None, embeddings=None):
     dict_args = vars(args)
 
     """extract embedding"""
-    transform = FreezingTransform()
-    data = DownstreamDataModule(**dict_args,
-                                fold=fold,
-                                collate_fn=collate_fn,
-                                transforms=[transform]*3,
-                                limit_batch_size=min(64,args.batch_size_per_gpu))
-    x_train, y_train, x_val, y_val, x_test, y_test = extract_embedding(pretrained_module,
-                                                                       data,
-                                                                       args.nproc)
+    if embeddings is not None:
+        x_train, y_train, x_val, y_val, x_test, y_test = embeddings
+    else:
+        transform = FreezingTransform()
+        data = DownstreamDataModule(**dict_args,
+                                    fold=fold,
+                                    collate_fn=collate_fn,
+                                    transforms=[transform]*3,
+                                    limit_batch_size=min(64,args.batch_size_per_gpu))
+        if cache is not None:
+            x_train, y_train, x_val, y_val, x_test, y_test = extract_embedding_cached(cache,
+                                                                                  pretrained_module,
+                                                                                  data,
+                                                                                  args.nproc,
+                                                                                  args.n_last_blocks,
+                                                                                  fold,
+                                                                                  args.accelerator,
+                                                                                  args.num_threads)
+        else:
+            x_train, y_train, x_val, y_val, x_test, y_test = extract_embedding(pretrained_module,
+                                                                               data,
+                                                                               args.nproc,
+                                                                               args.accelerator,
+                                                                               args.num_threads)
+
+    if args.solver != "sgd":
+        dataset_info = datasets.get_dataset(args.dataset_name)
+        return fit_linear_probe(args.solver,
+                                x_train, y_train, x_val, y_val, x_test, y_test,
+                                dataset_info.num_labels,
+                                dataset_info.multi_label,
+                                args.solver_l2,
+                                device=args.solver_device)
+    if multi_head(args):
+        save_path = args.save_path if fold is None else os.path.join(args.save_path, "fold{}".format(fold))
+        return run_multi_head(args, pretrained_module,
+                              (x_train, y_train, x_val, y_val, x_test, y_test),
+                              save_path)[0]
 
     """train a linear classifier on extracted embedding"""
     if fold is None or fold == 1:
@@ -98,8 +216,9 @@ def run(args, pretrained_module, fold=None):
     logger_tb = TensorBoardLogger(save_path, name="tb_logs")
     #logger_wb = WandbLogger(save_dir=args.save_path,name="wb_logs")
     embed_dim = x_train.shape[1]
-    num_labels = data.num_labels
-    multi_label = data.multi_label
+    dataset_info = datasets.get_dataset(args.dataset_name)
+    num_labels = dataset_info.num_labels
+    multi_label = dataset_info.multi_label
 
     inmemory_datamodule = get_inmemory_datamodule(x_train,
                                                   y_train,
@@ -107,7 +226,8 @@ def run(args, pretrained_module, fold=None):
                                                   y_val,
                                                   x_test,
                                                   y_test,
-                                                  args.batch_size_per_gpu)
+                                                  args.batch_size_per_gpu,
+                                                  device=args.inmemory_device)
 
     model = LinearClassifierPLModule(
         embed_dim=embed_dim,
@@ -124,8 +244,8 @@ def run(args, pretrained_module, fold=None):
                               )
     trainer: Trainer = Trainer(
         strategy="ddp",
-        sync_batchnorm=True,
-        accelerator="gpu",
+        sync_batchnorm=args.accelerator == "gpu",
+        accelerator=args.accelerator,
         devices=args.nproc,
         max_epochs=args.max_epochs,
         logger=logger_tb,  # ,logger_wb],
@@ -144,11 +264,27 @@ def run(args, pretrained_module, fold=None):
     return score
 
 
-def run_n_folds(args, pretrained_module, num_folds):
+def run_n_folds(args, pretrained_module, num_folds, cache=None):
     test_metrics = []
-    for fold in range(num_folds):
-        test_metrics.append(run(args, pretrained_module, fold+1))
-    test_metrics = torch.stack(test_metrics)
+    if args.nproc > 1 and cache is None and args.accelerator == "gpu":
+        # ddp predict shards and pads the clips, fold ids can not be matched;
+        # the cache writer (and the cpu backend) restore the dataset order.
+        # DownstreamDataModule builds the same folds as split_folds
+        for fold in range(num_folds):
+            test_metrics.append(run(args, pretrained_module, fold+1, cache))
+    else:
+        # every clip is encoded once, folds are assembled by indexing
+        transform = FreezingTransform()
+        x, y, fold_ids = extract_fold_embedding(args, pretrained_module, transform, cache)
+        if multi_head(args):
+            # heads of all folds are trained together
+            test_metrics = run_multi_head(args, pretrained_module, (x, y, x, y, x, y),
+                                          args.save_path, fold_ids)
+        else:
+            for fold in range(num_folds):
+                test_metrics.append(run(args, pretrained_module, fold+1,
+                                        embeddings=split_folds(x, y, fold_ids, fold+1)))
+    test_metrics = torch.stack(list(test_metrics))
     avg = torch.mean(test_metrics)
     print("{} folds's test scores:{}".format(num_folds, test_metrics))
     print("average test score:{}".format(avg))
@@ -162,10 +298,30 @@ def main():
     parser.add_argument("--pretrained_ckpt_path", type=str)
     parser.add_argument("--save_path", type=str)
     parser.add_argument('--nproc', type=int,  default=1)
+    parser.add_argument("--accelerator", type=str, default="gpu", choices=["gpu", "cpu"],
+                        help="cpu: extract embeddings (and train the probe) with nproc cpu processes")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="intra-op threads per cpu process, default cores/nproc")
+    parser.add_argument("--embedding_cache_dir", type=str, default=None,
+                        help="directory of the on-disk embedding cache; embeddings are extracted only once per checkpoint/dataset/fold")
+    parser.add_argument("--tome_r", type=int, default=0,
+                        help="tokens merged after each transformer block (ToMe), 0 disables merging")
     parser = LinearClassifierPLModule.add_model_specific_args(parser)
+    parser = MultiLinearClassifierPLModule.add_model_specific_args(parser)
+    parser.add_argument("--solver", type=str, default="sgd", choices=SOLVERS,
+                        help="sgd: LinearClassifierPLModule, ridge/lbfgs: full-batch solvers on the in-memory embeddings")
+    parser.add_argument("--solver_l2", type=float, nargs="+", default=[1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1],
+                        help="regularization path of the full-batch solvers, selected on the validation split")
+    parser.add_argument("--solver_device", type=str, default="cpu")
+    parser.add_argument("--inmemory_device", type=str, default="cpu", choices=["cpu", "auto"],
+                        help="auto: move the embeddings of all splits to the training device of every rank once, "
+                             "instead of copying each batch from host memory")
     parser = DownstreamDataModule.add_data_specific_args(parser)
 
     args = parser.parse_args()
+    if args.max_tokens is not None:
+        # rows of token budget batches can not be put back in dataset order
+        parser.error("--max_tokens is for fine-tuning, use --length_bucketing to cut the padding of the extraction")
 
     dataset_info = datasets.get_dataset(args.dataset_name)
     num_folds = dataset_info.num_folds
@@ -174,14 +330,27 @@ def main():
     pretrained_encoder = get_pretraied_encoder(args)
     pretrained_module = PretrainedEncoderPLModule(pretrained_encoder,
                                                         pretrained_encoder.hyper_param["train_len"],
-                                                        args.n_last_blocks)
+                                                        args.n_last_blocks,
+                                                        tome_r=args.tome_r)
     pretrained_module.freeze()
 
+    cache = None
+    if args.embedding_cache_dir is not None:
+        cache = EmbeddingCache(args.embedding_cache_dir,
+                               ckpt_hash=file_hash(args.pretrained_ckpt_path),
+                               dataset_name=args.dataset_name,
+                               data_path=os.path.abspath(args.data_path),
+                               transform={"name": "FreezingTransform"},
+                               use_encoder="teacher",
+                               chunk_len=pretrained_module.chunk_len,
+                               avgpool=pretrained_module.avgpool,
+                               tome_r=pretrained_module.tome_r)
+
     """train"""
     if num_folds > 1:
-        run_n_folds(args, pretrained_module, num_folds)
+        run_n_folds(args, pretrained_module, num_folds, cache)
     else:
-        run(args, pretrained_module)
+        run(args, pretrained_module, cache=cache)
 
 
 if __name__ == "__main__":
@@ -151,31 +151,38 @@ class Metric:
     def clear(self):
         self.preds = []
         self.targets = []
-    def compute(self):
+    def compute(self,verbose=True):
         preds = torch.cat(self.preds)
         targets = torch.cat(self.targets)
-        print(preds.shape,targets.shape)
+        if verbose:
+            print(preds.shape,targets.shape)
         preds=gather_all_tensors(preds) 
         targets=gather_all_tensors(targets) 
         preds = torch.cat(preds)
         targets = torch.cat(targets)
-        print(preds.shape,targets.shape)
-        preds = preds.cpu().numpy()
-        targets = targets.cpu().numpy()
-        if self.mode == "mAP":
-            mAPs =[]
-            for i in range(preds.shape[-1]):
-                mAPs.append(metrics.average_precision_score(targets[:,i],preds[:,i],average=None))
-            mAPs = np.array(mAPs)
-            _mAPs = mAPs[np.isnan(mAPs)]
+        if verbose:
+            print(preds.shape,targets.shape)
+        return metric_score(self.mode,preds,targets,verbose=verbose)
+
+def metric_score(mode,preds,targets,verbose=True):
+    """mAP or top-1 ACC of preds [N, num_labels] against targets, as Metric.compute"""
+    preds = preds.cpu().numpy()
+    targets = targets.cpu().numpy()
+    if mode == "mAP":
+        mAPs =[]
+        for i in range(preds.shape[-1]):
+            mAPs.append(metrics.average_precision_score(targets[:,i],preds[:,i],average=None))
+        mAPs = np.array(mAPs)
+        _mAPs = mAPs[np.isnan(mAPs)]
+        if verbose:
             print(mAPs)
             print("============{}================= nans".format(len(_mAPs)))
-            mAPs = mAPs[~np.isnan(mAPs)]
-            mAP = np.mean(mAPs)
-            return mAP
-        else:
-            acc = metrics.top_k_accuracy_score(targets,preds,k=1,labels=np.linspace(0,preds.shape[-1]-1,preds.shape[-1]))
-            return acc
+        mAPs = mAPs[~np.isnan(mAPs)]
+        mAP = np.mean(mAPs)
+        return mAP
+    else:
+        acc = metrics.top_k_accuracy_score(targets,preds,k=1,labels=np.linspace(0,preds.shape[-1]-1,preds.shape[-1]))
+        return acc
 
 def load_pretrained_weights(model, pretrained_weights, checkpoint_key):
     if os.path.isfile(pretrained_weights):
@@ -1,14 +1,19 @@
 
 import torch
 from torch import nn
-from audiossl.modules.transformer import Block
+from audiossl.modules.transformer import Block,set_grad_checkpointing
 from torch.nn import functional as F
 from functools import partial
 import time
 import warnings
 import math
+from collections import OrderedDict
 from audiossl.methods.atstframe import random_mask
 
+# interpolated position tables kept per model
+POS_CACHE_SIZE = 8
+
+
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
     # Cut & paste from PyTorch official master until it's in a few official releases - RW
     # Method based on https://people.sc.fsu.edu/~jburkardt/presentations/truncated_normal.pdf
@@ -110,6 +115,7 @@ class FrameAST(nn.Module):
         self.patch_h = patch_h
 
         self.pos_type = pos_type
+        self._pos_cache = OrderedDict()
         self.avg_blocks = avg_blocks
 
 
@@ -158,6 +164,9 @@ class FrameAST(nn.Module):
             nn.init.constant_(m.weight, 1.0)
 
 
+    def set_grad_checkpointing(self, policy="block", every=1):
+        set_grad_checkpointing(self.blocks, policy, every)
+
     def prepare_tokens(self, x, mask_index, length, mask=True):
         B, nc, h, w = x.shape
         mel_patches,x,patch_length = self.patch_embed(x,length)  # patch linear embedding
@@ -222,6 +231,24 @@ class FrameAST(nn.Module):
         return torch.mean(frame_repr[:,:self.nprompt],dim=1)
         
     def interpolate_pos_encoding(self, x, h, w):
+        # the interpolated table only depends on the input size and on the value
+        # of pos_embed, so it is reused until the parameter is updated in place
+        # (optimizer step, load_state_dict) or moved. Results that are part of
+        # an autograd graph are never cached.
+        if torch.is_grad_enabled() and self.pos_embed.requires_grad:
+            return self._interpolate_pos_encoding(x, h, w)
+        key = (h, w, self.pos_embed._version, self.pos_embed.data_ptr(), self.pos_embed.device, self.pos_embed.dtype)
+        if key in self._pos_cache:
+            self._pos_cache.move_to_end(key)
+        else:
+            self._pos_cache = OrderedDict((k, v) for k, v in self._pos_cache.items() if k[2:] == key[2:])
+            self._pos_cache[key] = self._interpolate_pos_encoding(x, h, w)
+            # variable length inputs give one table per width, keep the recent ones
+            if len(self._pos_cache) > POS_CACHE_SIZE:
+                self._pos_cache.popitem(last=False)
+        return self._pos_cache[key]
+
+    def _interpolate_pos_encoding(self, x, h, w):
         npatch = x.shape[1] - 1
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == self.spec_w and h == self.spec_h:
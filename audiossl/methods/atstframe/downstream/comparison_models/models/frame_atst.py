@@ -1,20 +1,26 @@
 
 import torch
 from torch import nn
-from audiossl.modules.transformer import Block
+from audiossl.modules.transformer import Block,set_grad_checkpointing
 from torch.nn import functional as F
 from functools import partial
 import time
 import warnings
 import math
+from collections import OrderedDict
 from pytorch_lightning import LightningModule
 from transformers.optimization import AdamW
-from audiossl.utils.common import cosine_scheduler_step,get_params_groups
+from audiossl.utils.common import cosine_scheduler_step,get_params_groups,EMAUpdater
+from itertools import chain
 from torch import nn
 import torch
 import argparse
 
 
+# interpolated position tables kept per model
+POS_CACHE_SIZE = 8
+
+
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
     # Cut & paste from PyTorch official master until it's in a few official releases - RW
     # Method based on https://people.sc.fsu.edu/~jburkardt/presentations/truncated_normal.pdf
@@ -95,6 +101,7 @@ class FrameAST(nn.Module):
         self.patch_h = patch_h
 
         self.pos_type = pos_type
+        self._pos_cache = OrderedDict()
 
 
         self.patch_embed = PatchEmbed_v2(patch_h,patch_w,embed_dim)
@@ -136,6 +143,9 @@ class FrameAST(nn.Module):
             nn.init.constant_(m.weight, 1.0)
 
 
+    def set_grad_checkpointing(self, policy="block", every=1):
+        set_grad_checkpointing(self.blocks, policy, every)
+
     def prepare_tokens(self, x, mask_index, length, mask=True):
         B, nc, h, w = x.shape
         mel_patches,x,patch_length = self.patch_embed(x,length)  # patch linear embedding
@@ -177,6 +187,24 @@ class FrameAST(nn.Module):
         return frame_repr[:,self.nprompt:][mask_index]
         
     def interpolate_pos_encoding(self, x, h, w):
+        # the interpolated table only depends on the input size and on the value
+        # of pos_embed, so it is reused until the parameter is updated in place
+        # (optimizer step, load_state_dict) or moved. Results that are part of
+        # an autograd graph are never cached.
+        if torch.is_grad_enabled() and self.pos_embed.requires_grad:
+            return self._interpolate_pos_encoding(x, h, w)
+        key = (h, w, self.pos_embed._version, self.pos_embed.data_ptr(), self.pos_embed.device, self.pos_embed.dtype)
+        if key in self._pos_cache:
+            self._pos_cache.move_to_end(key)
+        else:
+            self._pos_cache = OrderedDict((k, v) for k, v in self._pos_cache.items() if k[2:] == key[2:])
+            self._pos_cache[key] = self._interpolate_pos_encoding(x, h, w)
+            # variable length inputs give one table per width, keep the recent ones
+            if len(self._pos_cache) > POS_CACHE_SIZE:
+                self._pos_cache.popitem(last=False)
+        return self._pos_cache[key]
+
+    def _interpolate_pos_encoding(self, x, h, w):
         npatch = x.shape[1] - 1
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == self.spec_w and h == self.spec_h:
@@ -285,6 +313,8 @@ class FrameATST(nn.Module):
             p.requires_grad = False
         self.teacher.load_state_dict({k:v for k,v in self.student.state_dict().items() if "predictor" not in k })
         self.loss_fn = ByolLoss(symmetric=symmetric)
+        self.ema_updater = EMAUpdater(chain(zip(self.student.encoder.parameters(), self.teacher.encoder.parameters()),
+                                            zip(self.student.projector.parameters(), self.teacher.projector.parameters())))
     
     def forward(self,x,length,mask):
         if self.symmetric:
@@ -298,11 +328,7 @@ class FrameATST(nn.Module):
             return self.loss_fn(stu,tea)
             #total_loss_frm,std_frm_stu,std_frm_tea
     def update_teacher(self,m):
-        with torch.no_grad():
-            for param_q, param_k in zip(self.student.encoder.parameters(), self.teacher.encoder.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
-            for param_q, param_k in zip(self.student.projector.parameters(), self.teacher.projector.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
+        self.ema_updater(m)
 
 class FrameATSTLightningModule(LightningModule):
     def __init__(self,
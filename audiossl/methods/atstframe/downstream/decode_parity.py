@@ -0,0 +1,92 @@
+"""Parity check of the tensor decoding paths against the scipy reference, on CPU.
+
+Random strong predictions are decoded at every test threshold by
+    reference:             scipy median filter of the binary maps + ManyHotEncoder.decode_strong
+    batched_decode_preds:  decode_events
+    gpu_decode_preds:      MedianPool2d + ManyHotEncoder.gpu_decode_strong, in small threshold chunks
+and all three must give the same events. The binary maps of decode_preds,
+built in the same chunks, must equal the scipy median filtered ones.
+
+    python decode_parity.py --batches 5
+"""
+from argparse import ArgumentParser
+
+import numpy as np
+import scipy.ndimage
+import torch
+from audiossl.datasets.dcase_utils import ManyHotEncoder
+from audiossl.methods.atstframe.downstream.utils_dcase.class_dict import classes_labels
+from audiossl.methods.atstframe.downstream.utils_psds_eval.gpu_decode import (
+    MedianPool2d,
+    batched_decode_preds,
+    decode_preds,
+    gpu_decode_preds,
+)
+
+
+def reference_decode(strong_preds, filenames, encoder, thresholds, median_window):
+    preds = strong_preds.transpose(1, 2).numpy()  # [B, T, C]
+    decoded = {}
+    for th in thresholds:
+        events = []
+        for pred, f in zip(preds, filenames):
+            pred = scipy.ndimage.median_filter(pred > th, (median_window, 1))
+            events.extend((f, *e) for e in encoder.decode_strong(pred))
+        decoded[th] = events
+    return decoded
+
+
+def reference_maps(strong_preds, thresholds, median_window):
+    preds = strong_preds.numpy()
+    return np.stack([scipy.ndimage.median_filter(preds > th, (1, 1, median_window)) for th in thresholds])
+
+
+def event_set(events):
+    # times are computed differently by every path, frames are 40 ms apart
+    return sorted((f, c, round(float(on), 4), round(float(off), 4)) for f, c, on, off in events)
+
+
+def df_events(df):
+    return list(df[["filename", "event_label", "onset", "offset"]].itertuples(index=False, name=None))
+
+
+def main():
+    parser = ArgumentParser("decode_parity")
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--median_window", type=int, default=7)
+    parser.add_argument("--n_thresholds", type=int, default=50)
+    parser.add_argument("--max_elements", type=int, default=1 << 16)
+    args = parser.parse_args()
+
+    encoder = ManyHotEncoder(list(classes_labels.keys()), audio_len=10, frame_len=1024,
+                             frame_hop=160, net_pooling=4, fs=16000)
+    thresholds = list(np.arange(1 / (args.n_thresholds * 2), 1, 1 / args.n_thresholds))
+    median_filter = MedianPool2d(args.median_window, same=True)
+    generator = torch.Generator().manual_seed(0)
+    n_events = 0
+    for batch in range(args.batches):
+        # random walks, so events span several frames
+        logits = torch.randn(args.batch_size, len(encoder.labels), encoder.n_frames, generator=generator)
+        strong_preds = torch.sigmoid(logits.cumsum(-1) * 0.3)
+        filenames = ["clip{}_{}.wav".format(batch, i) for i in range(args.batch_size)]
+
+        reference = reference_decode(strong_preds, filenames, encoder, thresholds, args.median_window)
+        batched = batched_decode_preds(strong_preds, filenames, encoder, thresholds, args.median_window)
+        chunked = gpu_decode_preds(strong_preds, thresholds, filenames, encoder, median_filter,
+                                   max_elements=args.max_elements)
+        maps = decode_preds(strong_preds, thresholds, median_filter, max_elements=args.max_elements)
+        np.testing.assert_array_equal(maps.numpy() > 0.5, reference_maps(strong_preds, thresholds, args.median_window),
+                                      err_msg="decode_preds differs from the reference")
+        for th in thresholds:
+            expected = event_set(reference[th])
+            assert event_set(df_events(batched[th])) == expected, \
+                "batched_decode_preds differs from the reference at threshold {}".format(th)
+            assert event_set(df_events(chunked[th])) == expected, \
+                "gpu_decode_preds differs from the reference at threshold {}".format(th)
+            n_events += len(expected)
+    print("{} events of {} batches identical at {} thresholds".format(n_events, args.batches, len(thresholds)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,14 @@
 from email.mime import audio
 from pytorch_lightning import LightningModule
 from audiossl.modules.head import LinearHead
+from audiossl.modules.transformer import set_grad_checkpointing
 from audiossl.methods.atstframe import audio_transformer
 import torch
 from torch import nn
 from torch.nn import functional as F
 from audiossl.methods.atst.downstream.utils import Metric
-from audiossl.utils.common import cosine_scheduler_epoch,get_params_groups
+from audiossl.utils.common import (bool_flag, cosine_scheduler_epoch, get_params_groups,
+                                   merge_param_groups, optimizer_impl_kwargs)
 from itertools import chain
 
 
@@ -30,6 +32,11 @@ class PretrainedEncoderPLModule(LightningModule):
             self.embed_dim = self.encoder.embed_dim*n_blocks*2
         else:
             self.embed_dim = self.encoder.embed_dim*n_blocks 
+        # how get_intermediate_layers concatenates the outputs of all blocks:
+        # [avg (, prompt) of block 0, avg (, prompt) of block 1, ...]
+        self.embedding_layout = {"n_layers": len(self.encoder.blocks),
+                                 "n_parts": 2 if self.encoder.nprompt>0 else 1,
+                                 "order": "layer_major"}
 
     def forward(self, batch):
         (mel, length), y = batch
@@ -146,7 +153,9 @@ class LinearClassifierPLModule(LightningModule):
         parser.add_argument('--max_epochs', default=100, type=int)
         return parent_parser
 
-def layer_wise_lr_groups(model):
+def layer_wise_lr_groups(model, weight_decay=None):
+    """param groups with layer-wise lr decay, one group per (lr_scale, weight_decay);
+    with `weight_decay`, biases and norm parameters are not regularized"""
 
     layer_decay = model.layer_wise_lr
     num_layers = 12
@@ -186,7 +195,10 @@ def layer_wise_lr_groups(model):
                         #'name':name})
         else:
             print("missed",name)
-    return groups
+            continue
+        if weight_decay is not None:
+            groups[-1]['weight_decay'] = 0. if name.endswith(".bias") or len(param.shape) == 1 else weight_decay
+    return merge_param_groups(groups)
 
 
 
@@ -204,6 +216,10 @@ class FineTuningPLModule(LightningModule):
                  freeze_embed=False,
                  mixup_training=False,
                  optimizer="SGD",
+                 grad_checkpointing="none",
+                 checkpoint_every=1,
+                 scale_lr_by_batch=False,
+                 batch_size_per_gpu=256,
                  **kwargs):
         super().__init__()
         self.learning_rate = learning_rate
@@ -211,6 +227,10 @@ class FineTuningPLModule(LightningModule):
         self.warumup_epochs = warmup_epochs
         self.niter_per_epoch = niter_per_epoch
         self.optimizer_type =optimizer
+        # with dynamic batches, scale the lr of every step by the global batch
+        # size relative to nproc*batch_size_per_gpu the lr was set for
+        self.scale_lr_by_batch = scale_lr_by_batch
+        self.batch_size_per_gpu = batch_size_per_gpu
 
         self.encoder = encoder
         self.head = LinearHead(encoder.embed_dim, num_labels,use_norm=True, affine=False)
@@ -219,6 +239,7 @@ class FineTuningPLModule(LightningModule):
         self.num_labels = num_labels
         self.layer_wise_lr = layer_wise_lr
         self.freeze_embed = freeze_embed
+        set_grad_checkpointing(self.encoder, grad_checkpointing, checkpoint_every)
 
         if multi_label or self.mixup_training:
             self.loss_fn = binary_cross_entropy_with_logits
@@ -238,7 +259,7 @@ class FineTuningPLModule(LightningModule):
 
     def training_step(self, batch, batch_idx):
         self.encoder.train()
-        self.schedule()
+        self.schedule(len(batch[1]))
         x,y=self.encoder(batch)
         if self.multi_label == False and self.mixup_training == False and y.dim() > 1:
             y = y.argmax(-1)
@@ -251,17 +272,22 @@ class FineTuningPLModule(LightningModule):
         self.log("train_loss",loss,prog_bar=True,logger=True)
         return loss
 
-    def schedule(self):
+    def schedule(self, batch_size=None):
+        lr = self.mylr_scheduler[self.global_step]
+        if self.scale_lr_by_batch and batch_size is not None:
+            global_batch_size = self.trainer.strategy.reduce(torch.tensor(float(batch_size), device=self.device),
+                                                             reduce_op="sum")
+            lr = lr * global_batch_size.item() / (self.trainer.world_size * self.batch_size_per_gpu)
         if self.layer_wise_lr>0:
             for i, param_group in enumerate(self.trainer.optimizers[0].param_groups):
-                param_group["lr"] = self.mylr_scheduler[self.global_step] * param_group["lr_scale"]
+                param_group["lr"] = lr * param_group["lr_scale"]
         else:
             for i, param_group in enumerate(self.trainer.optimizers[0].param_groups):
-                param_group["lr"] = self.mylr_scheduler[self.global_step]
+                param_group["lr"] = lr
                 if self.optimizer_type== "adamw":
                     if i == 0:  # only the first group is regularized
                         param_group["weight_decay"] = 5e-4
-        self.log("lr",self.mylr_scheduler[self.global_step],prog_bar=True,logger=True)
+        self.log("lr",lr,prog_bar=True,logger=True)
 
     def _cal_metric(self,output,target):
         if self.multi_label:
@@ -309,21 +335,23 @@ class FineTuningPLModule(LightningModule):
     def configure_optimizers(self):
         if self.optimizer_type == "SGD":
             if self.layer_wise_lr > 0 :
-                optimizer = torch.optim.SGD(layer_wise_lr_groups( self),
-                                            self.learning_rate,
-                                            momentum=0.9,
-                                            weight_decay=0,
-                                            )
+                params = layer_wise_lr_groups(self)
             else:
-                optimizer = torch.optim.SGD(list(self.encoder.encoder.parameters())+list(self.head.parameters()),
-                                    self.learning_rate,
-                                    momentum=0.9,
-                                    weight_decay=0,
-                                    )
+                params = list(self.encoder.encoder.parameters())+list(self.head.parameters())
+            optimizer = torch.optim.SGD(params,
+                                        self.learning_rate,
+                                        momentum=0.9,
+                                        weight_decay=0,
+                                        **optimizer_impl_kwargs(torch.optim.SGD, params))
         else:
-            optimizer = torch.optim.AdamW(get_params_groups( self),
+            if self.layer_wise_lr > 0 :
+                params = layer_wise_lr_groups(self, weight_decay=5e-4)
+            else:
+                params = get_params_groups(self)
+            optimizer = torch.optim.AdamW(params,
                                           self.learning_rate,
-                                          weight_decay=0)
+                                          weight_decay=0,
+                                          **optimizer_impl_kwargs(torch.optim.AdamW, params))
         return [optimizer]
     
     @staticmethod
@@ -334,4 +362,10 @@ class FineTuningPLModule(LightningModule):
                             type=float, help="""Learning rate""")
         parser.add_argument('--max_epochs', default=100, type=int)
         parser.add_argument('--warmup_epochs', default=5, type=int)
+        parser.add_argument('--grad_checkpointing', default="none", type=str,
+                            help="activation checkpointing of transformer blocks: none, block or attn")
+        parser.add_argument('--checkpoint_every', default=1, type=int,
+                            help="checkpoint every k-th transformer block")
+        parser.add_argument('--scale_lr_by_batch', default=False, type=bool_flag,
+                            help="scale the lr of every step by its global batch size / (nproc*batch_size_per_gpu), for --max_tokens")
         return parent_parser
@@ -0,0 +1,113 @@
+"""Regression checks of the PSDS evaluation against the original pandas formulation.
+
+    overlap:      overlapping_pairs against the per-file outer merge and
+                  interval filter it replaces, on random tables with shared
+                  onsets and zero-length events
+    zero-length:  a ground truth with a zero-length event starting at the
+                  onset of another event of the same class is accepted, as
+                  the outer merge filter never paired them
+    shared:       the second scenario evaluated against a PreparedGroundTruth
+                  reuses the intersections of the first one, and gets the
+                  same rates as an evaluation of its own
+
+    python psds_parity.py --files 20 --events 10
+"""
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+from audiossl.methods.atstframe.downstream.utils_psds_eval.psds import (
+    PSDSEval,
+    overlapping_pairs,
+)
+
+
+def disjoint_events(rng, n_files, n_events):
+    """events that do not overlap within a file and class, as ground truth
+    tables must be"""
+    rows = []
+    for f in range(n_files):
+        for label in ["Speech", "Dog"]:
+            ends = np.cumsum(rng.integers(1, 6, 2 * n_events) / 2)
+            rows.extend(("f{}.wav".format(f), on, off, label)
+                        for on, off in zip(ends[0::2], ends[1::2]) if off <= 60)
+    return pd.DataFrame(rows, columns=["filename", "onset", "offset", "event_label"])
+
+
+def random_events(rng, n_files, n_events):
+    # half-second grid, so onsets are shared and some events have zero length
+    n = n_files * n_events
+    onset = rng.integers(0, 20, n) / 2
+    return pd.DataFrame({"filename": ["f{}.wav".format(i) for i in rng.integers(0, n_files, n)],
+                         "onset": onset,
+                         "offset": onset + rng.integers(0, 4, n) / 2,
+                         "event_label": rng.choice(["Speech", "Dog"], n)})
+
+
+def reference_pairs(table1, table2):
+    merged = pd.merge(table1.assign(pos1=np.arange(len(table1))),
+                      table2.assign(pos2=np.arange(len(table2))),
+                      how="outer", on="filename", suffixes=("_1", "_2"))
+    merged = merged[(merged.onset_1 < merged.offset_2) & (merged.onset_2 < merged.offset_1)]
+    return merged.pos1.to_numpy(dtype=np.int64), merged.pos2.to_numpy(dtype=np.int64)
+
+
+def check_overlap(rng, n_files, n_events):
+    table1 = random_events(rng, n_files, n_events)
+    table2 = random_events(rng, n_files, n_events)
+    for t1, t2 in [(table1, table2), (table1, table1)]:
+        pos1, pos2 = overlapping_pairs(t1, t2)
+        expected = reference_pairs(t1, t2)
+        assert np.array_equal(pos1, expected[0]) and np.array_equal(pos2, expected[1]), \
+            "overlapping_pairs differs from the outer merge filter"
+    print("overlap: {} pairs identical".format(len(pos1)))
+
+
+def check_zero_length():
+    ground_truth = pd.DataFrame({"filename": ["a.wav", "a.wav"],
+                                 "onset": [1.0, 1.0],
+                                 "offset": [2.0, 1.0],
+                                 "event_label": ["Speech", "Speech"]})
+    metadata = pd.DataFrame({"filename": ["a.wav"], "duration": [10.0]})
+    psds_eval = PSDSEval(ground_truth=ground_truth, metadata=metadata)
+    # the zero-length event is dropped after validation
+    assert len(psds_eval.ground_truth[psds_eval.ground_truth.event_label == "Speech"]) == 1
+    print("zero-length: accepted")
+
+
+def check_shared(rng, n_files, n_events):
+    ground_truth = disjoint_events(rng, n_files, n_events)
+    metadata = pd.DataFrame({"filename": ["f{}.wav".format(f) for f in range(n_files)],
+                             "duration": 60.0})
+    detections = [disjoint_events(rng, n_files, n_events) for _ in range(5)]
+    prepared = PSDSEval(ground_truth=ground_truth, metadata=metadata).prepared
+
+    PSDSEval(ground_truth=prepared, dtc_threshold=0.7, gtc_threshold=0.7).add_operating_points(detections)
+    intersections = prepared.intersections
+    scenario2 = PSDSEval(ground_truth=prepared, dtc_threshold=0.1, gtc_threshold=0.1)
+    scenario2.add_operating_points(detections)
+    assert prepared.intersections is intersections, "the second scenario recomputed the intersections"
+
+    alone = PSDSEval(ground_truth=ground_truth, metadata=metadata, dtc_threshold=0.1, gtc_threshold=0.1)
+    alone.add_operating_points(detections)
+    for column in ["tpr", "fpr", "ctr"]:
+        for shared, own in zip(scenario2.operating_points[column], alone.operating_points[column]):
+            np.testing.assert_array_equal(shared, own)
+    print("shared: intersections of {} operating points reused".format(len(detections)))
+
+
+def main():
+    parser = ArgumentParser("psds_parity")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--events", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    check_overlap(rng, args.files, args.events)
+    check_zero_length()
+    check_shared(rng, args.files, args.events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Parity check of the batched PSD-ROC curves against the per-curve reference.
+
+Random per-class rates, with NaN cross-trigger rates, are turned into curves by
+    reference:  PSDSEval.step_curve / PSDSEval.perform_interp, one curve at a time
+    batched:    batched_curves with step_curves / interp_curves
+and both must give the same values, NaNs included. The step curves get
+repeated rates; the interpolated ones do not, as perform_interp picks any of
+several tied rates.
+
+    python roc_parity.py --classes 20 --ops 50
+"""
+from argparse import ArgumentParser
+
+import numpy as np
+from audiossl.methods.atstframe.downstream.utils_psds_eval.psds import (
+    PSDSEval,
+    batched_curves,
+    interp_curves,
+    step_curves,
+)
+
+
+def main():
+    parser = ArgumentParser("roc_parity")
+    parser.add_argument("--classes", type=int, default=20)
+    parser.add_argument("--ops", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n, ops = args.classes, args.ops + 1
+    tpr = rng.random((n, ops))
+    ctr = rng.random((n, n, ops)) * 5
+    # at most one NaN per curve, perform_interp picks any of several
+    nan_rows = rng.random((n, n)) < 0.2
+    ctr[nan_rows, rng.integers(0, ops - 1, nan_rows.sum())] = np.nan
+    ctr[..., -1] = 0
+    pairs = ~np.eye(n, dtype=bool)
+
+    for name, reference, batched, decimals in [("step", PSDSEval.step_curve, step_curves, 1),
+                                               ("interp", PSDSEval.perform_interp, interp_curves, None)]:
+        # rounded, so the same rate comes back at several operating points
+        rates = ctr if decimals is None else np.round(ctr, decimals)
+        points = np.unique(np.sort(rates.flatten()))
+        xp, yp = rates[pairs], np.broadcast_to(tpr[:, None], rates.shape)[pairs]
+        expected = np.stack([reference(points, x, y) for x, y in zip(xp, yp)])
+        # small chunks, so rows are split over several calls
+        result = batched_curves(batched, points, xp, yp, max_elements=points.size * 7)
+        np.testing.assert_allclose(result, expected, equal_nan=True,
+                                   err_msg="{} curves differ from the reference".format(name))
+        print("{} {} curves over {} points identical".format(len(xp), name, points.size))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,7 @@ from audiossl.methods.atstframe.downstream.comparison_models.mmd_module import M
 from audiossl.datasets.dcase_utils import collate_fn
 from audiossl.methods.atstframe.downstream.utils_as_strong.model_as_strong import FineTuningPLModule
 from audiossl.methods.atstframe.downstream.utils_as_strong.model_distill_as_strong import DistillPLModule
+from audiossl.lightning.teacher_cache import TeacherCache
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint, EarlyStopping
 from pytorch_lightning.loggers import TensorBoardLogger
@@ -61,6 +62,17 @@ def run(args, pretrained_module):
             )
     n_gpus = len([x for x in args.nproc.split(",") if x != ""])
     if args.arch == "distill":
+        teacher_cache = None
+        if args.teacher_cache_dir is not None:
+            # the training clips are not augmented, one view is exact
+            teacher_cache = TeacherCache(args.teacher_cache_dir)
+            if not teacher_cache.exists():
+                teacher_cache.build(pretrained_module.encoder.teacher_module,
+                                    data.dataset_train[0],
+                                    collate_fn=collate_fn,
+                                    batch_size=args.batch_size_per_gpu,
+                                    num_workers=args.num_workers,
+                                    nproc=n_gpus)
         model = DistillPLModule(
         encoder=pretrained_module,
         num_labels=num_labels,
@@ -73,7 +85,8 @@ def run(args, pretrained_module):
         warmup_epochs=args.warmup_epochs,
         freeze_mode=args.freeze_mode,
         lr_scale=args.lr_scale,
-        distill_mode=args.pretrained_ckpt_path
+        distill_mode=args.pretrained_ckpt_path,
+        teacher_cache=teacher_cache
         )
     else:
         model = FineTuningPLModule(
@@ -88,6 +101,8 @@ def run(args, pretrained_module):
             warmup_epochs=args.warmup_epochs,
             freeze_mode=args.freeze_mode,
             lr_scale=args.lr_scale,
+            grad_checkpointing=args.grad_checkpointing,
+            checkpoint_every=args.checkpoint_every,
             )
     strategy = None if n_gpus == 1 else DDPStrategy(find_unused_parameters=False)
     trainer: Trainer = Trainer(
@@ -127,6 +142,8 @@ def main():
     parser.add_argument("--freeze_mode", action="store_true")
     parser.add_argument("--prefix", type=str, default="/")
     parser.add_argument("--lr_scale", type=float, default=1.0)
+    parser.add_argument("--teacher_cache_dir", type=str, default=None,
+                        help="distill: read the teacher predictions from this cache (built on first use)")
     parser = FineTuningPLModule.add_model_specific_args(parser)
     parser = DownstreamDataModule.add_data_specific_args(parser)
     
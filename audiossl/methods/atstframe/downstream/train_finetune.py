@@ -109,7 +109,7 @@ def run(args, pretrained_module, fold=None):
         encoder=pretrained_module,
         num_labels=num_labels,
         multi_label=multi_label,
-        niter_per_epoch=len(data.dataset_train)//args.batch_size_per_gpu//args.nproc+1,
+        niter_per_epoch=data.steps_per_epoch(args.nproc),
         layer_wise_lr = args.layerwise_lr,
         #optimizer= "adamw" if args.dataset_name == "audioset" else "SGD",
         **dict_args)
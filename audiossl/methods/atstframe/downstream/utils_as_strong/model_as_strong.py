@@ -10,17 +10,20 @@ from pytorch_lightning import LightningModule
 from torch.nn import functional as F
 from audiossl.datasets.as_strong_utils.as_strong_dict import get_lab_dict
 from audiossl.datasets.dcase_utils import ManyHotEncoder
+from audiossl.modules.transformer import set_grad_checkpointing
 from audiossl.utils.common import cosine_scheduler_epoch
-from audiossl.methods.atstframe.downstream.utils_psds_eval import evaluation, psds
 from audiossl.methods.atstframe.downstream.utils_psds_eval.gpu_decode import (
     decode_preds,
     MedianPool2d,
     SEDMetrics,
-    gpu_decode_preds
+    gpu_decode_preds,
+    EventBuffer,
+    broadcast_object,
 )
 from audiossl.methods.atstframe.downstream.utils_psds_eval.evaluation import (
     compute_per_intersection_macro_f1,
-    compute_psds_from_operating_points
+    compute_psds_from_operating_points,
+    prepare_ground_truth,
 )
 
 
@@ -70,7 +73,9 @@ class FineTuningPLModule(LightningModule):
                  multi_label=False,
                  metric_save_dir=None,
                  freeze_mode=False,
-                 lr_scale=1.0,):
+                 lr_scale=1.0,
+                 grad_checkpointing="none",
+                 checkpoint_every=1,):
         super().__init__()
         self.freeze_mode = freeze_mode
         self.learning_rate = learning_rate
@@ -79,6 +84,7 @@ class FineTuningPLModule(LightningModule):
         self.niter_per_epoch = niter_per_epoch
         self.metric_save_dir = metric_save_dir
         self.encoder = encoder
+        set_grad_checkpointing(self.encoder, grad_checkpointing, checkpoint_every)
         self.head = LinearHead(encoder.embed_dim, num_labels, use_norm=False, affine=False)
         self.multi_label = multi_label
         self.num_labels = num_labels
@@ -106,8 +112,7 @@ class FineTuningPLModule(LightningModule):
         test_thresholds = np.arange(
             1 / (test_n_thresholds * 2), 1, 1 / test_n_thresholds
         )
-        self.test_psds_buffer = {k: pd.DataFrame() for k in test_thresholds}
-        self.decoded_05_buffer = pd.DataFrame()
+        self.test_events = EventBuffer(test_thresholds, self.pred_decoder.labels)
         self.lr_scale = lr_scale
 
     def training_step(self, batch, batch_idx):        
@@ -172,30 +177,42 @@ class FineTuningPLModule(LightningModule):
         
         self.log("test/real/strong_loss", test_loss, prog_bar=True, logger=True)
         # Compute PSDS (Different from F1 metric, PSDS computes the ROC, which requires various thresholds from 0 to 1.)   
-        decoded_strong = gpu_decode_preds(
+        events = gpu_decode_preds(
             strong_pred, 
-            thresholds=list(self.test_psds_buffer.keys()),
+            thresholds=self.test_events.thresholds,
             filenames=filenames,
             encoder=self.pred_decoder, 
-            median_filter=self.median_filter
+            median_filter=self.median_filter,
+            output_type="codes",
         )
-        for th in self.test_psds_buffer.keys():
-            self.test_psds_buffer[th] = pd.concat([self.test_psds_buffer[th], decoded_strong[th]], ignore_index=True)
-        # Compute F1 metric
-        mid_val = list(self.test_psds_buffer.keys())[len(self.test_psds_buffer.keys()) // 2]
-        self.decoded_05_buffer = self.decoded_05_buffer.append(decoded_strong[mid_val])
+        self.test_events.add(filenames=filenames, **events)
         return
 
     def on_test_epoch_end(self) -> None:
         save_dir = os.path.join(self.metric_save_dir, "metrics_test")
+        # events are gathered to rank 0, which computes the metrics for all ranks
+        results = self._test_metrics(save_dir) if self.test_events.gather() else None
+        self.test_events.reset()
+        results = broadcast_object(results)
+        if self.logger is not None:
+                self.logger.log_metrics(results)
+                self.logger.log_hyperparams(self.config, results)
+
+        for key in results.keys():
+            self.log(key, results[key], prog_bar=True, logger=False)
+
+    def _test_metrics(self, save_dir):
+        """PSDS and F1 scores of the test events gathered on this rank"""
+        test_psds_buffer = self.test_events.to_dataframes()
+        # F1 metric at the middle threshold
+        mid_val = self.test_events.thresholds[len(self.test_events.thresholds) // 2]
+        decoded_05_buffer = test_psds_buffer[mid_val]
         # calculate the metrics
-        # Enable parallel computing
-        evaluation.g_parallel=True
-        psds.g_parallel=True
-        
+        # both scenarios share the ground truth and its intersections with the detections
+        ground_truth = prepare_ground_truth(self.config["data"]["test_tsv"], self.config["data"]["test_dur"])
         psds_score_scenario1 = compute_psds_from_operating_points(
-            self.test_psds_buffer,
-            self.config["data"]["test_tsv"],
+            test_psds_buffer,
+            ground_truth,
             self.config["data"]["test_dur"],
             dtc_threshold=0.7,
             gtc_threshold=0.7,
@@ -205,8 +222,8 @@ class FineTuningPLModule(LightningModule):
             weighted=False,
         )
         psds_score_scenario2 = compute_psds_from_operating_points(
-            self.test_psds_buffer,
-            self.config["data"]["test_tsv"],
+            test_psds_buffer,
+            ground_truth,
             self.config["data"]["test_dur"],
             dtc_threshold=0.1,
             gtc_threshold=0.1,
@@ -218,8 +235,8 @@ class FineTuningPLModule(LightningModule):
         )
 
         intersection_f1_macro = compute_per_intersection_macro_f1(
-            {"0.5": self.decoded_05_buffer},
-            self.config["data"]["test_tsv"],
+            {"0.5": decoded_05_buffer},
+            ground_truth,
             self.config["data"]["test_dur"],
         )
         print("Intersection F1:", intersection_f1_macro)
@@ -233,12 +250,7 @@ class FineTuningPLModule(LightningModule):
             "test/real/intersection_f1_macro": intersection_f1_macro * 100,
         }
         print(results)
-        if self.logger is not None:
-                self.logger.log_metrics(results)
-                self.logger.log_hyperparams(self.config, results)
-
-        for key in results.keys():
-            self.log(key, results[key], prog_bar=True, logger=False)
+        return results
 
     def configure_optimizers(self):
         # Freezing opt
@@ -284,6 +296,10 @@ class FineTuningPLModule(LightningModule):
         parser.add_argument("--learning_rate", default=0.01, type=float, help="""Learning rate""")
         parser.add_argument('--max_epochs', default=100, type=int)
         parser.add_argument('--warmup_epochs', default=5, type=int)
+        parser.add_argument('--grad_checkpointing', default="none", type=str,
+                            help="activation checkpointing of transformer blocks: none, block or attn")
+        parser.add_argument('--checkpoint_every', default=1, type=int,
+                            help="checkpoint every k-th transformer block")
         return parent_parser
 
     def request_param_groups(self):
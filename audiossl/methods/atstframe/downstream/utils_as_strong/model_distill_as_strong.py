@@ -15,16 +15,18 @@ from torch.nn import functional as F
 from audiossl.datasets.as_strong_utils.as_strong_dict import get_lab_dict
 from audiossl.datasets.dcase_utils import ManyHotEncoder
 from audiossl.utils.common import cosine_scheduler_epoch
-from audiossl.methods.atstframe.downstream.utils_psds_eval import evaluation, psds
 from audiossl.methods.atstframe.downstream.utils_psds_eval.gpu_decode import (
     decode_preds,
     MedianPool2d,
     SEDMetrics,
-    gpu_decode_preds
+    gpu_decode_preds,
+    EventBuffer,
+    broadcast_object,
 )
 from audiossl.methods.atstframe.downstream.utils_psds_eval.evaluation import (
     compute_per_intersection_macro_f1,
-    compute_psds_from_operating_points
+    compute_psds_from_operating_points,
+    prepare_ground_truth,
 )
 '''
 This file is modified from model.py
@@ -71,9 +73,12 @@ class DistillPLModule(LightningModule):
                  multi_label=False,
                  metric_save_dir=None,
                  freeze_mode=False,
-                 distill_mode="clip->frame"):
+                 distill_mode="clip->frame",
+                 teacher_cache=None):
         super().__init__()
         self.distill_mode = distill_mode
+        # TeacherCache with the teacher's frame predictions, keyed by file name
+        self.teacher_cache = teacher_cache
         self.freeze_mode = freeze_mode
         self.learning_rate = learning_rate
         self.max_epochs = max_epochs
@@ -87,7 +92,7 @@ class DistillPLModule(LightningModule):
         self.loss_fn = torch.nn.BCELoss()
         self.monitor = 0
         self.val_loss = []
-        self.save_hyperparameters(ignore=["encoder", ])
+        self.save_hyperparameters(ignore=["encoder", "teacher_cache"])
         with open(dcase_conf, "r") as f:
             self.config = yaml.safe_load(f)
         classes_labels = get_lab_dict(self.config["data"]["label_dict"])
@@ -108,8 +113,7 @@ class DistillPLModule(LightningModule):
         test_thresholds = np.arange(
             1 / (test_n_thresholds * 2), 1, 1 / test_n_thresholds
         )
-        self.test_psds_buffer = {k: pd.DataFrame() for k in test_thresholds}
-        self.decoded_05_buffer = pd.DataFrame()
+        self.test_events = EventBuffer(test_thresholds, self.pred_decoder.labels)
         self.lr_scale = lr_scale
 
 
@@ -117,10 +121,13 @@ class DistillPLModule(LightningModule):
         if not self.freeze_mode:
             self.encoder.finetune_mannual_train()
         self.schedule()
-        data, labels, _ = batch
+        data, labels, filenames = batch
 
         x, labels = self.encoder((data, labels))
-        if self.distill_mode == "clip->frame":
+        if self.teacher_cache is not None:
+            strong_pred_tea = self.teacher_cache.get(filenames).to(x)
+            strong_pred_std = self.head(x)
+        elif self.distill_mode == "clip->frame":
             with torch.no_grad():
                 strong_pred_tea = self.encoder.encoder.teacher_module((data, labels))
             strong_pred_std = self.head(x)
@@ -185,29 +192,42 @@ class DistillPLModule(LightningModule):
         test_loss = self.loss_fn(strong_pred, labels)
         self.log("test/real/strong_loss", test_loss, prog_bar=True, logger=True)
         # Compute PSDS (Different from F1 metric, PSDS computes the ROC, which requires various thresholds from 0 to 1.)   
-        decoded_strong = gpu_decode_preds(
+        events = gpu_decode_preds(
             strong_pred, 
-            thresholds=list(self.test_psds_buffer.keys()),
+            thresholds=self.test_events.thresholds,
             filenames=filenames,
             encoder=self.pred_decoder, 
-            median_filter=self.median_filter
+            median_filter=self.median_filter,
+            output_type="codes",
         )
-        for th in self.test_psds_buffer.keys():
-            self.test_psds_buffer[th] = pd.concat([self.test_psds_buffer[th], decoded_strong[th]], ignore_index=True)
-        # Compute F1 metric
-        mid_val = list(self.test_psds_buffer.keys())[len(self.test_psds_buffer.keys()) // 2]
-        self.decoded_05_buffer = self.decoded_05_buffer.append(decoded_strong[mid_val])
+        self.test_events.add(filenames=filenames, **events)
         return
 
     def on_test_epoch_end(self) -> None:
         save_dir = os.path.join(self.metric_save_dir, "metrics_test")
+        # events are gathered to rank 0, which computes the metrics for all ranks
+        results = self._test_metrics(save_dir) if self.test_events.gather() else None
+        self.test_events.reset()
+        results = broadcast_object(results)
+        if self.logger is not None:
+                self.logger.log_metrics(results)
+                self.logger.log_hyperparams(self.config, results)
+
+        for key in results.keys():
+            self.log(key, results[key], prog_bar=True, logger=False)
+
+    def _test_metrics(self, save_dir):
+        """PSDS and F1 scores of the test events gathered on this rank"""
+        test_psds_buffer = self.test_events.to_dataframes()
+        # F1 metric at the middle threshold
+        mid_val = self.test_events.thresholds[len(self.test_events.thresholds) // 2]
+        decoded_05_buffer = test_psds_buffer[mid_val]
         # # calculate the metrics
-        evaluation.g_parallel=True
-        psds.g_parallel=True
-        
+        # both scenarios share the ground truth and its intersections with the detections
+        ground_truth = prepare_ground_truth(self.config["data"]["test_tsv"], self.config["data"]["test_dur"])
         psds_score_scenario1 = compute_psds_from_operating_points(
-            self.test_psds_buffer,
-            self.config["data"]["test_tsv"],
+            test_psds_buffer,
+            ground_truth,
             self.config["data"]["test_dur"],
             dtc_threshold=0.7,
             gtc_threshold=0.7,
@@ -218,8 +238,8 @@ class DistillPLModule(LightningModule):
         )
 
         psds_score_scenario2 = compute_psds_from_operating_points(
-            self.test_psds_buffer,
-            self.config["data"]["test_tsv"],
+            test_psds_buffer,
+            ground_truth,
             self.config["data"]["test_dur"],
             dtc_threshold=0.1,
             gtc_threshold=0.1,
@@ -232,8 +252,8 @@ class DistillPLModule(LightningModule):
         #==================================
 
         intersection_f1_macro = compute_per_intersection_macro_f1(
-            {"0.5": self.decoded_05_buffer},
-            self.config["data"]["test_tsv"],
+            {"0.5": decoded_05_buffer},
+            ground_truth,
             self.config["data"]["test_dur"],
         )
         print("Intersection F1:", intersection_f1_macro)
@@ -247,12 +267,7 @@ class DistillPLModule(LightningModule):
             "test/real/intersection_f1_macro": intersection_f1_macro * 100,
         }
         print(results)
-        if self.logger is not None:
-                self.logger.log_metrics(results)
-                self.logger.log_hyperparams(self.config, results)
-
-        for key in results.keys():
-            self.log(key, results[key], prog_bar=True, logger=False)
+        return results
 
     def configure_optimizers(self):
         if self.lr_scale == 1:
@@ -15,7 +15,9 @@ from audiossl.datasets.dcase_utils import ManyHotEncoder
 from audiossl.utils.common import cosine_scheduler_epoch
 from audiossl.methods.atstframe.downstream.utils_dcase.class_dict import classes_labels
 from audiossl.methods.atstframe.downstream.utils_psds_eval.gpu_decode import (
-    batched_decode_preds,
+    decode_events,
+    EventBuffer,
+    broadcast_object,
     log_sedeval_metrics,
     decode_preds,
     MedianPool2d,
@@ -24,7 +26,8 @@ from audiossl.methods.atstframe.downstream.utils_psds_eval.gpu_decode import (
 )
 from audiossl.methods.atstframe.downstream.utils_psds_eval.evaluation import (
     compute_per_intersection_macro_f1,
-    compute_psds_from_operating_points
+    compute_psds_from_operating_points,
+    prepare_ground_truth,
 )
 '''
 This file is modified from model.py
@@ -129,8 +132,12 @@ class FineTuningPLModule(LightningModule):
         test_thresholds = np.arange(
             1 / (test_n_thresholds * 2), 1, 1 / test_n_thresholds
         )
-        self.test_psds_buffer = {k: pd.DataFrame() for k in test_thresholds}
-        self.decoded_05_buffer = pd.DataFrame()
+        self.test_thresholds = list(test_thresholds)
+        # psds operating points and the 0.5 threshold of the F1 scores, decoded together
+        self.test_events = EventBuffer(
+            self.test_thresholds + ([0.5] if 0.5 not in self.test_thresholds else []),
+            self.pred_decoder.labels,
+        )
 
 
     def training_step(self, batch, batch_idx):
@@ -244,34 +251,40 @@ class FineTuningPLModule(LightningModule):
         
         self.log("test/real/strong_loss", test_loss, prog_bar=True, logger=True)
         # Compute PSDS (Different from F1 metric, PSDS computes the ROC, which requires various thresholds from 0 to 1.)
-        decoded_strong = batched_decode_preds(
-            strong_pred,
-            filenames,
-            self.pred_decoder,
-            median_filter=self.config["training"]["median_window"],
-            thresholds=list(self.test_psds_buffer.keys()),
-        )
-        for th in self.test_psds_buffer.keys():
-            self.test_psds_buffer[th] = pd.concat([self.test_psds_buffer[th], decoded_strong[th]], ignore_index=True)
-
-        # Compute F1 metric
-        decoded_strong = batched_decode_preds(
+        # and the F1 metric at 0.5, the median filter runs once for all thresholds
+        events = decode_events(
             strong_pred,
-            filenames,
-            self.pred_decoder,
-            median_filter=self.config["training"]["median_window"],
-            thresholds=[0.5],
+            self.test_events.thresholds,
+            median_window=self.config["training"]["median_window"],
         )
-        self.decoded_05_buffer = self.decoded_05_buffer.append(decoded_strong[0.5])
+        self.test_events.add_events(events, filenames, self.pred_decoder)
         return
 
     def on_test_epoch_end(self) -> None:
         save_dir = os.path.join(self.metric_save_dir, "metrics_test")
+        # events are gathered to rank 0, which computes the metrics for all ranks
+        results = self._test_metrics(save_dir) if self.test_events.gather() else None
+        self.test_events.reset()
+        results = broadcast_object(results)
+        if self.logger is not None:
+                self.logger.log_metrics(results)
+                self.logger.log_hyperparams(self.config, results)
+
+        for key in results.keys():
+            self.log(key, results[key], prog_bar=True, logger=False)
+
+    def _test_metrics(self, save_dir):
+        """PSDS and F1 scores of the test events gathered on this rank"""
+        decoded = self.test_events.to_dataframes()
+        test_psds_buffer = {th: decoded[th] for th in self.test_thresholds}
+        decoded_05_buffer = decoded[0.5]
 
         # calculate the metrics
+        # both scenarios share the ground truth and its intersections with the detections
+        ground_truth = prepare_ground_truth(self.config["data"]["test_tsv"], self.config["data"]["test_dur"])
         psds_score_scenario1 = compute_psds_from_operating_points(
-            self.test_psds_buffer,
-            self.config["data"]["test_tsv"],
+            test_psds_buffer,
+            ground_truth,
             self.config["data"]["test_dur"],
             dtc_threshold=0.7,
             gtc_threshold=0.7,
@@ -281,8 +294,8 @@ class FineTuningPLModule(LightningModule):
         )
 
         psds_score_scenario2 = compute_psds_from_operating_points(
-            self.test_psds_buffer,
-            self.config["data"]["test_tsv"],
+            test_psds_buffer,
+            ground_truth,
             self.config["data"]["test_dur"],
             dtc_threshold=0.1,
             gtc_threshold=0.1,
@@ -293,15 +306,15 @@ class FineTuningPLModule(LightningModule):
         )
 
         event_F1_macro = log_sedeval_metrics(
-            self.decoded_05_buffer,
+            decoded_05_buffer,
             self.config["data"]["test_tsv"],
             os.path.join(save_dir, "student"),
         )[0]
 
         # synth dataset
         intersection_f1_macro = compute_per_intersection_macro_f1(
-            {"0.5": self.decoded_05_buffer},
-            self.config["data"]["test_tsv"],
+            {"0.5": decoded_05_buffer},
+            ground_truth,
             self.config["data"]["test_dur"],
         )
 
@@ -314,13 +327,7 @@ class FineTuningPLModule(LightningModule):
             "test/real/event_f1_macro": event_F1_macro,
             "test/real/intersection_f1_macro": intersection_f1_macro,
         }
-
-        if self.logger is not None:
-                self.logger.log_metrics(results)
-                self.logger.log_hyperparams(self.config, results)
-
-        for key in results.keys():
-            self.log(key, results[key], prog_bar=True, logger=False)
+        return results
 
     def configure_optimizers(self):
         # Freezing opt
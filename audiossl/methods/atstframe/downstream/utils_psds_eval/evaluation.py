@@ -1,21 +1,15 @@
 import os
-import threading
-import multiprocessing
 import sed_eval
 import psds_eval
 
 import numpy as np
 import pandas as pd
-from .psds import PSDSEval, plot_psd_roc
-
-from concurrent.futures import ProcessPoolExecutor
-from queue import Queue
-
-
-g_manager = multiprocessing.Manager()
+from .psds import PSDSEval, PreparedGroundTruth, plot_psd_roc
+from .parallel import add_operating_points_parallel
 
 
 g_parallel = False
+g_num_workers = 10
 
 def get_event_list_current_file(df, fname):
     """
@@ -170,7 +164,7 @@ def compute_per_intersection_macro_f1(
     """ Compute F1-score per intersection, using the defautl
     Args:
         prediction_dfs: dict, a dictionary with thresholds keys and predictions dataframe
-        ground_truth_file: pd.DataFrame, the groundtruth dataframe
+        ground_truth_file: pd.DataFrame, the groundtruth dataframe, or the PreparedGroundTruth of prepare_ground_truth
         durations_file: pd.DataFrame, the duration dataframe
         dtc_threshold: float, the parameter used in PSDSEval, percentage of tolerance for groundtruth intersection
             with predictions
@@ -181,16 +175,12 @@ def compute_per_intersection_macro_f1(
     Returns:
 
     """
-    gt = pd.read_csv(ground_truth_file, sep="\t")
-    durations = pd.read_csv(durations_file, sep="\t")
-    if label_interest is not None:
-        gt_mask = [x in label_interest for x in gt["event_label"]]
-        gt = gt[gt_mask]
-        filenames = gt["filename"].values
-        durations = durations[[x in filenames for x in durations["filename"]]]
+    if isinstance(ground_truth_file, PreparedGroundTruth):
+        ground_truth = ground_truth_file
+    else:
+        ground_truth = prepare_ground_truth(ground_truth_file, durations_file, label_interest)
     psds = PSDSEval(
-        ground_truth=gt,
-        metadata=durations,
+        ground_truth=ground_truth,
         dtc_threshold=dtc_threshold,
         gtc_threshold=gtc_threshold,
         cttc_threshold=cttc_threshold,
@@ -208,15 +198,19 @@ def compute_per_intersection_macro_f1(
     return psds_macro_f1
 
 
-def compute_psds_one_item(psds_eval: PSDSEval,prediction_dfs,i,k, weighted=False):
-    det = prediction_dfs[k]
-    # see issue https://github.com/audioanalytic/psds_eval/issues/3
-    det["index"] = range(1, len(det) + 1)
-    det = det.set_index("index")
-    psds_args = psds_eval.add_operating_point_single_thread(
-        det, info={"name": f"Op {i + 1:02d}", "threshold": k}, weighted=weighted
-    )
-    return psds_args
+def prepare_ground_truth(ground_truth_file, durations_file, label_interest=None):
+    """Read and prepare the ground truth once, it can then be passed as
+    ground_truth_file to compute_psds_from_operating_points for every scenario"""
+    gt = pd.read_csv(ground_truth_file, sep="\t")
+    durations = pd.read_csv(durations_file, sep="\t")
+
+    if label_interest is not None:
+        gt_mask = [x in label_interest for x in gt["event_label"]]
+        gt = gt[gt_mask]
+        filenames = gt["filename"].values
+        durations = durations[[x in filenames for x in durations["filename"]]]
+    return PSDSEval(ground_truth=gt, metadata=durations).prepared
+
 
 def compute_psds_from_operating_points(
     prediction_dfs,
@@ -230,46 +224,43 @@ def compute_psds_from_operating_points(
     max_efpr=100,
     save_dir=None,
     label_interest=None,
-    weighted=False
+    weighted=False,
+    single_pass=True,
+    num_workers=None,
 ):
+    """PSDS of the detections of a system at several operating points.
+
+    prediction_dfs: dict {threshold: DataFrame with columns filename,
+    event_label, onset, offset}. With single_pass all operating points are
+    evaluated together by PSDSEval.add_operating_points, otherwise one by one.
+    If g_parallel is set, the operating points are spread over num_workers
+    (default g_num_workers) processes sharing the ground truth and the
+    detections in shared memory, see add_operating_points_parallel.
+    ground_truth_file: tsv file, or the PreparedGroundTruth of
+    prepare_ground_truth (durations_file and label_interest are then unused),
+    which lets the scenarios share the ground truth and, on the single_pass
+    path only, the intersections.
+    weighted: not used, PSDSEval.psds averages the classes with equal weights.
+    """
     print("Computing PSDS score ... (May take > 10 mins)")
-    gt = pd.read_csv(ground_truth_file, sep="\t")
-    durations = pd.read_csv(durations_file, sep="\t")
+    if isinstance(ground_truth_file, PreparedGroundTruth):
+        ground_truth = ground_truth_file
+    else:
+        ground_truth = prepare_ground_truth(ground_truth_file, durations_file, label_interest)
 
-    if label_interest is not None:
-        gt_mask = [x in label_interest for x in gt["event_label"]]
-        gt = gt[gt_mask]
-        filenames = gt["filename"].values
-        durations = durations[[x in filenames for x in durations["filename"]]]
-    
     psds_eval = PSDSEval(
-        ground_truth=gt,
-        metadata=durations,
+        ground_truth=ground_truth,
         dtc_threshold=dtc_threshold,
         gtc_threshold=gtc_threshold,
         cttc_threshold=cttc_threshold,
     )
-    if g_parallel:
-        # Parallel version (written by us)
-        prediction_dfs=g_manager.dict(prediction_dfs)
-        q = Queue(100)
-        def helper_thread_fun():
-            with ProcessPoolExecutor(max_workers=10) as exe:
-                for i, k in enumerate(prediction_dfs.keys()):
-                    q.put(exe.submit(compute_psds_one_item,psds_eval,prediction_dfs,i,k, weighted=weighted))
-                q.put(None)
-
-        helper_thread = threading.Thread(target=helper_thread_fun)
-        helper_thread.setDaemon(True)
-        helper_thread.start()
-
-        for future in iter(q.get,""):
-            if future is None:
-                break
-            else:
-                psds_args=future.result()
-                if psds_args is not None:
-                    psds_eval._add_op(**psds_args)
+    infos = [{"name": f"Op {i + 1:02d}", "threshold": k} for i, k in enumerate(prediction_dfs.keys())]
+    if num_workers is None:
+        num_workers = g_num_workers
+    if g_parallel and num_workers > 1:
+        add_operating_points_parallel(psds_eval, list(prediction_dfs.values()), infos, num_workers)
+    elif single_pass:
+        psds_eval.add_operating_points(list(prediction_dfs.values()), infos=infos)
     else:
         # Default behavior
         for i, k in enumerate(prediction_dfs.keys()):
@@ -278,11 +269,11 @@ def compute_psds_from_operating_points(
             det["index"] = range(1, len(det) + 1)
             det = det.set_index("index")
             psds_args = psds_eval.add_operating_point_single_thread(
-                det, info={"name": f"Op {i + 1:02d}", "threshold": k}, weighted=weighted
+                det, info={"name": f"Op {i + 1:02d}", "threshold": k}
             )
             if psds_args is not None:
                 psds_eval._add_op(**psds_args)
-    psds_score = psds_eval.psds(alpha_ct=alpha_ct, alpha_st=alpha_st, max_efpr=max_efpr, weighted=weighted)
+    psds_score = psds_eval.psds(alpha_ct=alpha_ct, alpha_st=alpha_st, max_efpr=max_efpr)
 
 
     if save_dir is not None:
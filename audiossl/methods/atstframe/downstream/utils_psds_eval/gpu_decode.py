@@ -4,7 +4,9 @@ import math
 import json
 import torch
 
+import numpy as np
 import pandas as pd
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -50,7 +52,7 @@ class MedianPool2d(nn.Module):
         middle = x.shape[dim]//2
         even = 1 - x.shape[dim]%2
         deref[dim] = slice(middle-even, middle+1+even)
-        values = x.gather(dim, index[deref])
+        values = x.gather(dim, index[tuple(deref)])
         return (
             values.mean(dim, keepdim=keepdim) if even 
             else values if keepdim 
@@ -100,12 +102,12 @@ class SEDMetrics(nn.Module):
             preds = strong_preds.bool()
             labels = ground_truth.bool()
 
-            idv_event_triu = torch.cuda.FloatTensor(T + 1, T).fill_(1).triu().T
+            idv_event_triu = torch.ones(T + 1, T, device=strong_preds.device).triu().T
 
             # Locate each events
             all_events = torch.logical_or(preds, labels).float()
-            events_bdry = torch.cat([all_events, torch.cuda.FloatTensor(bsz, num_cls, 1).fill_(0)], dim=-1) \
-                - torch.cat([torch.cuda.FloatTensor(bsz, num_cls, 1).fill_(0), all_events], dim=-1)
+            events_bdry = torch.cat([all_events, all_events.new_zeros(bsz, num_cls, 1)], dim=-1) \
+                - torch.cat([all_events.new_zeros(bsz, num_cls, 1), all_events], dim=-1)
             events_start = torch.argwhere(events_bdry == 1)
             events_end = torch.argwhere(events_bdry == -1)
         
@@ -130,11 +132,11 @@ class SEDMetrics(nn.Module):
         with torch.no_grad():
             
             bsz, num_cls, T = strong_preds.shape
-            idv_event_triu = torch.cuda.FloatTensor(T + 1, T).fill_(1).triu().T
+            idv_event_triu = torch.ones(T + 1, T, device=strong_preds.device).triu().T
 
             # Locate each events
-            events_bdry = torch.cat([neg_truths, torch.cuda.FloatTensor(bsz, num_cls, 1).fill_(0)], dim=-1) \
-                - torch.cat([torch.cuda.FloatTensor(bsz, num_cls, 1).fill_(0), neg_truths], dim=-1)
+            events_bdry = torch.cat([neg_truths, neg_truths.new_zeros(bsz, num_cls, 1)], dim=-1) \
+                - torch.cat([neg_truths.new_zeros(bsz, num_cls, 1), neg_truths], dim=-1)
             events_start = torch.argwhere(events_bdry == 1)
             events_end = torch.argwhere(events_bdry == -1)
         
@@ -174,7 +176,7 @@ class SEDMetrics(nn.Module):
     def compute_macro_f1(self):
         false_num = self.fps + self.fns
         if false_num is 0:
-            false_num += torch.cuda.FloatTensor(1).fill_(1e-7)
+            false_num += torch.full((1,), 1e-7)
         f_score = self.tps / (self.tps + 1 / 2 * (false_num))
         f_score = f_score.nan_to_num(0)
         self.reset_stats()
@@ -184,10 +186,10 @@ class SEDMetrics(nn.Module):
         # strong_preds: [thds, bsz, cls, T]
         num_thds, _, num_cls, _ = strong_preds.shape
         # redefine tps with thds dimension
-        self.tps += torch.cuda.FloatTensor(num_thds, num_cls).fill_(0)
-        self.fps += torch.cuda.FloatTensor(num_thds, num_cls).fill_(0)
-        self.fns += torch.cuda.FloatTensor(num_thds, num_cls).fill_(0)
-        self.tns += torch.cuda.FloatTensor(num_thds, num_cls).fill_(0)
+        self.tps += torch.zeros(num_thds, num_cls, device=strong_preds.device)
+        self.fps += torch.zeros(num_thds, num_cls, device=strong_preds.device)
+        self.fns += torch.zeros(num_thds, num_cls, device=strong_preds.device)
+        self.tns += torch.zeros(num_thds, num_cls, device=strong_preds.device)
         # cls eye for one-hot calculation
         cls_eye = torch.eye(num_cls, device=strong_preds.device)
         for i, strong_preds_thd in enumerate(strong_preds):
@@ -225,21 +227,97 @@ class SEDMetrics(nn.Module):
         d_prime = standard_normal.ppf(auc) * math.sqrt(2.0)
         return d_prime
 
-def decode_preds(strong_preds, thds, median_filter):
-    bsz, cls, T = strong_preds.shape
-    # Not implement for multiple thds
-    if len(thds) > 1:
-        smooth_preds = torch.cuda.FloatTensor(len(thds), bsz, cls, T)
-    for i, thd in enumerate(thds):
-        thd = torch.tensor(thd, device="cuda").reshape(1, 1, 1)
-        thd = thd.repeat(bsz, cls, T)
-        hard_preds = strong_preds > thd
-        if len(thds) > 1:
-            smooth_preds[i] = median_filter(hard_preds.float())
-        else:
-            smooth_preds = median_filter(hard_preds.float())
+def decode_preds(strong_preds, thds, median_filter, max_elements=1 << 22):
+    """Binarize `strong_preds` [B, C, T] at every threshold and median filter
+    the binary maps, on the device and in the dtype of `strong_preds`.
+    Returns [len(thds), B, C, T], or [B, C, T] for a single threshold. The
+    maps are built in threshold chunks; to keep memory bounded with many
+    thresholds, iterate `decoded_pred_chunks` instead."""
+    chunks = [maps for _, maps in decoded_pred_chunks(strong_preds, thds, median_filter, max_elements)]
+    smooth_preds = chunks[0] if len(chunks) == 1 else torch.cat(chunks)
+    return smooth_preds[0] if len(thds) == 1 else smooth_preds
+
+def decoded_pred_chunks(strong_preds, thds, median_filter, max_elements=1 << 22):
+    """Median filtered binary maps of `strong_preds` [B, C, T], one chunk of
+    thresholds at a time (see `threshold_chunks`): yields (start, maps) with
+    maps [n, B, C, T] for thds[start:start + n]"""
+    start = 0
+    for chunk in threshold_chunks(list(thds), strong_preds.shape, max_elements):
+        with torch.no_grad():
+            thd = torch.as_tensor(chunk, dtype=strong_preds.dtype, device=strong_preds.device).reshape(-1, 1, 1, 1)
+            binary_preds = strong_preds.unsqueeze(0) > thd # [Thds, Bsz, Cls, T]
+            smooth_preds = median_filter(binary_preds.to(strong_preds.dtype))
+        yield start, smooth_preds
+        start += len(chunk)
+
+def threshold_chunks(thresholds, shape, max_elements=1 << 22):
+    """Split `thresholds` so that the binary maps of one chunk, each of
+    `shape`, hold at most `max_elements` values (at least one threshold per chunk)"""
+    n = max(1, max_elements // int(np.prod(shape)))
+    return [thresholds[i:i + n] for i in range(0, len(thresholds), n)]
+
+def rank_filter(x, window, rank=None):
+    """Rank filter of `x` along its last dimension, the same as
+    scipy.ndimage.median_filter(x, (..., window)): the window of frame t
+    covers t - window//2 ... t + (window-1)//2, the edges are padded
+    symmetrically (scipy "reflect") and the value of sorted index
+    `rank` (default window//2) is taken."""
+    if rank is None:
+        rank = window // 2
+    T = x.shape[-1]
+    left, right = window // 2, window - 1 - window // 2
+    index = torch.cat([torch.arange(left - 1, -1, -1),
+                       torch.arange(T),
+                       torch.arange(T - 1, T - 1 - right, -1)]).clamp(0, T - 1).to(x.device)
+    x = x.index_select(-1, index).unfold(-1, window, 1)
+    return x.sort(dim=-1).values[..., rank]
+
+
+def decode_events(strong_preds, thresholds, median_window=7, pad_indx=None):
+    """Decode a batch of strong predictions [B, C, T] at all `thresholds` at once.
+
+    The predictions are thresholded into a [thr, B, C, T] boolean tensor,
+    median filtered over time and the contiguous active regions are found
+    with diff / argwhere, on the device of `strong_preds`. The median filter
+    is applied once to the scores before thresholding, which gives the same
+    result as filtering every binary map since a rank filter commutes with
+    thresholding.
+
+    Args:
+        strong_preds: torch.Tensor, batch of strong predictions [B, C, T].
+        thresholds: list, the thresholds.
+        median_window: int, the median filter window in frames.
+        pad_indx: list, fraction of every clip that is not padding, frames past it are dropped.
+
+    Returns:
+        dict of numpy arrays with one entry per event, ordered by threshold, clip, class and onset:
+        "threshold" (index into `thresholds`), "clip" (index into the batch), "event_label" (class index),
+        "onset" and "offset" (frames, offset excluded)
+    """
+    with torch.no_grad():
+        preds = strong_preds.detach()
+        if median_window > 1:
+            preds = rank_filter(preds, median_window)
+        # compared in the dtype of the predictions, like numpy does with python floats
+        thds = torch.as_tensor(thresholds, dtype=preds.dtype, device=preds.device).reshape(-1, 1, 1, 1)
+        active = preds.unsqueeze(0) > thds
+        if pad_indx is not None:
+            T = active.shape[-1]
+            true_len = torch.tensor([int(T * float(p)) for p in pad_indx], device=preds.device)
+            active &= (torch.arange(T, device=preds.device) < true_len.unsqueeze(-1)).unsqueeze(1)
+        n_thds, B, C, T = active.shape
+        active = F.pad(active.reshape(-1, T).to(torch.int8), (1, 1))
+        change = active[:, 1:] - active[:, :-1]
+        onset = torch.argwhere(change == 1).cpu().numpy()
+        offset = torch.argwhere(change == -1).cpu().numpy()
+    # regions of a row are found in order, so onsets and offsets pair up
+    row = onset[:, 0]
+    return {"threshold": row // (B * C),
+            "clip": row // C % B,
+            "event_label": row % C,
+            "onset": onset[:, 1],
+            "offset": offset[:, 1]}
 
-    return smooth_preds
 
 def batched_decode_preds(
     strong_preds, filenames, encoder, thresholds=[0.5], median_filter=7, pad_indx=None,
@@ -258,25 +336,124 @@ def batched_decode_preds(
     Returns:
         dict of predictions, each keys is a threshold and the value is the DataFrame of predictions.
     """
+    events = decode_events(strong_preds, thresholds, median_filter, pad_indx)
+    labels = np.array(encoder.labels, dtype=object)
+    names = np.array([Path(f).stem + ".wav" for f in filenames], dtype=object)
     prediction_dfs = {}
-    for threshold in thresholds:
-        prediction_dfs[threshold] = pd.DataFrame()
-    strong_preds = strong_preds.detach().cpu().numpy()
-    for j in range(strong_preds.shape[0]):  # over batches
-        for k, c_th in enumerate(thresholds):
-            c_preds = strong_preds[j]
-            if pad_indx is not None:
-                true_len = int(c_preds.shape[-1] * pad_indx[j].item())
-                c_preds = c_preds[:true_len]
-            pred = c_preds.T
-            pred = pred > c_th
-            pred = scipy.ndimage.filters.median_filter(pred, (median_filter, 1))
-            pred = encoder.decode_strong(pred)
-            pred = pd.DataFrame(pred, columns=["event_label", "onset", "offset"])
-            pred["filename"] = Path(filenames[j]).stem + ".wav"
-            prediction_dfs[c_th] = pd.concat([prediction_dfs[c_th], pred], ignore_index=True)
+    for k, c_th in enumerate(thresholds):
+        mask = events["threshold"] == k
+        prediction_dfs[c_th] = pd.DataFrame({
+            "event_label": labels[events["event_label"][mask]],
+            "onset": encoder._frame_to_time(events["onset"][mask]),
+            "offset": encoder._frame_to_time(events["offset"][mask]),
+            "filename": names[events["clip"][mask]],
+        })
     return prediction_dfs
 
+class EventBuffer:
+    """Append-only columnar buffer of the events decoded during a test epoch.
+
+    Every batch adds arrays of threshold id, file id, class id, onset and
+    offset (seconds), so the cost of a batch does not depend on what was
+    buffered before. The per threshold DataFrames expected by the PSDS and
+    F1 code are built once, by `to_dataframes`, after `gather` collected the
+    events of all ddp ranks on rank 0.
+
+    Example::
+
+            buffer = EventBuffer(thresholds, encoder.labels)
+            # test_step
+            buffer.add_events(decode_events(preds, buffer.thresholds), filenames, encoder)
+            # on_test_epoch_end
+            results = compute_metrics(buffer.to_dataframes()) if buffer.gather() else None
+            results = broadcast_object(results)
+    """
+    def __init__(self, thresholds, labels):
+        self.thresholds = list(thresholds)
+        self.labels = list(labels)
+        self.reset()
+
+    def reset(self):
+        self.filenames = []
+        self.chunks = []
+
+    def add(self, threshold, clip, event_label, onset, offset, filenames):
+        """Events of one batch of `filenames`: `threshold` and `event_label`
+        index the thresholds and labels of the buffer, `clip` the batch"""
+        file = np.asarray(clip, dtype=np.int64) + len(self.filenames)
+        self.filenames.extend(Path(f).stem + ".wav" for f in filenames)
+        self.chunks.append((np.asarray(threshold, dtype=np.int64), file,
+                            np.asarray(event_label, dtype=np.int64),
+                            np.asarray(onset, dtype=np.float64),
+                            np.asarray(offset, dtype=np.float64)))
+
+    def add_events(self, events, filenames, encoder):
+        """Events returned by `decode_events` for the thresholds of the buffer"""
+        self.add(events["threshold"], events["clip"], events["event_label"],
+                 encoder._frame_to_time(events["onset"]),
+                 encoder._frame_to_time(events["offset"]),
+                 filenames)
+
+    def columns(self):
+        if len(self.chunks) == 0:
+            return [np.zeros(0, dtype=np.int64)] * 3 + [np.zeros(0, dtype=np.float64)] * 2
+        return [np.concatenate(c) for c in zip(*self.chunks)]
+
+    def gather(self, dst=0):
+        """Collect the events of all ddp ranks on rank `dst`, the metrics are
+        computed there only. A file tested on several ranks
+        (DistributedSampler padding) is kept once. Returns whether this rank
+        holds the events."""
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return True
+        is_dst = dist.get_rank() == dst
+        parts = [None] * dist.get_world_size() if is_dst else None
+        dist.gather_object((self.filenames, self.columns()), parts, dst=dst)
+        self.reset()
+        if not is_dst:
+            return False
+        index = {}
+        for filenames, columns in parts:
+            # the index is updated while scanning, a file padded in more than
+            # once within the same part is kept once as well
+            new = np.zeros(len(filenames), dtype=bool)
+            remap = np.full(len(filenames), -1, dtype=np.int64)
+            for i, f in enumerate(filenames):
+                if f not in index:
+                    index[f] = len(index)
+                    self.filenames.append(f)
+                    new[i] = True
+                    remap[i] = index[f]
+            threshold, file, event_label, onset, offset = columns
+            keep = new[file]
+            self.chunks.append((threshold[keep], remap[file[keep]], event_label[keep], onset[keep], offset[keep]))
+        return True
+
+    def to_dataframes(self):
+        """{threshold: DataFrame with columns filename, event_label, onset, offset}"""
+        threshold, file, event_label, onset, offset = self.columns()
+        order = np.argsort(threshold, kind="stable")
+        bounds = np.searchsorted(threshold[order], np.arange(len(self.thresholds) + 1))
+        filenames = np.array(self.filenames, dtype=object)
+        labels = np.array(self.labels, dtype=object)
+        decoded = {}
+        for k, th in enumerate(self.thresholds):
+            rows = order[bounds[k]:bounds[k + 1]]
+            decoded[th] = pd.DataFrame({"filename": filenames[file[rows]],
+                                        "event_label": labels[event_label[rows]],
+                                        "onset": onset[rows],
+                                        "offset": offset[rows]})
+        return decoded
+
+def broadcast_object(obj, src=0):
+    """`obj` of ddp rank `src` on every rank, e.g. the test metrics computed
+    from the events gathered there"""
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
 def convert_to_event_based(weak_dataframe):
     """ Convert a weakly labeled DataFrame ('filename', 'event_labels') to a DataFrame strongly labeled
     ('filename', 'onset', 'offset', 'event_label').
@@ -389,13 +566,21 @@ def parse_jams(jams_list, encoder, out_json):
     with open(out_json, "w") as f:
         json.dump({"backgrounds": backgrounds, "sources": sources}, f, indent=4)
 
-def gpu_decode_preds(strong_preds, thresholds, filenames, encoder, median_filter):
-    # Init a dataframe per threshold
-    bsz, cls, T = strong_preds.shape
-    # Not implement for multiple thds
-    thd = torch.cuda.FloatTensor(thresholds).reshape(-1, 1, 1, 1) # [Thds, Bsz, T, Cls]
-    thd = thd.repeat(1, bsz, cls, T)
-    binary_preds = strong_preds > thd
-    smooth_preds = median_filter(binary_preds.float())
-    prediction_dfs_gpu = encoder.gpu_decode_strong(smooth_preds, thresholds, filenames)
-    return prediction_dfs_gpu
\ No newline at end of file
+def gpu_decode_preds(strong_preds, thresholds, filenames, encoder, median_filter, max_elements=1 << 22,
+                     output_type="pandas"):
+    """Decode a batch of strong predictions [B, C, T] with `encoder.gpu_decode_strong`,
+    to one DataFrame per threshold or, with output_type="codes", to the integer
+    coded events. Runs on the device of `strong_preds`, cpu included; the
+    thresholds are processed in chunks of at most `max_elements` binary values
+    (see `decoded_pred_chunks`)."""
+    thresholds = list(thresholds)
+    chunk_events = []
+    for start, smooth_preds in decoded_pred_chunks(strong_preds, thresholds, median_filter, max_elements):
+        chunk = thresholds[start:start + smooth_preds.shape[0]]
+        events = encoder.gpu_decode_strong(smooth_preds, chunk, filenames, output_type="codes")
+        events["threshold"] += start
+        chunk_events.append(events)
+    events = {k: np.concatenate([e[k] for e in chunk_events]) for k in chunk_events[0]}
+    if output_type == "codes":
+        return events
+    return encoder.events_to_dataframes(events, thresholds, filenames)
@@ -0,0 +1,152 @@
+"""Shared memory process pool backend of the PSDS evaluation.
+
+The ground truth and the detections of every operating point are copied
+once into shared memory as columnar arrays, file and label names as integer
+codes, and mapped by every worker when it starts. Tasks only carry operating
+point indices. Results are gathered in task order, so the output does not
+depend on the number of workers.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from warnings import warn
+
+import numpy as np
+import pandas as pd
+
+from .psds import PSDSEval, PreparedGroundTruth
+
+
+class SharedArrays:
+    """numpy arrays copied into shared memory blocks, `spec` (picklable)
+    lets other processes map them with `attach_arrays`"""
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            np.ndarray(a.shape, a.dtype, buffer=shm.buf)[...] = a
+            self.blocks.append(shm)
+            self.spec[name] = (shm.name, a.shape, a.dtype.str)
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+
+
+def attach_arrays(spec):
+    """Map the arrays of a SharedArrays spec, the blocks must stay referenced
+    as long as the arrays are used"""
+    blocks = {name: shared_memory.SharedMemory(name=shm_name) for name, (shm_name, _, _) in spec.items()}
+    arrays = {name: np.ndarray(shape, np.dtype(dtype), buffer=blocks[name].buf)
+              for name, (_, shape, dtype) in spec.items()}
+    return arrays, blocks
+
+
+def run_pool(initializer, initargs, task, items, num_workers):
+    """task(item) for every item in `num_workers` forked processes, results in item order"""
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                             initializer=initializer, initargs=initargs) as exe:
+        return list(exe.map(task, items))
+
+
+# state of a worker process, set by the pool initializers
+_worker = {}
+
+
+def _init_operating_point_worker(spec, filenames, labels, psds_kwargs):
+    arrays, blocks = attach_arrays(spec)
+    ground_truth = pd.DataFrame({"filename": filenames[arrays["gt_file"]],
+                                 "onset": arrays["gt_onset"],
+                                 "offset": arrays["gt_offset"],
+                                 "event_label": labels[arrays["gt_label"]],
+                                 "duration": arrays["gt_duration"],
+                                 "id": arrays["gt_id"]})
+    metadata = pd.DataFrame({"filename": filenames[arrays["meta_file"]],
+                             "duration": arrays["meta_duration"]})
+    _worker.update(arrays=arrays, blocks=blocks, filenames=filenames, labels=labels,
+                   psds_eval=PSDSEval(ground_truth=PreparedGroundTruth(ground_truth, metadata),
+                                      **psds_kwargs))
+
+
+def _evaluate_operating_points(ops):
+    """(op id, counts, tpr, fpr, ctr) of the operating points `ops`, evaluated in one pass"""
+    arrays, psds_eval = _worker["arrays"], _worker["psds_eval"]
+    bounds = arrays["det_bounds"]
+    det_ts, op_ids = [], []
+    for k, op in enumerate(ops):
+        rows = slice(bounds[op], bounds[op + 1])
+        det_t = psds_eval._init_det_table(pd.DataFrame({
+            "filename": _worker["filenames"][arrays["det_file"][rows]],
+            "onset": arrays["det_onset"][rows],
+            "offset": arrays["det_offset"][rows],
+            "event_label": _worker["labels"][arrays["det_label"][rows]]}))
+        op_ids.append(psds_eval._operating_point_id(det_t))
+        det_ts.append(det_t.assign(op=k))
+    rates = psds_eval._evaluate_operating_points(det_ts) if len(det_ts) else []
+    return [(op_id,) + tuple(r) for op_id, r in zip(op_ids, rates)]
+
+
+def add_operating_points_parallel(psds_eval, detections, infos=None, num_workers=10):
+    """Same as psds_eval.add_operating_points(detections, infos), with the
+    operating points spread over `num_workers` processes. Every worker
+    evaluates its share in a single pass; operating points are added, and
+    duplicates skipped, in their original order. The intersections are
+    computed by the workers, they are not kept in psds_eval.prepared for
+    other scenarios."""
+    if infos is None:
+        infos = [None] * len(detections)
+    ground_truth, metadata = psds_eval.ground_truth, psds_eval.metadata
+    det = pd.concat([d[["filename", "onset", "offset", "event_label"]] for d in detections],
+                    ignore_index=True)
+    file_codes, filenames = pd.factorize(pd.concat(
+        [ground_truth.filename, metadata.filename, det.filename], ignore_index=True))
+    label_codes, labels = pd.factorize(pd.concat(
+        [ground_truth.event_label, det.event_label], ignore_index=True))
+    n_gt, n_meta = len(ground_truth), len(metadata)
+    shared = SharedArrays({
+        "gt_file": file_codes[:n_gt],
+        "gt_onset": ground_truth.onset.to_numpy(dtype=np.float64),
+        "gt_offset": ground_truth.offset.to_numpy(dtype=np.float64),
+        "gt_label": label_codes[:n_gt],
+        "gt_duration": ground_truth.duration.to_numpy(dtype=np.float64),
+        "gt_id": ground_truth.id.to_numpy(),
+        "meta_file": file_codes[n_gt:n_gt + n_meta],
+        "meta_duration": metadata.duration.to_numpy(dtype=np.float64),
+        "det_file": file_codes[n_gt + n_meta:],
+        "det_onset": det.onset.to_numpy(dtype=np.float64),
+        "det_offset": det.offset.to_numpy(dtype=np.float64),
+        "det_label": label_codes[n_gt:],
+        "det_bounds": np.concatenate([[0], np.cumsum([len(d) for d in detections])]),
+    })
+    psds_kwargs = {"dtc_threshold": psds_eval.threshold.dtc,
+                   "gtc_threshold": psds_eval.threshold.gtc,
+                   "cttc_threshold": psds_eval.threshold.cttc,
+                   "duration_unit": psds_eval.duration_unit,
+                   "class_names": psds_eval.class_names}
+    # interleaved shares, low and high thresholds have very different numbers of events
+    shares = [list(range(w, len(detections), num_workers)) for w in range(num_workers)]
+    try:
+        results = run_pool(_init_operating_point_worker,
+                           (shared.spec, np.asarray(filenames, dtype=object),
+                            np.asarray(labels, dtype=object), psds_kwargs),
+                           _evaluate_operating_points, shares, num_workers)
+    finally:
+        shared.close()
+    by_op = {}
+    for share, share_results in zip(shares, results):
+        by_op.update(zip(share, share_results))
+
+    seen = set(psds_eval.operating_points.id.values)
+    for op in range(len(detections)):
+        op_id, cts, tp_ratio, fp_rate, ct_rate = by_op[op]
+        if not op_id or op_id in seen:
+            if op_id:
+                warn("A similar operating point exists, skipping this one")
+            continue
+        seen.add(op_id)
+        psds_eval._add_op(opid=op_id, counts=cts, tpr=tp_ratio, fpr=fp_rate,
+                          ctr=ct_rate, info=infos[op])
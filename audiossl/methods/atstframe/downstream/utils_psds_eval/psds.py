@@ -20,25 +20,151 @@ PSDS = namedtuple("PSDS", ["value", "plt", "alpha_st", "alpha_ct", "max_efpr",
 Thresholds = namedtuple("Thresholds", ["gtc", "dtc", "cttc"])
 
 
-from concurrent.futures import ProcessPoolExecutor
-from queue import Queue
-import threading
-g_parallel=True
-
 import time
 
-def roc_curve_one_item(c,fpr_points,efpr_points,ctr_points,pcr,n_classes,_curve):
-    tpr_v_fpr = _curve(fpr_points, pcr.fp_rate[c], pcr.tp_ratio[c])
-    tpr_v_efpr = _curve(efpr_points, pcr.effective_fp_rate[c],
-                        pcr.tp_ratio[c])
-    tpr_v_ctr=np.full((n_classes,ctr_points.size),np.nan)
-    for k in range(n_classes):
-        if c == k:
-            continue
-        tpr_v_ctr[k]= _curve(ctr_points, pcr.ct_rate[c, k],
-                                pcr.tp_ratio[c])
-
-    return c,tpr_v_fpr,tpr_v_efpr,tpr_v_ctr
+def batched_curves(curve, x, xp, yp, max_elements=1 << 22):
+    """Apply `curve` (step_curves or interp_curves) to every row of
+    xp, yp [..., n] over the points x, in chunks of rows holding about
+    `max_elements` output values. Returns [..., x.size]"""
+    shape = xp.shape[:-1]
+    xp = np.asarray(xp, dtype=float).reshape(-1, xp.shape[-1])
+    yp = np.broadcast_to(yp, shape + yp.shape[-1:]).reshape(-1, xp.shape[-1]).astype(float)
+    out = np.empty((xp.shape[0], x.size))
+    rows = max(1, max_elements // max(x.size, 1))
+    for start in range(0, xp.shape[0], rows):
+        out[start:start + rows] = curve(x, xp[start:start + rows], yp[start:start + rows])
+    return out.reshape(shape + (x.size,))
+
+
+def step_curves(x, xp, yp):
+    """PSDSEval.step_curve of every row of xp, yp [rows, n] over the sorted
+    points x, which hold all xp values.
+
+    The value at x[j] is the highest yp whose xp <= x[j], or 0: every yp is
+    put at the first point >= its xp and a running max taken along x. NaN
+    xp or yp are ignored, as the groupby and forward fill of step_curve do.
+    """
+    pos = np.searchsorted(x, xp, side="left")
+    valid = ~np.isnan(xp) & ~np.isnan(yp) & (pos < x.size)
+    grid = np.full((xp.shape[0], x.size), -np.inf)
+    np.maximum.at(grid, (np.nonzero(valid)[0], pos[valid]), yp[valid])
+    grid = np.maximum.accumulate(grid, axis=1)
+    grid[np.isneginf(grid)] = 0
+    return grid
+
+
+def interp_curves(x, xp, yp):
+    """PSDSEval.perform_interp of every row of xp, yp [rows, n] over the
+    sorted points x.
+
+    Of duplicated xp values the first one in (stable) sorted order is
+    kept, as np.unique(return_index=True) does; a row with a NaN xp takes
+    the yp of its first NaN everywhere, as its last unique xp is then NaN.
+    """
+    rows, n = xp.shape
+    order = np.argsort(xp, axis=1, kind="stable")
+    xs = np.take_along_axis(xp, order, axis=1)
+    ys = np.take_along_axis(yp, order, axis=1)
+    # y of the first element of every run of equal xs
+    same = (xs[:, 1:] == xs[:, :-1]) | (np.isnan(xs[:, 1:]) & np.isnan(xs[:, :-1]))
+    first = np.concatenate([np.ones((rows, 1), bool), ~same], axis=1)
+    run = np.maximum.accumulate(np.where(first, np.arange(n), 0), axis=1)
+    ys = np.take_along_axis(ys, run, axis=1)
+    # k: last sorted xp <= x[j], so k + 1 starts the next run
+    counts = np.zeros((rows, x.size + 1), dtype=np.int64)
+    np.add.at(counts, (np.repeat(np.arange(rows), n), np.searchsorted(x, xs, side="left").ravel()), 1)
+    k = np.cumsum(counts, axis=1)[:, :-1] - 1
+    lo = np.take_along_axis(xs, np.clip(k, 0, n - 1), axis=1), np.take_along_axis(ys, np.clip(k, 0, n - 1), axis=1)
+    hi = np.take_along_axis(xs, np.clip(k + 1, 0, n - 1), axis=1), np.take_along_axis(ys, np.clip(k + 1, 0, n - 1), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = lo[1] + (hi[1] - lo[1]) * (x - lo[0]) / (hi[0] - lo[0])
+    y = np.where(x == lo[0], lo[1], y)
+    y = np.where(k < 0, ys[:, :1], y)
+    # past the last xp: its y
+    y = np.where(x < xs[:, -1:], y, ys[:, -1:])
+    return np.maximum.accumulate(y, axis=1)
+
+
+def range_pairs(lo, hi):
+    """(row, position) pairs for every position in [lo[row], hi[row])"""
+    n = np.maximum(hi - lo, 0)
+    rows = np.repeat(np.arange(len(n)), n)
+    pos = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+    return rows, pos
+
+
+def overlapping_pairs(table1, table2):
+    """Positions (pos1, pos2) of the rows of two event tables that belong to
+    the same file and overlap in time (onset_1 < offset_2 and onset_2 < offset_1).
+
+    Events A and B overlap if and only if onset_B is in [onset_A, offset_A) or
+    onset_A is in (onset_B, offset_B). Both cases are binary searches over the
+    events sorted by (file, onset), so only overlapping pairs are generated
+    instead of the per-file cartesian product of the two tables. Pairs are
+    returned in the row order of pd.merge(table1, table2, on="filename").
+    """
+    n1 = len(table1)
+    files = pd.factorize(pd.concat([table1.filename, table2.filename], ignore_index=True), sort=True)[0]
+    times = np.concatenate([table1.onset.to_numpy(dtype=np.float64), table1.offset.to_numpy(dtype=np.float64),
+                            table2.onset.to_numpy(dtype=np.float64), table2.offset.to_numpy(dtype=np.float64)])
+    # exact ranks of the times, so that (file, time) compares as one integer key
+    ranks = np.unique(times, return_inverse=True)[1].reshape(-1)
+    stride = len(times) + 1
+    on1, off1, on2, off2 = np.split(ranks, [n1, 2 * n1, 2 * n1 + len(table2)])
+    f1, f2 = files[:n1], files[n1:]
+    key_on1, key_off1 = f1 * stride + on1, f1 * stride + off1
+    key_on2, key_off2 = f2 * stride + on2, f2 * stride + off2
+    # rows without filename or times never intersect
+    idx1 = np.flatnonzero((f1 >= 0) & ~np.isnan(times[:n1]) & ~np.isnan(times[n1:2 * n1]))
+    idx2 = np.flatnonzero((f2 >= 0) & ~np.isnan(times[2 * n1:2 * n1 + len(table2)]) &
+                          ~np.isnan(times[2 * n1 + len(table2):]))
+    order1 = idx1[np.argsort(key_on1[idx1], kind="stable")]
+    order2 = idx2[np.argsort(key_on2[idx2], kind="stable")]
+
+    # B starts in [onset_A, offset_A)
+    rows, pos = range_pairs(np.searchsorted(key_on2[order2], key_on1[idx1], "left"),
+                            np.searchsorted(key_on2[order2], key_off1[idx1], "left"))
+    pos1, pos2 = [idx1[rows]], [order2[pos]]
+    # A starts in (onset_B, offset_B)
+    rows, pos = range_pairs(np.searchsorted(key_on1[order1], key_on2[idx2], "right"),
+                            np.searchsorted(key_on1[order1], key_off2[idx2], "left"))
+    pos1.append(order1[pos])
+    pos2.append(idx2[rows])
+    pos1, pos2 = np.concatenate(pos1), np.concatenate(pos2)
+    # the bounds above also take a zero-length B starting at onset_A, the
+    # strict criteria reject it
+    keep = (key_on1[pos1] < key_off2[pos2]) & (key_on2[pos2] < key_off1[pos1])
+    pos1, pos2 = pos1[keep], pos2[keep]
+
+    order = np.lexsort((pos2, pos1, f1[pos1]))
+    return pos1[order], pos2[order]
+
+
+class PreparedGroundTruth:
+    """Ground truth and metadata of a dataset, validated and prepared once.
+
+    Holds the ground truth table with its WORLD events, the metadata and the
+    per-class event counts and durations. It can be shared by several
+    PSDSEval objects, e.g. the scenarios of a DCASE evaluation, which differ
+    only by their dtc/gtc/cttc thresholds. The intersections of the last
+    batch of operating points evaluated against it are kept too, as they do
+    not depend on these thresholds (see `PSDSEval.add_operating_points`).
+
+    Example::
+
+            prepared = PSDSEval(ground_truth=gt, metadata=meta).prepared
+            scenario1 = PSDSEval(ground_truth=prepared, dtc_threshold=0.7, gtc_threshold=0.7)
+            scenario2 = PSDSEval(ground_truth=prepared, dtc_threshold=0.1, gtc_threshold=0.1)
+    """
+    def __init__(self, ground_truth, metadata):
+        self.ground_truth = ground_truth
+        self.metadata = metadata
+        self.counts = ground_truth.groupby("event_label").filename.count()
+        self.durations = ground_truth.groupby("event_label").duration.sum()
+        self.dataset_duration = \
+            ground_truth[ground_truth.event_label == WORLD].duration.sum()
+        # (operating point ids, intersection table) of the last batch
+        self.intersections = None
 
 
 class PSDSEvalError(ValueError):
@@ -82,7 +208,8 @@ class PSDSEval:
                 inferred from the ground truth table
             duration_unit: unit of time ('minute', 'hour', 'day', 'month',
                 'year') for FP/CT rates report
-            ground_truth (str): Path to the file containing ground truths.
+            ground_truth (str): Path to the file containing ground truths,
+                or a PreparedGroundTruth, which needs no metadata.
             metadata (str): Path to the file containing audio metadata
         Raises:
             PSDSEvalError: If any of the input values are incorrect.
@@ -106,6 +233,7 @@ class PSDSEval:
         self.operating_points = self._operating_points_table()
         self.ground_truth = None
         self.metadata = None
+        self.prepared = None
         gt_t = kwargs.get("ground_truth", None)
         meta_t = kwargs.get("metadata", None)
         if gt_t is not None or meta_t is not None:
@@ -194,6 +322,12 @@ class PSDSEval:
         if self.ground_truth is not None or self.metadata is not None:
             raise PSDSEvalError("You cannot set the ground truth more than"
                                 " once per evaluation")
+        if isinstance(gt_t, PreparedGroundTruth):
+            self._update_class_names(gt_t.ground_truth.event_label)
+            self.ground_truth = gt_t.ground_truth
+            self.metadata = gt_t.metadata
+            self.prepared = gt_t
+            return
         if gt_t is None and meta_t is not None:
             raise PSDSEvalError("The ground truth cannot be set without data")
         if meta_t is None and gt_t is not None:
@@ -229,6 +363,7 @@ class PSDSEval:
         self._update_class_names(ground_truth_t.event_label)
         self.ground_truth = ground_truth_t
         self.metadata = metadata_t
+        self.prepared = PreparedGroundTruth(ground_truth_t, metadata_t)
 
     def _init_det_table(self, det_t):
         """Validate and prepare an input detection table
@@ -261,12 +396,9 @@ class PSDSEval:
         Append to each file an artificial ground truth of length equal
         to the file duration provided in the metadata table.
         """
-        world_gt = [
-            {k: v for k, v in zip(columns,
-                                  [metadata.loc[i, 'filename'], 0.0,
-                                   metadata.loc[i, 'duration'], WORLD])
-             } for i in metadata.index
-        ]
+        world_gt = pd.DataFrame(dict(zip(
+            columns, [metadata["filename"].to_numpy(), 0.0,
+                      metadata["duration"].to_numpy(), WORLD])))
         if len(world_gt):
             ground_truth = pd.concat(
                 [ground_truth, pd.DataFrame(world_gt)], ignore_index=True)
@@ -302,18 +434,19 @@ class PSDSEval:
             suffixes from each input table. A boolean "same_cls" column
             indicates if intersecting events have the same class. If
             remove_identical=True, identical events from both tables are not
-            considered.
+            considered. Overlapping events are found by `overlapping_pairs`.
         """
-        comb_t = pd.merge(table1, table2,
-                          how='outer', on='filename',
-                          suffixes=suffixes)
-        # intersect_t contains detections/labels in the first table that
-        # intersect one or more detections/labels in the second table
-        # with non-zero intersections
-        intersect_t = comb_t[
-            (comb_t["onset" + suffixes[0]] < comb_t["offset" + suffixes[1]]) &
-            (comb_t["onset" + suffixes[1]] < comb_t["offset" + suffixes[0]]) &
-            comb_t.filename.notna()].copy(deep=True)
+        # same rows and columns as filtering
+        # pd.merge(table1, table2, how='outer', on='filename', suffixes=suffixes)
+        # on intersecting events, with a fresh index
+        pos1, pos2 = overlapping_pairs(table1, table2)
+        left = table1.iloc[pos1].reset_index(drop=True)
+        right = table2.drop(columns="filename").iloc[pos2].reset_index(drop=True)
+        common = set(left.columns) & set(right.columns)
+        intersect_t = pd.concat(
+            [left.rename(columns={c: c + suffixes[0] for c in common}),
+             right.rename(columns={c: c + suffixes[1] for c in common})],
+            axis=1)
         if remove_identical:
             intersect_t = intersect_t[
                 (intersect_t["onset" + suffixes[0]] !=
@@ -352,12 +485,14 @@ class PSDSEval:
             cross_t.inter_duration / cross_t.duration_gt
         return cross_t
 
-    def _detection_and_ground_truth_criteria(self, cross_t):
+    def _detection_and_ground_truth_criteria(self, cross_t, by=()):
         """Creates GTC and DTC detection sets
 
         Args:
             cross_t (pandas.DataFrame): A DataFrame containing detections and
                 their timings that intersect with the class's ground truths.
+            by (tuple): additional columns the sums are grouped by, e.g. the
+                operating point of every detection
 
         Returns:
             A tuple that contains two DataFrames. The first a table of
@@ -369,27 +504,28 @@ class PSDSEval:
         # Detections that intersect with the the ground truths
         gt_cross_t = cross_t[cross_t.same_cls]
 
+        by = list(by)
         # Group the duplicate detections and sum the det_precision
         if gt_cross_t.empty:
-            dtc_t = pd.DataFrame(columns=["id_det", "event_label_gt",
-                                          "det_precision"])
+            dtc_t = pd.DataFrame(columns=by + ["id_det", "event_label_gt",
+                                               "det_precision"])
         else:
             dtc_t = gt_cross_t.groupby(
-                ["id_det", "event_label_gt"]
+                by + ["id_det", "event_label_gt"]
             ).det_precision.sum().reset_index()
 
         dtc_ids = dtc_t[dtc_t.det_precision >= self.threshold.dtc].id_det
 
         # Group the duplicate detections that exist in the DTC set and sum
         gtc_t = gt_cross_t[gt_cross_t.id_det.isin(dtc_ids)].groupby(
-            ["id_gt", "event_label_det"]
+            by + ["id_gt", "event_label_det"]
         ).gt_coverage.sum().reset_index()
 
         # Join the two into a single true positive table
         if len(dtc_t) or len(gtc_t):
-            tmp = pd.merge(gt_cross_t, dtc_t, on=["id_det", "event_label_gt"],
+            tmp = pd.merge(gt_cross_t, dtc_t, on=by + ["id_det", "event_label_gt"],
                            suffixes=("", "_sum")
-                           ).merge(gtc_t, on=["id_gt", "event_label_det"],
+                           ).merge(gtc_t, on=by + ["id_gt", "event_label_det"],
                                    suffixes=("", "_sum"))
         else:
             cols = gt_cross_t.columns.to_list() + \
@@ -405,6 +541,8 @@ class PSDSEval:
 
         Compute the duration per class, and total duration for false
         positives."""
+        if self.prepared is not None:
+            return self.prepared.durations, self.prepared.dataset_duration
         t_filter = self.ground_truth.event_label == WORLD
         data_duration = self.ground_truth[t_filter].duration.sum()
         gt_durations = self.ground_truth.groupby("event_label").duration.sum()
@@ -414,6 +552,8 @@ class PSDSEval:
         """Compute event counts on the source data.
 
         Compute the number of events per class."""
+        if self.prepared is not None:
+            return self.prepared.counts
         gt_counts = self.ground_truth.groupby("event_label").filename.count()
         return gt_counts
 
@@ -590,6 +730,89 @@ class PSDSEval:
         self._add_op(opid=op_id, counts=cts, tpr=tp_ratio, fpr=fp_rate,
                      ctr=ct_rate, info=info)
 
+    def add_operating_points(self, detections, infos=None):
+        """Adds several Operating Points (OPs) into the evaluation at once
+
+        Same result as calling `add_operating_point` for every table in
+        turn, but the detections of all OPs (e.g. the outputs of one system
+        at every decision threshold) are evaluated in a single pass: one
+        intersection with the ground truth, and DTC/GTC/CTTC sums and counts
+        grouped by OP, instead of one pandas pipeline per OP. Every table is
+        still validated and hashed on its own (e.g. the tables of
+        `EventBuffer.to_dataframes`); the counts are not derived from raw
+        frame scores by a sweep over the thresholds.
+
+        Args:
+            detections (list of pandas.DataFrame): one table of system
+                detections per OP, with the columns "filename", "onset",
+                "offset", "event_label".
+            infos (list of dict): optional information of every OP, see
+                `add_operating_point`
+        Raises:
+            PSDSEvalError: If the PSDSEval ground_truth or metadata are unset.
+        """
+        if self.ground_truth is None:
+            raise PSDSEvalError("Ground Truth must be provided before "
+                                "adding the first operating point")
+        if self.metadata is None:
+            raise PSDSEvalError("Audio metadata must be provided before "
+                                "adding the first operating point")
+        if infos is None:
+            infos = [None] * len(detections)
+
+        # validate and prepare tables, skipping OPs seen before
+        det_ts, op_ids, op_infos = [], [], []
+        for detections_op, info in zip(detections, infos):
+            det_t = self._init_det_table(detections_op)
+            op_id = self._operating_point_id(det_t)
+            if not op_id or op_id in op_ids:
+                if op_id:
+                    warn("A similar operating point exists, skipping this one")
+                continue
+            det_ts.append(det_t.assign(op=len(op_ids)))
+            op_ids.append(op_id)
+            op_infos.append(info)
+        if len(det_ts) == 0:
+            return
+        rates = self._evaluate_operating_points(det_ts, key=tuple(op_ids))
+        for op_id, info, (cts, tp_ratio, fp_rate, ct_rate) in zip(op_ids, op_infos, rates):
+            self._add_op(opid=op_id, counts=cts, tpr=tp_ratio, fpr=fp_rate,
+                         ctr=ct_rate, info=info)
+
+    def _evaluate_operating_points(self, det_ts, key=None):
+        """`_evaluate_detections` of several initialised detection tables,
+        whose "op" column numbers them from 0, in a single pass. With a
+        `key` the intersections are kept in / taken from the prepared
+        ground truth.
+
+        Returns:
+            list of (counts, tp_ratio, fp_rate, ct_rate), one per table
+        """
+        cached = self.prepared.intersections
+        if key is not None and cached is not None and cached[0] == key:
+            # same detections evaluated in another scenario
+            inter_t = cached[1]
+        else:
+            det_t = pd.concat(det_ts, ignore_index=True)
+            # empty tables may carry object columns
+            det_t = det_t.astype({"onset": float, "offset": float, "duration": float})
+            det_t["id"] = det_t.index
+            inter_t = self._ground_truth_intersections(det_t, self.ground_truth)
+            if key is not None:
+                self.prepared.intersections = (key, inter_t)
+        tp, dtc_ids = self._detection_and_ground_truth_criteria(inter_t, by=("op",))
+        cttc = self._cross_trigger_criterion(inter_t, tp, dtc_ids)
+
+        # For the final detection count we must drop duplicates
+        cttc = cttc.drop_duplicates(["id_det", "event_label_gt"])
+        tp = tp.drop_duplicates(["op", "id_gt"])
+
+        tp_ops = dict(tuple(tp.groupby("op")))
+        cttc_ops = dict(tuple(cttc.groupby("op")))
+        return [self._confusion_matrix_and_rates(tp_ops.get(op, tp.iloc[:0]),
+                                                 cttc_ops.get(op, cttc.iloc[:0]))
+                for op in range(len(det_ts))]
+
     @staticmethod
     def _operating_points_table():
         """Returns and empty operating point table with the correct columns"""
@@ -733,44 +956,16 @@ class PSDSEval:
         fpr_points = np.unique(np.sort(pcr.fp_rate.flatten()))
         efpr_points = np.unique(np.sort(pcr.effective_fp_rate.flatten()))
         ctr_points = np.unique(np.sort(pcr.ct_rate.flatten()))
-        tpr_v_fpr = np.full((n_classes, fpr_points.size), np.nan)
-        tpr_v_efpr = np.full((n_classes, efpr_points.size), np.nan)
+        _curve = interp_curves if linear_interp else step_curves
+        tpr = pcr.tp_ratio[:n_classes]
+        tpr_v_fpr = batched_curves(_curve, fpr_points, pcr.fp_rate[:n_classes], tpr)
+        tpr_v_efpr = batched_curves(_curve, efpr_points, pcr.effective_fp_rate[:n_classes], tpr)
+        # every (c, k) pair with c != k, the tpr of class c against its ct rate on k
+        pairs = ~np.eye(n_classes, dtype=bool)
         tpr_v_ctr = np.full((n_classes, n_classes, ctr_points.size), np.nan)
-        _curve = self.perform_interp if linear_interp else self.step_curve
-        if g_parallel:
-            pass
-            q = Queue(100)
-            def helper_thread_fun():
-                with ProcessPoolExecutor(max_workers=10) as exe:
-
-                    for c in range(n_classes):
-                        q.put(exe.submit(roc_curve_one_item,c,fpr_points,efpr_points,ctr_points,pcr,n_classes,_curve))
-                    q.put(None)
-
-            helper_thread = threading.Thread(target=helper_thread_fun)
-            helper_thread.setDaemon(True)
-            helper_thread.start()
-
-
-            for future in iter(q.get,""):
-                if future is None:
-                    break
-                else:
-                    c,tpr_v_fpr_c,tpr_v_efpr_c,tpr_v_ctr_c=future.result()
-                    tpr_v_fpr[c] = tpr_v_fpr_c
-                    tpr_v_efpr[c] = tpr_v_efpr_c
-                    for k in range(n_classes):
-                        tpr_v_ctr[c,k] = tpr_v_ctr_c[k]
-        else:
-            for c in range(n_classes):
-                tpr_v_fpr[c] = _curve(fpr_points, pcr.fp_rate[c], pcr.tp_ratio[c])
-                tpr_v_efpr[c] = _curve(efpr_points, pcr.effective_fp_rate[c],
-                                    pcr.tp_ratio[c])
-                for k in range(n_classes):
-                    if c == k:
-                        continue
-                    tpr_v_ctr[c, k] = _curve(ctr_points, pcr.ct_rate[c, k],
-                                            pcr.tp_ratio[c])
+        tpr_v_ctr[pairs] = batched_curves(
+            _curve, ctr_points, pcr.ct_rate[:n_classes, :n_classes][pairs],
+            np.broadcast_to(tpr[:, None], pcr.ct_rate[:n_classes, :n_classes].shape)[pairs])
 
         tpr_vs_fpr_c = PSDROC(
             yp=tpr_v_fpr, xp=fpr_points,
@@ -1,6 +1,7 @@
 from pytorch_lightning import LightningModule
 from transformers.optimization import AdamW, get_cosine_schedule_with_warmup
-from audiossl.utils.common import cosine_scheduler_step,get_params_groups
+from audiossl.utils.common import cosine_scheduler_step,get_params_groups,EMAUpdater
+from itertools import chain
 from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
 from torch import nn
 from audiossl.methods.atstframe.audio_transformer import FrameAST_small,FrameAST_base
@@ -64,23 +65,23 @@ class FrameATST(nn.Module):
             self.teacher.load_state_dict({k:v for k,v in self.student.state_dict().items() if "projector" not in k })
 
         self.loss_fn = ByolLoss(symmetric=symmetric)
+        self.ema_updater = EMAUpdater(chain(zip(self.student.encoder.parameters(), self.teacher.encoder.parameters()),
+                                            zip(self.student.projector.parameters(), self.teacher.projector.parameters())))
     
     def forward(self,x,length,mask):
         if self.symmetric:
-            tea = self.teacher(x,length,mask,False)
+            with torch.no_grad():
+                tea = self.teacher(x,length,mask,False)
             stu = self.student(x,length,mask,True)
             return self.loss_fn(stu,tea)
         else:
-            tea = self.teacher(x[:1],length[:1],mask[:1],False)
+            with torch.no_grad():
+                tea = self.teacher(x[:1],length[:1],mask[:1],False)
             stu = self.student(x[1:],length[1:],mask[1:],True)
             return self.loss_fn(stu,tea)
 
     def update_teacher(self,m):
-        with torch.no_grad():
-            for param_q, param_k in zip(self.student.encoder.parameters(), self.teacher.encoder.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
-            for param_q, param_k in zip(self.student.projector.parameters(), self.teacher.projector.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
+        self.ema_updater(m)
     def _init_teacher(self):
         self.teacher.load_state_dict({k:v for k,v in self.student.state_dict().items() if "predictor" not in k })
         
@@ -98,6 +99,8 @@ class FrameATSTLightningModule(LightningModule):
                  pos_type="cut",
                  avg_blocks=0,
                  patch_embed="Linear",
+                 grad_checkpointing="none",
+                 checkpoint_every=1,
                  **kwargs,
                  ):
         super().__init__()
@@ -107,6 +110,8 @@ class FrameATSTLightningModule(LightningModule):
                                avg_blocks=avg_blocks,
                                patch_embed=patch_embed,
                                **kwargs)
+        # the teacher runs under no_grad, only the student needs checkpointing
+        self.model.student.encoder.set_grad_checkpointing(grad_checkpointing,checkpoint_every)
         self.learning_rate = learning_rate 
         self.warmup_steps =  warmup_steps
         self.max_steps = max_steps
@@ -163,4 +168,6 @@ class FrameATSTLightningModule(LightningModule):
         parser.add_argument('--pos_type',default="cut",type=str,help="\"cut\" denotes absolute psitional embedding, \"interpolate\" denotes 2D positional embedding used in SSAST")
         parser.add_argument('--avg_blocks',default=0,type=int,help="0 means atst-frame, a positive int value means data2vec style loss")
         parser.add_argument('--patch_embed',default="Linear",type=str,help="Linear or CNN patch embedding")
+        parser.add_argument('--grad_checkpointing',default="none",type=str,help="activation checkpointing of student transformer blocks: none, block or attn")
+        parser.add_argument('--checkpoint_every',default=1,type=int,help="checkpoint every k-th transformer block")
         return parent_parser
\ No newline at end of file
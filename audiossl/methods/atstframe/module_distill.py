@@ -4,7 +4,7 @@ from audiossl.models.atst.audio_transformer import AST_base, AST_small
 from audiossl.methods.atstframe.audio_transformer import FrameAST_base
 import argparse
 import torch
-from audiossl.utils.common import cosine_scheduler_step,get_params_groups
+from audiossl.utils.common import cosine_scheduler_step,get_params_groups,merge_param_groups,optimizer_impl_kwargs
 from transformers.optimization import AdamW, get_cosine_schedule_with_warmup
 import torch.distributed as dist
 
@@ -20,8 +20,9 @@ random.seed(1234)
 from audiossl.transforms.byol_a import Mixup, RandomResizeCrop
 from audiossl.methods.atstframe.byol import build_mlp
 from audiossl.methods.atst.downstream.utils import Metric
-from torch.utils.data import WeightedRandomSampler
+from torch.utils.data import Dataset, WeightedRandomSampler
 from audiossl.lightning.datamodules import DistributedSamplerWrapper
+from audiossl.lightning.teacher_cache import dataset_keys, load_view
 import os
 
 from audiossl.methods.atst.downstream.model import PretrainedEncoderPLModule as ClipEncoder
@@ -56,6 +57,21 @@ class DistillATSTTrainTransform:
         return output,output.shape[-1]
     
 
+def mixup_spec(x, x_, l):
+    """x*l + x_*(1-l), the shorter spectrogram mixed into a random segment of the longer one"""
+    if x.shape[-1] == x_.shape[-1]:
+        x_mix = x*l + x_*(1-l)
+    elif x.shape[-1] > x_.shape[-1]:
+        start = np.random.randint(0,x.shape[-1] - x_.shape[-1])
+        x_mix = x.clone()
+
+        x_mix[:,:,start:start+x_.shape[-1]] = x[:,:,start:start+x_.shape[-1]]*l + x_*(1-l)
+    else:
+        start = np.random.randint(0,x_.shape[-1] - x.shape[-1])
+
+        x_mix= x*l + x_[:,:,start:start+x.shape[-1]]*(1-l)
+    return x_mix
+
 class MixupSpecLabelAudioset:
     def __init__(self,dataset,mixup_ratio=0.5,alpha=10,num_classes=527):
         self.dataset = dataset
@@ -82,17 +98,7 @@ class MixupSpecLabelAudioset:
             index = np.random.randint(len(self.dataset))
             (x_,_),y_ = self.dataset[index]
             y_=convert_label(y_)
-            if x.shape[-1] == x_.shape[-1]:
-                x_mix = x*l + x_*(1-l)
-            elif x.shape[-1] > x_.shape[-1]:
-                start = np.random.randint(0,x.shape[-1] - x_.shape[-1])
-                x_mix = x.clone()
-
-                x_mix[:,:,start:start+x_.shape[-1]] = x[:,:,start:start+x_.shape[-1]]*l + x_*(1-l)
-            else:
-                start = np.random.randint(0,x_.shape[-1] - x.shape[-1])
-
-                x_mix= x*l + x_[:,:,start:start+x.shape[-1]]*(1-l)
+            x_mix = mixup_spec(x, x_, l)
             y_mix = y*l +y_ * (1-l)
         else:
             x_mix=x
@@ -114,6 +120,43 @@ class DistllATSTTargetTransform:
         return x,y
 
 
+class CachedTeacherDataset(Dataset):
+    """Training set of DistillLightningModule with the teacher outputs read
+    from a TeacherCache instead of running the teacher every step.
+
+    Every item is a random cached view of a clip (0: un-augmented, k > 0:
+    seeded RandomResizeCrop), mixed up with a random view of a random partner
+    clip. Spectrograms, labels and teacher probabilities are mixed with the
+    same weight, and the mixed probabilities are returned as logits like the
+    output of the teacher: ((x, length), y, teacher_logits).
+    """
+    def __init__(self, dataset, cache, mixup_ratio=0.5, alpha=10):
+        self.dataset = dataset
+        self.cache = cache
+        self.keys = dataset_keys(dataset)
+        self.mixup_ratio = mixup_ratio
+        self.alpha = alpha
+        self.rrc = RandomResizeCrop()
+
+    def view(self, index):
+        view = np.random.randint(self.cache.num_views)
+        (x, length), y = load_view(self.dataset, index, self.keys[index], view, self.rrc)
+        target = self.cache.get([self.keys[index]], view)[0].sigmoid()
+        return x, length, y.float(), target
+
+    def __getitem__(self, index):
+        x, length, y, target = self.view(index)
+        if np.random.random() < self.mixup_ratio:
+            l = float(np.random.beta(self.alpha,self.alpha))
+            x_, _, y_, target_ = self.view(np.random.randint(len(self.dataset)))
+            x = mixup_spec(x, x_, l)
+            y = y*l + y_*(1-l)
+            target = target*l + target_*(1-l)
+        return (x.to(torch.float), length), y, torch.logit(target, eps=1e-6)
+
+    def __len__(self):
+        return len(self.dataset)
+
 
 def bool_flag(s):
     """
@@ -155,8 +198,12 @@ class Distill(nn.Module):
             self.project_linear = LinearHead(768,527,use_norm=True, affine=False)
         self.linear = LinearHead(768,527,use_norm=True, affine=False)
     def forward(self,batch):
-        target,_ = self.teacher(batch)
-        (x, lengths), y = batch
+        if len(batch) == 3:
+            # teacher outputs read from a TeacherCache
+            (x, lengths), y, target = batch
+        else:
+            target,_ = self.teacher(batch)
+            (x, lengths), y = batch
         pred = self.student.get_intermediate_layers(x,lengths,n=1,scene=True)
         return pred,target,y
 
@@ -200,7 +247,7 @@ def layer_wise_lr_groups(model):
         else:
             print("missed",name)
     print("=====complete==========")
-    return groups
+    return merge_param_groups(groups)
 
 class DistillLightningModule(LightningModule):
     def __init__(self,
@@ -227,7 +274,6 @@ class DistillLightningModule(LightningModule):
         return self.model(x)
     def training_step(self,batch,batch_idx):
         self.schedule()
-        (melspecs,lengths),y = batch
         pred,target,_=self.model(batch)
 
         pred_sup = self.model.linear(pred)
@@ -290,11 +336,12 @@ class DistillLightningModule(LightningModule):
         self.log("test_map",metric,prog_bar=True,logger=True)
 
     def configure_optimizers(self):
-        optimizer = torch.optim.SGD(layer_wise_lr_groups( self),
+        params = layer_wise_lr_groups(self)
+        optimizer = torch.optim.SGD(params,
                                     self.learning_rate,
                                     momentum=0.9,
                                     weight_decay=0,
-                                        )
+                                    **optimizer_impl_kwargs(torch.optim.SGD, params))
 
         return [optimizer]
 
@@ -326,6 +373,7 @@ class DistillATSTDataModule(LightningDataModule):
                  batch_size_per_gpu=256,
                  num_workers=10,
                  subset=200000,
+                 teacher_cache=None,
                  **kwargs,
                  ):
         super().__init__()
@@ -340,6 +388,9 @@ class DistillATSTDataModule(LightningDataModule):
                                  subset=subset,
                                  transform=DistillATSTTrainTransform())
         _dataset = ConcatDataset([_dataset_ub,_dataset_b])
+        # un-augmented training set, also the source of the teacher cache
+        self.clean_dataset = _dataset
+        self.teacher_cache = teacher_cache
         
         dataset_ub=LMDBDataset(data_path,
                                  split="train",
@@ -363,7 +414,7 @@ class DistillATSTDataModule(LightningDataModule):
         self.sampler = WeightedRandomSampler(weights, len(weights))
         self.batch_size=batch_size_per_gpu
         self.num_workers=num_workers
-        self.save_hyperparameters()
+        self.save_hyperparameters(ignore=["teacher_cache"])
     
 
     def train_dataloader(self):
@@ -373,7 +424,10 @@ class DistillATSTDataModule(LightningDataModule):
             rank = dist.get_rank()
             np.random.seed((id + rank +  np.random.get_state()[1][0])%(2**32))
 
-        return data.DataLoader(self.dataset,
+        dataset = self.dataset
+        if self.teacher_cache is not None:
+            dataset = CachedTeacherDataset(self.clean_dataset, self.teacher_cache)
+        return data.DataLoader(dataset,
                                batch_size=self.batch_size,
                                num_workers=self.num_workers,
                                shuffle=False,
@@ -402,6 +456,10 @@ class DistillATSTDataModule(LightningDataModule):
             help='Per-GPU batch-size : number of distinct samples loaded on one GPU.')
         parser.add_argument('--num_workers', default=10, type=int, help='Number of data loading workers per GPU.')
         parser.add_argument('--subset', default=3000000, type=int, help='subset of training data')
+        parser.add_argument('--teacher_cache_dir', default=None, type=str,
+            help='read the teacher outputs from this cache (built on first use) instead of running the teacher every step')
+        parser.add_argument('--teacher_cache_views', default=0, type=int,
+            help='number of cached RandomResizeCrop views per clip besides the un-augmented one')
 
         return parent_parser
 
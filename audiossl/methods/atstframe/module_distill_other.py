@@ -4,7 +4,7 @@ from audiossl.models.atst.audio_transformer import AST_base, AST_small
 from audiossl.methods.atstframe.audio_transformer import FrameAST_base
 import argparse
 import torch
-from audiossl.utils.common import cosine_scheduler_epoch,get_params_groups
+from audiossl.utils.common import cosine_scheduler_epoch,get_params_groups,merge_param_groups,optimizer_impl_kwargs
 from transformers.optimization import AdamW, get_cosine_schedule_with_warmup
 import torch.distributed as dist
 
@@ -252,7 +252,7 @@ def layer_wise_lr_groups(model):
         else:
             print("missed",name)
     print("=====complete==========")
-    return groups
+    return merge_param_groups(groups)
 
 class DistillLightningModule(LightningModule):
     def __init__(self,
@@ -391,11 +391,12 @@ class DistillLightningModule(LightningModule):
         self.log("test_"+self.metric.mode,metric,prog_bar=True,logger=True)
 
     def configure_optimizers(self):
-        optimizer = torch.optim.SGD(layer_wise_lr_groups( self),
+        params = layer_wise_lr_groups(self)
+        optimizer = torch.optim.SGD(params,
                                     self.learning_rate,
                                     momentum=0.9,
                                     weight_decay=0,
-                                        )
+                                    **optimizer_impl_kwargs(torch.optim.SGD, params))
 
         return [optimizer]
 
@@ -0,0 +1,79 @@
+"""Parity check of mixed precision pretraining against fp32.
+
+Runs a few optimization steps of FrameATST and ATST on random spectrograms on CPU,
+once in fp32 and once under bf16 autocast, starting from the same weights, and
+compares the losses and std statistics.
+
+    python precision_parity.py --steps 5
+"""
+import copy
+from argparse import ArgumentParser
+
+import torch
+from audiossl.methods.atstframe.model import FrameATST
+from audiossl.models.atst import ATST
+
+
+def frame_atst_batch(batch_size, n_frames, mask_ratio=0.65):
+    x = [torch.randn(batch_size, 1, 64, n_frames) for _ in range(2)]
+    length = [torch.full((batch_size,), n_frames) for _ in range(2)]
+    mask = [torch.rand(batch_size, n_frames // 4) < mask_ratio for _ in range(2)]
+    return x, length, mask
+
+
+def atst_batch(batch_size, n_frames):
+    x = [torch.randn(batch_size, 1, 64, n_frames) for _ in range(2)]
+    length = [torch.full((batch_size,), n_frames) for _ in range(2)]
+    return x, length
+
+
+def run(model, batches, autocast, lr, ema):
+    # same dropout / drop path draws in both runs
+    torch.manual_seed(1)
+    optimizer = torch.optim.AdamW([p for p in model.student.parameters() if p.requires_grad], lr=lr)
+    history = []
+    for batch in batches:
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=autocast):
+            loss, std_s, std_t = model(*batch)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        model.update_teacher(ema)
+        history.append((loss.item(), std_s.item(), std_t.item()))
+    return history
+
+
+def compare(name, model, batches, args):
+    fp32 = run(copy.deepcopy(model), batches, False, args.lr, args.ema)
+    bf16 = run(copy.deepcopy(model), batches, True, args.lr, args.ema)
+    max_rel = 0.
+    print("==={}===".format(name))
+    for step, (a, b) in enumerate(zip(fp32, bf16)):
+        rel = [abs(x - y) / (abs(x) + 1e-6) for x, y in zip(a, b)]
+        max_rel = max(max_rel, max(rel))
+        print("step {} fp32 loss {:.5f} std_s {:.5f} std_t {:.5f} | bf16 loss {:.5f} std_s {:.5f} std_t {:.5f}".format(
+            step, *a, *b))
+    print("max relative difference {:.4f}".format(max_rel))
+    assert max_rel < args.tol, "{}: bf16 deviates from fp32 by {:.4f} (> {})".format(name, max_rel, args.tol)
+
+
+def main():
+    parser = ArgumentParser("PrecisionParity")
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--n_frames", type=int, default=160)
+    parser.add_argument("--lr", type=float, default=5e-5)
+    parser.add_argument("--ema", type=float, default=0.99)
+    parser.add_argument("--tol", type=float, default=5e-2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    batches = [frame_atst_batch(args.batch_size, args.n_frames) for _ in range(args.steps)]
+    compare("FrameATST", FrameATST(arch="small"), batches, args)
+
+    batches = [atst_batch(args.batch_size, args.n_frames) for _ in range(args.steps)]
+    compare("ATST", ATST(arch="small"), batches, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,7 @@ def main(args):
                             sync_batchnorm=True,
                             accelerator="gpu",
                             devices=args.nproc,
-                            #precision=16,
+                            precision=args.precision,
                             max_steps=args.max_steps,
                             logger=[logger_tb],#,logger_wb],
                             callbacks=[ModelCheckpoint(dirpath=args.save_path,
@@ -45,6 +45,8 @@ if __name__ == "__main__":
 
     parser.add_argument("--save_path",type=str)
     parser.add_argument('--nproc', type=int,  default=2)
+    parser.add_argument('--precision', type=str, default="32",
+                        help="\"32\", \"16-mixed\" or \"bf16-mixed\"; mixed modes keep fp32 master weights and compute the loss in fp32")
     parser.add_argument('--patch_h', type=int,  default=64)
     parser.add_argument('--patch_w', type=int,  default=4)
     parser = FrameATSTLightningModule.add_model_specific_args(parser)
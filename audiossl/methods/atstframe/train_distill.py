@@ -3,6 +3,8 @@ from audiossl.methods.atstframe.model import FrameATSTLightningModule
 from audiossl.methods.atst.downstream.train_freeze import get_pretraied_encoder
 from argparse import ArgumentParser
 from audiossl.methods.atstframe.module_distill import DistillATSTDataModule,DistillLightningModule
+from audiossl.lightning.teacher_cache import TeacherCache
+from audiossl.transforms.byol_a import RandomResizeCrop
 from pytorch_lightning.callbacks import LearningRateMonitor,ModelCheckpoint
 from pytorch_lightning import Trainer
 from pytorch_lightning.loggers import TensorBoardLogger,WandbLogger
@@ -53,7 +55,17 @@ if __name__ == "__main__":
     for n,p in model.model.teacher.named_parameters():
         p.requires_grad = False
 
-    data = DistillATSTDataModule(**dict_args)
+    teacher_cache = TeacherCache(args.teacher_cache_dir) if args.teacher_cache_dir is not None else None
+    data = DistillATSTDataModule(**dict_args, teacher_cache=teacher_cache)
+    if teacher_cache is not None and not teacher_cache.exists():
+        # run the frozen teacher once per clip and view
+        teacher_cache.build(model.model.teacher,
+                            data.clean_dataset,
+                            num_views=1+args.teacher_cache_views,
+                            augment=RandomResizeCrop(),
+                            batch_size=args.batch_size_per_gpu,
+                            num_workers=args.num_workers,
+                            nproc=args.nproc)
     trainer:Trainer = Trainer(
                             strategy="ddp_find_unused_parameters_true",
                             sync_batchnorm=True,
@@ -2,6 +2,8 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from itertools import chain
+from audiossl.utils.common import EMAUpdater
 
 def build_mlp(num_layers, input_dim, mlp_dim, output_dim, last_bn=True):
     mlp = []
@@ -296,6 +298,8 @@ class Byol(nn.Module):
         for param_q, param_k in zip(self.head_q.parameters(), self.head_k.parameters()):
             param_k.data.copy_(param_q.data)  # initialize
             param_k.requires_grad = False  # not update by gradient
+        self.ema_updater = EMAUpdater(chain(zip(self.encoder_q.parameters(), self.encoder_k.parameters()),
+                                            zip(self.head_q.parameters(), self.head_k.parameters())))
 
 
     def _build_mlp(self, num_layers, input_dim, mlp_dim, output_dim, last_bn=True):
@@ -321,10 +325,7 @@ class Byol(nn.Module):
         """
         Momentum update of the key encoder
         """
-        for param_q, param_k in zip(self.encoder_q.parameters(), self.encoder_k.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-        for param_q, param_k in zip(self.head_q.parameters(), self.head_k.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
+        self.ema_updater(self.m)
 
     @torch.no_grad()
     def _batch_shuffle_ddp(self, x):
@@ -1,12 +1,18 @@
 
 import torch
 from torch import nn
-from audiossl.modules.transformer import Block
+from audiossl.modules.transformer import Block,set_grad_checkpointing
+from audiossl.modules.token_merging import tome_schedule,init_token_size,size_to_attention_mask,merge_tokens
 from torch.nn import functional as F
 from functools import partial
 import time
 import warnings
 import math
+from collections import OrderedDict
+
+# interpolated position tables kept per model
+POS_CACHE_SIZE = 8
+
 
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
     # Cut & paste from PyTorch official master until it's in a few official releases - RW
@@ -103,6 +109,7 @@ class AST(nn.Module):
         self.pos_drop = nn.Dropout(p=drop_rate)
         self.mask_ratio = mask_ratio
         self.pos_type = pos_type
+        self._pos_cache = OrderedDict()
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
         self.blocks = nn.ModuleList([
@@ -128,7 +135,28 @@ class AST(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def set_grad_checkpointing(self, policy="block", every=1):
+        set_grad_checkpointing(self.blocks, policy, every)
+
     def interpolate_pos_encoding(self, x, h, w):
+        # the interpolated table only depends on the input size and on the value
+        # of pos_embed, so it is reused until the parameter is updated in place
+        # (optimizer step, load_state_dict) or moved. Results that are part of
+        # an autograd graph are never cached.
+        if torch.is_grad_enabled() and self.pos_embed.requires_grad:
+            return self._interpolate_pos_encoding(x, h, w)
+        key = (h, w, self.pos_embed._version, self.pos_embed.data_ptr(), self.pos_embed.device, self.pos_embed.dtype)
+        if key in self._pos_cache:
+            self._pos_cache.move_to_end(key)
+        else:
+            self._pos_cache = OrderedDict((k, v) for k, v in self._pos_cache.items() if k[2:] == key[2:])
+            self._pos_cache[key] = self._interpolate_pos_encoding(x, h, w)
+            # variable length inputs give one table per width, keep the recent ones
+            if len(self._pos_cache) > POS_CACHE_SIZE:
+                self._pos_cache.popitem(last=False)
+        return self._pos_cache[key]
+
+    def _interpolate_pos_encoding(self, x, h, w):
         npatch = x.shape[1] - 1
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == self.spec_w and h == self.spec_h:
@@ -253,8 +281,28 @@ class AST(nn.Module):
             if len(self.blocks) - i <= n:
                 output.append(self.norm(x_))
         return output
-        
-    def get_intermediate_layers_chunks(self, x,length, n=1,  chunk_len=601, avgpool=True):
+
+    def get_intermediate_layers_tome(self, x, length, n=1, r=0):
+        """Same as `get_intermediate_layers` but merges `r` similar tokens after every
+        block (ToMe). The token count shrinks with depth, so the size (number of
+        original patches) of every token is returned along with each output.
+        Meant for inference / embedding extraction only.
+        """
+        x,_,_,_,_,patch_length = self.prepare_tokens(x,mask_index=None,length=length,mask=False)
+        size = init_token_size(x,patch_length,self.use_cls)
+        schedule = tome_schedule(r,len(self.blocks))
+        output = []
+        sizes = []
+        for i, blk in enumerate(self.blocks):
+            x = blk(x,attn_mask=size_to_attention_mask(size))
+            if len(self.blocks) - i <= n:
+                output.append(self.norm(x))
+                sizes.append(size)
+            if schedule[i] > 0:
+                x,size = merge_tokens(x,size,schedule[i],protect_first=self.use_cls)
+        return output,sizes
+
+    def get_intermediate_layers_chunks(self, x,length, n=1,  chunk_len=601, avgpool=True, tome_r=0):
         total_len = x.shape[-1]
         num_chunks = total_len // chunk_len + 1
         cls = []
@@ -271,6 +319,13 @@ class AST(nn.Module):
             if end > total_len:
                 end = total_len
             x_chunk=x[:,:,:,start:end]
+            if tome_r != 0:
+                output_i,sizes_i = self.get_intermediate_layers_tome(x_chunk,cur_len,n,tome_r)
+                cls_,avg_=get_cls_avg_tome(output_i,sizes_i,self.use_cls)
+                cls.append(cls_)
+                avg.append(avg_)
+                chunk_mark.append([chunk_mark_]*n)
+                continue
             x_chunk,_,_,_,_,patch_length = self.prepare_tokens(x_chunk,mask_index=None,length=cur_len,mask=False)
             # we return the output tokens from the `n` last blocks
             output_i = []
@@ -364,6 +419,18 @@ def get_cls_avg(output_i,cur_len,use_cls):
         cls = [torch.zeros_like(x[:,0]) for x in output_i]
         avg = [torch.sum(x*length_mask.unsqueeze(-1),dim=1)/(cur_len.unsqueeze(1)+1e-6) for x in output_i]
     return cls,avg
+
+def get_cls_avg_tome(output_i,sizes_i,use_cls):
+    # merged tokens are averaged weighted by their size, which equals the
+    # length-masked mean of `get_cls_avg` when nothing has been merged
+    if use_cls:
+        cls = [x[:,0] for x in output_i]
+        avg = [torch.sum(x[:,1:]*s[:,1:].unsqueeze(-1),dim=1)/(torch.sum(s[:,1:],dim=1,keepdim=True)+1e-6) for x,s in zip(output_i,sizes_i)]
+    else:
+        cls = [torch.zeros_like(x[:,0]) for x in output_i]
+        avg = [torch.sum(x*s.unsqueeze(-1),dim=1)/(torch.sum(s,dim=1,keepdim=True)+1e-6) for x,s in zip(output_i,sizes_i)]
+    return cls,avg
+
 def AST_small(patch_h=64,patch_w=4,**kwargs):
     return AST(patch_h=patch_h,patch_w=patch_w,embed_dim=384,depth=12,num_heads=6,qkv_bias=False,norm_layer=partial(nn.LayerNorm, eps=1e-6),**kwargs)
 
@@ -41,13 +41,14 @@ def byol_loss_func(p: torch.Tensor, z: torch.Tensor, simplified: bool = True) :
     return 2 - 2 * (p * z).sum(dim=1).mean()
 def compute_var(y):
         y = y.view(-1, y.size(-1))
-        zc = torch.tensor(y.size(0)).cuda()
+        zc = torch.tensor(y.size(0),device=y.device)
         zs = y.sum(dim=0)
         zss = (y ** 2).sum(dim=0)
 
-        torch.distributed.all_reduce(zc)
-        torch.distributed.all_reduce(zs)
-        torch.distributed.all_reduce(zss)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(zc)
+            torch.distributed.all_reduce(zs)
+            torch.distributed.all_reduce(zss)
 
         var = zss / (zc - 1) - (zs ** 2) / (zc * (zc - 1))
         return torch.sqrt(var + 1e-6)
@@ -59,6 +60,12 @@ class ByolLoss(nn.Module):
         super().__init__()
         self.ncrops=ncrops
     def forward(self,student,teacher):
+        # normalization, std statistics and the loss are always computed in fp32,
+        # also when the encoders run under autocast (mixed precision training)
+        with torch.autocast(device_type=student.device.type,enabled=False):
+            return self._forward(student.float(),teacher.float())
+
+    def _forward(self,student,teacher):
         std_cls_s=compute_var(F.normalize(student,dim=-1)).mean()
         std_cls_t=compute_var(F.normalize(teacher,dim=-1)).mean()
         student = student.chunk(self.ncrops)
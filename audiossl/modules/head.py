@@ -69,6 +69,57 @@ class LinearHead(nn.Module):
         # linear layer
         return self.linear(x)
 
+class MultiLinearHead(nn.Module):
+    """K independent LinearHeads (BatchNorm without affine + linear) evaluated
+    with one batched matmul.
+
+    Every head keeps its own BatchNorm statistics, computed over the samples
+    it is trained on (``weights``), and only sees the input features selected
+    by its row of ``feature_masks``. The normalization is folded into the
+    linear weights, so no [K, B, dim] tensor is materialized.
+    Output is [K, B, num_labels].
+    """
+    def __init__(self, dim, num_labels, num_heads, feature_masks=None, momentum=0.1, eps=1e-5):
+        super().__init__()
+        self.num_labels = num_labels
+        self.num_heads = num_heads
+        self.momentum = momentum
+        self.eps = eps
+        self.weight = nn.Parameter(torch.empty(num_heads, num_labels, dim).normal_(mean=0.0, std=0.01))
+        self.bias = nn.Parameter(torch.zeros(num_heads, num_labels))
+        self.register_buffer("running_mean", torch.zeros(num_heads, dim))
+        self.register_buffer("running_var", torch.ones(num_heads, dim))
+        if feature_masks is None:
+            feature_masks = torch.ones(num_heads, dim)
+        self.register_buffer("feature_masks", feature_masks.float())
+
+    def _batch_stats(self, x, weights):
+        n = weights.sum(0)
+        # shift by the batch mean before E[x^2]-E[x]^2 to avoid cancellation
+        shift = x.mean(0)
+        xs = x - shift
+        mean = weights.t() @ xs / n.clamp(min=1).unsqueeze(1)
+        var = (weights.t() @ (xs * xs) / n.clamp(min=1).unsqueeze(1) - mean ** 2).clamp(min=0)
+        with torch.no_grad():
+            # heads with less than 2 samples in this batch keep their running stats
+            m = self.momentum * (n > 1).to(x.dtype).unsqueeze(1)
+            unbiased = var * (n / (n - 1).clamp(min=1)).unsqueeze(1)
+            self.running_mean.lerp_(mean + shift, m)
+            self.running_var.lerp_(unbiased, m)
+        return mean + shift, var
+
+    def forward(self, x, weights=None):
+        if self.training:
+            if weights is None:
+                weights = torch.ones(x.shape[0], self.num_heads, device=x.device, dtype=x.dtype)
+            mean, var = self._batch_stats(x, weights.to(x.dtype))
+        else:
+            mean, var = self.running_mean, self.running_var
+        scale = (var + self.eps).rsqrt() * self.feature_masks
+        weight = self.weight * scale.unsqueeze(1)
+        bias = self.bias - (weight * mean.unsqueeze(1)).sum(-1)
+        return torch.einsum("bd,kcd->kbc", x, weight) + bias.unsqueeze(1)
+
 class AttentionHead(nn.Module):
     def __init__(self,dim,att_dim,num_heads,num_labels):
         super().__init__()
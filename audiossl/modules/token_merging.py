@@ -0,0 +1,96 @@
+
+import math
+import torch
+
+
+def tome_schedule(r, depth):
+    """Number of tokens to merge after each block.
+
+    ``r`` is either a constant (merged after every block but the last) or a
+    list with one entry per block.
+    """
+    if isinstance(r, (list, tuple)):
+        assert len(r) == depth, "tome schedule needs {} entries, got {}".format(depth, len(r))
+        return list(r)
+    return [r] * (depth - 1) + [0]
+
+
+def init_token_size(x, patch_length, use_cls):
+    """Number of original patches each token stands for; padded patches count 0."""
+    B, N, _ = x.shape
+    if patch_length is None:
+        return torch.ones(B, N, device=x.device, dtype=x.dtype)
+    n_patch = N - 1 if use_cls else N
+    size = (torch.arange(n_patch, device=x.device) < patch_length.unsqueeze(1).to(x.device)).to(x.dtype)
+    if use_cls:
+        size = torch.cat([torch.ones_like(size[:, :1]), size], dim=1)
+    return size
+
+
+def size_to_attention_mask(size):
+    """Proportional attention: add log(size) to the logits, padded tokens (size 0)
+    get the same -10000 used by ``get_attention_mask``. With every size equal to
+    1 this is identical to the plain length mask."""
+    mask = torch.where(size > 0, size.clamp(min=1e-6).log(), torch.full_like(size, -10000.0))
+    return mask[:, None, None, :]
+
+
+def bipartite_soft_matching(metric, size, r, protect_first=True):
+    """ToMe bipartite matching (Bolya et al., 2023) with length awareness.
+
+    Tokens are split into alternating sets A and B, each A token is matched to
+    its most similar B token and the ``r`` best matches are merged. Padded A
+    tokens are always merged first (they carry no content), real tokens are
+    never merged into padded ones and the first token (CLS) is kept if
+    ``protect_first`` is set.
+
+    Returns a ``merge(x, size)`` function applying the same reduction.
+    """
+    N = metric.shape[1]
+    r = min(r, (N - int(protect_first)) // 2)
+    if r <= 0:
+        return lambda x, size: (x, size)
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True).clamp(min=1e-6)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)
+
+        size_a, size_b = size[:, ::2], size[:, 1::2]
+        scores.masked_fill_((size_b == 0).unsqueeze(1), -math.inf)
+        node_max, node_idx = scores.max(dim=-1)
+        node_max.masked_fill_(size_a == 0, math.inf)
+        if protect_first:
+            node_max[:, 0] = -math.inf
+
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:].sort(dim=1)[0]
+        src_idx = edge_idx[:, :r]
+        dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+
+    def merge(x, size):
+        B, _, C = x.shape
+        x = x * size.unsqueeze(-1)
+        src, dst = x[:, ::2], x[:, 1::2]
+        n_a = src.shape[1]
+        unm = src.gather(dim=1, index=unm_idx.expand(B, n_a - r, C))
+        src = src.gather(dim=1, index=src_idx.expand(B, r, C))
+        dst = dst.scatter_reduce(1, dst_idx.expand(B, r, C), src, reduce="sum")
+
+        size = size.unsqueeze(-1)
+        size_src, size_dst = size[:, ::2], size[:, 1::2]
+        size_unm = size_src.gather(dim=1, index=unm_idx)
+        size_src = size_src.gather(dim=1, index=src_idx)
+        size_dst = size_dst.scatter_reduce(1, dst_idx, size_src, reduce="sum")
+
+        x = torch.cat([unm, dst], dim=1)
+        size = torch.cat([size_unm, size_dst], dim=1)
+        x = x / size.clamp(min=1e-6)
+        return x, size.squeeze(-1)
+
+    return merge
+
+
+def merge_tokens(x, size, r, protect_first=True):
+    merge = bipartite_soft_matching(x, size, r, protect_first)
+    return merge(x, size)
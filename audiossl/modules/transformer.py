@@ -1,6 +1,7 @@
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 def drop_path(x, drop_prob: float = 0., training: bool = False):
@@ -84,16 +85,34 @@ class Block(nn.Module):
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
+        # activation checkpointing: None, "block" or "attn", see set_grad_checkpointing
+        self.grad_checkpointing = None
 
-    def forward(self, x, length=None, return_attention=False):
+    def forward(self, x, length=None, return_attention=False, attn_mask=None):
 
 
-        if length is not None:
+        if attn_mask is not None:
+            mask_att = attn_mask
+        elif length is not None:
             mask_att = get_attention_mask(x,length)
         else:
             mask_att = None
 
-        y, attn = self.attn(self.norm1(x),mask_att)
+        # checkpoint() restores the RNG state before recomputing, so dropout and
+        # DropPath draw the same masks in the forward and the recomputation
+        use_checkpoint = self.grad_checkpointing is not None and torch.is_grad_enabled() and not return_attention
+        if use_checkpoint and self.grad_checkpointing == "block":
+            return checkpoint(self._forward, x, mask_att, False, use_reentrant=False)
+        return self._forward(x, mask_att, use_checkpoint and self.grad_checkpointing == "attn", return_attention)
+
+    def _attention(self, x, mask_att):
+        return self.attn(self.norm1(x),mask_att)
+
+    def _forward(self, x, mask_att, checkpoint_attn=False, return_attention=False):
+        if checkpoint_attn:
+            y, attn = checkpoint(self._attention, x, mask_att, use_reentrant=False)
+        else:
+            y, attn = self._attention(x, mask_att)
         x = x + self.drop_path(y)
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         if return_attention:
@@ -101,6 +120,21 @@ class Block(nn.Module):
         else:
             return x
 
+def set_grad_checkpointing(model, policy="block", every=1):
+    """Enable activation checkpointing on the transformer `Block`s of `model`.
+
+    policy: "none", "block" (recompute the whole block) or "attn" (recompute
+            only the attention branch)
+    every:  checkpoint every `every`-th block, counting from the first one
+    """
+    assert policy in ["none","block","attn"], "unknown checkpointing policy {}".format(policy)
+    blocks = [m for m in model.modules() if isinstance(m, Block)]
+    for i, blk in enumerate(blocks):
+        if policy == "none" or i % every != 0:
+            blk.grad_checkpointing = None
+        else:
+            blk.grad_checkpointing = policy
+
 def get_attention_mask(x,length):
     batch_size, max_len, _ = x.shape
     # create mask for padded elements and zero-out them
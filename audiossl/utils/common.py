@@ -1,3 +1,5 @@
+import inspect
+
 import torch
 import numpy as np
 @torch.no_grad()
@@ -13,6 +15,29 @@ def concat_all_gather(tensor):
     output = torch.cat(tensors_gather, dim=0)
     return output
 
+class EMAUpdater:
+    """EMA update of teacher parameters from student parameters.
+
+    The (student, teacher) pairs are collected once, every update is then a single
+    ``torch._foreach_lerp_`` over all tensors instead of two kernels plus a
+    temporary per parameter: teacher = m * teacher + (1 - m) * student.
+
+    Example::
+
+            ema = EMAUpdater(zip(student.parameters(), teacher.parameters()))
+            ema(0.99)
+    """
+    def __init__(self, param_pairs):
+        pairs = list(param_pairs)
+        self.student_params = [q for q, _ in pairs]
+        self.teacher_params = [k for _, k in pairs]
+
+    @torch.no_grad()
+    def __call__(self, m):
+        if len(self.teacher_params) == 0:
+            return
+        torch._foreach_lerp_(self.teacher_params, self.student_params, 1. - float(m))
+
 def cosine_scheduler_epoch(base_value, final_value, epochs, niter_per_ep, warmup_epochs=0, start_warmup_value=0):
     warmup_schedule = np.array([])
     warmup_iters = warmup_epochs * niter_per_ep
@@ -50,6 +75,35 @@ def get_params_groups(model):
         else:
             regularized.append(param)
     return [{'params': regularized}, {'params': not_regularized, 'weight_decay': 0.}]
+
+def merge_param_groups(groups):
+    """Merge optimizer param groups that share the same options (lr_scale,
+    weight_decay, ...) into one group each, in order of first appearance.
+
+    Per parameter groups (e.g. for layer-wise lr decay) become one group per
+    distinct setting, so the lr schedule updates a handful of groups per step
+    and foreach / fused optimizer kernels run over whole groups.
+    """
+    merged = {}
+    for group in groups:
+        options = tuple(sorted((k, v) for k, v in group.items() if k != "params"))
+        params = group["params"]
+        params = [params] if isinstance(params, torch.Tensor) else list(params)
+        if options not in merged:
+            merged[options] = dict(group, params=[])
+        merged[options]["params"].extend(params)
+    return list(merged.values())
+
+def optimizer_impl_kwargs(optimizer_cls, params):
+    """`fused=True` if all `params` are cuda floating point tensors and
+    `optimizer_cls` has a fused implementation, otherwise `foreach=True`"""
+    signature = inspect.signature(optimizer_cls).parameters
+    params = [p for group in params for p in (group["params"] if isinstance(group, dict) else [group])]
+    if "fused" in signature and all(p.is_cuda and p.is_floating_point() for p in params):
+        return {"fused": True}
+    if "foreach" in signature:
+        return {"foreach": True}
+    return {}
 def bool_flag(s):
     """
     Parse boolean arguments from the command line.